@@ -0,0 +1,373 @@
+"""
+    Admin tools: broadcasting a message to every telegram user and guest
+    the bot knows, and the fleet wide numbers of aggregates.py.
+
+    Recipients are read in keyset paginated batches ordered by username,
+    so a broadcast never holds more than a few batches in memory. The
+    running bot sends the broadcasts queued in BROADCASTS_DB through its
+    own senders.OutboundSender, so they share its limit of messages per
+    second, and takes at most `rate` of them to leave room for its
+    replies. Every finished batch moves the broadcast's cursor, and the
+    recipients of the batches after it are recorded as they're sent, so a
+    broadcast that crashed resumes where it stopped without messaging
+    anyone twice. A process sending a broadcast holds a lease on it, so
+    it's never sent by two at once.
+
+        python admins.py broadcast "message"          queued for the bot
+        python admins.py broadcast --here "message"   sent from here, with the bot stopped
+        python admins.py resume <id>                  sent from here
+        python admins.py list
+        python admins.py stats
+"""
+
+import sys, time, asyncio, logging, pathlib, sqlite3, argparse
+from datetime import datetime
+from sqlalchemy import select, union
+
+from models import engine, TelegramUsers, GuestUsers
+from senders import TokenBucket
+from aggregates import Aggregates
+from configs import (BROADCASTS_DB,
+                     BROADCAST_RATE,
+                     BROADCAST_BATCH_SIZE,
+                     BROADCAST_POLL_INTERVAL,
+                     AGGREGATES_DB)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _usernames_after(column, after, limit):
+    query = select(column.label("username")).where(column.isnot(None))
+    if after is not None:
+        query = query.where(column > after)
+    # sqlite only takes ORDER BY and LIMIT on a union's parts inside a subquery
+    return select(query.order_by(column).limit(limit).subquery())
+
+
+def recipients_after(conn, after, limit):
+    """
+        The next `limit` usernames after `after`, of telegram users and guests
+        both. Each table gives at most `limit` from its username index and
+        only those are merged, so a page costs the same wherever it starts.
+    """
+    everyone = union(_usernames_after(TelegramUsers.username, after, limit),
+                     _usernames_after(GuestUsers.username, after, limit)).subquery()
+    return conn.execute(
+        select(everyone.c.username).order_by(everyone.c.username).limit(limit)
+    ).scalars().all()
+
+
+class BroadcastTaken(Exception):
+    """Another process is sending the broadcast, or it's finished."""
+
+
+class BroadcastStore:
+    """The broadcasts and how far each got, in a small sqlite file."""
+    def __init__(self, path=BROADCASTS_DB):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # a commit per recipient sent to, without an fsync each. Under WAL
+        # they still survive the process crashing, only not the machine.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY, text TEXT NOT NULL, created TEXT NOT NULL, "
+            "cursor TEXT, delivered INTEGER NOT NULL DEFAULT 0, "
+            "failed INTEGER NOT NULL DEFAULT 0, skipped INTEGER NOT NULL DEFAULT 0, "
+            "finished TEXT)"
+        )
+        # until when the process sending a broadcast holds it, a unix time
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(broadcasts)")}
+        if "lease" not in columns:
+            self._conn.execute("ALTER TABLE broadcasts ADD COLUMN lease REAL")
+        # recipients past the cursor that were sent to already, and how it went
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent ("
+            "broadcast_id INTEGER NOT NULL, username TEXT NOT NULL, outcome TEXT NOT NULL, "
+            "PRIMARY KEY (broadcast_id, username))"
+        )
+        self._conn.commit()
+
+    def create(self, text) -> int:
+        with self._conn:
+            return self._conn.execute(
+                "INSERT INTO broadcasts (text, created) VALUES (?, ?)",
+                (text, datetime.now().isoformat())
+            ).lastrowid
+
+    def get(self, broadcast_id):
+        return self._conn.execute("SELECT * FROM broadcasts WHERE id=?",
+                                  (broadcast_id,)).fetchone()
+
+    def all(self):
+        return self._conn.execute("SELECT * FROM broadcasts ORDER BY id").fetchall()
+
+    def pending(self) -> list:
+        """Ids of the unfinished broadcasts nobody is sending."""
+        return [row["id"] for row in self._conn.execute(
+            "SELECT id FROM broadcasts WHERE finished IS NULL AND "
+            "(lease IS NULL OR lease < ?) ORDER BY id", (time.time(),))]
+
+    def claim(self, broadcast_id, seconds) -> bool:
+        """Leases the broadcast for `seconds`, False if it's finished or leased already."""
+        now = time.time()
+        with self._conn:
+            return self._conn.execute(
+                "UPDATE broadcasts SET lease=? WHERE id=? AND finished IS NULL AND "
+                "(lease IS NULL OR lease < ?)", (now + seconds, broadcast_id, now)
+            ).rowcount == 1
+
+    def mark_sent(self, broadcast_id, username, outcome):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sent VALUES (?, ?, ?)",
+                               (broadcast_id, username, outcome))
+
+    def sent(self, broadcast_id) -> dict:
+        """username -> outcome of the recipients past the cursor sent to already."""
+        return dict(self._conn.execute("SELECT username, outcome FROM sent WHERE broadcast_id=?",
+                                       (broadcast_id,)).fetchall())
+
+    def checkpoint(self, broadcast_id, cursor, delivered, failed, skipped,
+                   finished=False, lease=None):
+        """Also extends the lease by `lease` seconds, or gives it up when finished."""
+        with self._conn:
+            self._conn.execute(
+                "UPDATE broadcasts SET cursor=?, delivered=?, failed=?, skipped=?, "
+                "finished=?, lease=? WHERE id=?",
+                (cursor, delivered, failed, skipped,
+                 datetime.now().isoformat() if finished else None,
+                 None if finished or lease is None else time.time() + lease,
+                 broadcast_id)
+            )
+            # the counts above include the recipients up to the cursor
+            if finished:
+                self._conn.execute("DELETE FROM sent WHERE broadcast_id=?", (broadcast_id,))
+            elif cursor is not None:
+                self._conn.execute("DELETE FROM sent WHERE broadcast_id=? AND username<=?",
+                                   (broadcast_id, cursor))
+
+    def release(self, broadcast_id):
+        with self._conn:
+            self._conn.execute("UPDATE broadcasts SET lease=NULL WHERE id=?", (broadcast_id,))
+
+
+class Broadcaster:
+    """
+        sender is a started senders.OutboundSender and chat_id_of(username)
+        returns where to message a user, or None. In the bot, sender is the
+        one its replies go through, so both share its global limit and the
+        broadcast takes at most `rate` of it.
+    """
+    def __init__(self,
+                 sender,
+                 chat_id_of,
+                 store=None,
+                 rate=BROADCAST_RATE,
+                 batch_size=BROADCAST_BATCH_SIZE,
+                 workers=32):
+        self.sender = sender
+        self.chat_id_of = chat_id_of
+        self.store = store or BroadcastStore()
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.workers = workers
+        # seconds a lease lasts, renewed after every batch
+        self.lease = max(60, 3*batch_size/rate)
+
+    def _next_batch(self, after):
+        with engine.connect() as conn:
+            usernames = recipients_after(conn, after, self.batch_size)
+        return [(username, self.chat_id_of(username)) for username in usernames]
+
+    async def run(self, broadcast_id) -> dict:
+        """Sends the broadcast to everyone after its cursor, returns its report."""
+        row = self.store.get(broadcast_id)
+        if row is None:
+            raise KeyError(f"no broadcast {broadcast_id}")
+        if not self.store.claim(broadcast_id, self.lease):
+            raise BroadcastTaken(f"broadcast {broadcast_id} is finished or being sent")
+        text = row["text"]
+        # only finished batches are counted and checkpointed, a resumed
+        # broadcast counts the recipients of later batches it sent to already
+        # without sending again
+        already = self.store.sent(broadcast_id)
+        counts = {"delivered": row["delivered"], "failed": row["failed"], "skipped": row["skipped"]}
+        started, sent_before = time.perf_counter(), row["delivered"] + row["failed"]
+        # (batch number, username, chat id), None stops a worker
+        queue = asyncio.Queue(maxsize=self.workers*4)
+        # batch number -> its messages left, last username and counts. The
+        # cursor only moves past a batch once it and all before it finished.
+        batches, done = {}, {"next": 0, "cursor": row["cursor"]}
+
+        def finished_one(number, outcome=None):
+            batch = batches[number]
+            batch["left"] -= 1
+            if outcome:
+                batch[outcome] += 1
+            while done["next"] in batches and batches[done["next"]]["left"] == 0:
+                batch = batches.pop(done["next"])
+                for key in counts:
+                    counts[key] += batch[key]
+                done["cursor"] = batch["last"]
+                done["next"] += 1
+                self.store.checkpoint(broadcast_id, done["cursor"], lease=self.lease, **counts)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                number, username, chat_id = item
+                await self.bucket.acquire()
+                try:
+                    await self.sender.batch(chat_id).text(text).send()
+                    outcome = "delivered"
+                except Exception as e:
+                    # mostly users who blocked the bot
+                    logger.info("broadcast %s to %s failed: %s", broadcast_id, chat_id, e)
+                    outcome = "failed"
+                self.store.mark_sent(broadcast_id, username, outcome)
+                finished_one(number, outcome)
+
+        workers = [asyncio.create_task(work()) for _ in range(self.workers)]
+        after, number = row["cursor"], 0
+        try:
+            while True:
+                batch = await asyncio.to_thread(self._next_batch, after)
+                if not batch:
+                    break
+                after = batch[-1][0]
+                recipients = [(username, chat_id) for username, chat_id in batch
+                              if chat_id is not None and username not in already]
+                # the extra count is for the batch itself, so an empty one finishes too
+                batches[number] = {"left": len(recipients) + 1,
+                                   "last": after,
+                                   "delivered": 0,
+                                   "failed": 0,
+                                   "skipped": sum(1 for username, chat_id in batch
+                                                  if chat_id is None and username not in already)}
+                for username, _ in batch:
+                    if username in already:
+                        batches[number][already[username]] += 1
+                for username, chat_id in recipients:
+                    await queue.put((number, username, chat_id))
+                finished_one(number)
+                number += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            self.store.release(broadcast_id)
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+        self.store.checkpoint(broadcast_id, done["cursor"], finished=True, **counts)
+        elapsed = time.perf_counter() - started
+        sent = counts["delivered"] + counts["failed"] - sent_before
+        return {
+            "id": broadcast_id,
+            **counts,
+            "elapsed": elapsed,
+            "rate": sent / elapsed if elapsed else 0.0,
+        }
+
+    async def watch(self, interval=BROADCAST_POLL_INTERVAL):
+        """Sends the queued broadcasts one after another, until cancelled."""
+        while True:
+            for broadcast_id in self.store.pending():
+                try:
+                    report = await self.run(broadcast_id)
+                except BroadcastTaken:
+                    continue
+                except Exception:
+                    logger.exception("broadcast %s failed", broadcast_id)
+                    continue
+                logger.info("broadcast %s finished: %s", broadcast_id, report)
+            await asyncio.sleep(interval)
+
+
+def print_report(report):
+    print(f"broadcast {report['id']}: delivered={report['delivered']} "
+          f"failed={report['failed']} without chat={report['skipped']} "
+          f"took={report['elapsed']:.1f}s rate={report['rate']:.1f}/s")
+
+
+def print_stats(aggregates, top=10, days=7):
+    for name, total in sorted(aggregates.totals().items()):
+        print(f"{name:>8}: inbounds={total['inbounds']} used={total['used']/2**30:.1f}GB "
+              f"quota={total['quota']/2**30:.1f}GB")
+    print("top consumers:")
+    for bot_id, used, quota, inbounds in aggregates.top_consumers(top):
+        print(f"  bot user {bot_id}: used={used/2**30:.1f}GB of {quota/2**30:.1f}GB "
+              f"in {inbounds} inbounds")
+    expiring = aggregates.expiring(days)
+    print(f"expiring in {days} days: {sum(expiring.values())} inbounds")
+    for day, count in expiring.items():
+        print(f"  {day}: {count}")
+    conversion = aggregates.trial_conversion()
+    print(f"guests: {conversion['guests']}, logged in later: {conversion['converted']} "
+          f"({conversion['rate']:.1%})")
+    print("traffic per day:")
+    for day, used in aggregates.daily_usage(days).items():
+        print(f"  {day}: {used/2**30:.1f}GB")
+
+
+async def _run_from_cli(broadcast_id=None, text=None):
+    from telegram import Bot
+    from senders import OutboundSender
+    from backends import chat_id_of
+    from configs import (ACCESS_TOKEN,
+                         TELEGRAM_GLOBAL_RATE,
+                         TELEGRAM_CHAT_RATE,
+                         TELEGRAM_CHAT_BURST,
+                         SENDER_WORKERS)
+
+    sender = OutboundSender(global_rate=TELEGRAM_GLOBAL_RATE,
+                            chat_rate=TELEGRAM_CHAT_RATE,
+                            chat_burst=TELEGRAM_CHAT_BURST,
+                            workers=SENDER_WORKERS)
+    broadcaster = Broadcaster(sender, chat_id_of)
+    if broadcast_id is None:
+        broadcast_id = broadcaster.store.create(text)
+        print(f"created broadcast {broadcast_id}", file=sys.stderr)
+    async with Bot(ACCESS_TOKEN) as bot:
+        sender.start(bot)
+        try:
+            return await broadcaster.run(broadcast_id)
+        finally:
+            await sender.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    broadcast = commands.add_parser("broadcast")
+    broadcast.add_argument("text")
+    broadcast.add_argument("--here", action="store_true",
+                           help="send it from this process instead of the running bot")
+    commands.add_parser("resume").add_argument("id", type=int)
+    commands.add_parser("list")
+    commands.add_parser("stats").add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print_stats(Aggregates().open(AGGREGATES_DB, load=False), top=args.top)
+    elif args.command == "list":
+        for row in BroadcastStore().all():
+            state = f"finished {row['finished']}" if row["finished"] else f"at {row['cursor']!r}"
+            print(f"{row['id']:>4} {row['created']} {state} delivered={row['delivered']} "
+                  f"failed={row['failed']} without chat={row['skipped']}: {row['text'][:40]!r}")
+    elif args.command == "broadcast" and not args.here:
+        broadcast_id = BroadcastStore().create(args.text)
+        print(f"queued broadcast {broadcast_id}, the bot sends it within "
+              f"{BROADCAST_POLL_INTERVAL:.0f}s")
+    elif args.command == "broadcast":
+        print_report(asyncio.run(_run_from_cli(text=args.text)))
+    else:
+        print_report(asyncio.run(_run_from_cli(broadcast_id=args.id)))
@@ -0,0 +1,287 @@
+"""
+    Fleet wide numbers for the admins, kept up to date from the traffic
+    snapshot instead of computed by reading every inbound.
+
+    Every inbound counts itself, its traffic and its quota into a few rollup
+    rows: the whole fleet, its protocol, the bot user or guest it belongs to
+    and the day it expires. What each inbound counted is kept too, so after
+    a refresh only the inbounds that changed move their rollups, by the
+    difference. Traffic is also added to the row of the day it was seen.
+    The rows live in a small sqlite file, and the admin queries read a
+    handful of them however many inbounds there are.
+
+    After editing the x-ui database by hand, or to start over, with the bot
+    stopped:
+
+        python aggregates.py rebuild
+"""
+
+import time, asyncio, logging, pathlib, sqlite3, argparse, threading
+from datetime import date, timedelta
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    # kind is fleet, protocol, bot, guest, expiry, day or trials
+    "CREATE TABLE IF NOT EXISTS rollups ("
+    "kind TEXT NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, "
+    "used INTEGER NOT NULL DEFAULT 0, quota INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (kind, key))",
+    "CREATE INDEX IF NOT EXISTS rollups_by_used ON rollups (kind, used)",
+    # what every inbound counted into the rollups
+    "CREATE TABLE IF NOT EXISTS inbounds ("
+    "id INTEGER PRIMARY KEY, account_kind TEXT, account TEXT, protocol TEXT, "
+    "used INTEGER, quota INTEGER, expires TEXT)",
+    "CREATE INDEX IF NOT EXISTS inbounds_by_expiry ON inbounds (expires)",
+)
+# rollups that go away once no inbound counts into them
+COUNTED_KINDS = {"protocol", "bot", "guest", "expiry"}
+
+
+def _expiry_day(expiry_time):
+    if not expiry_time:
+        return None
+    return date.fromtimestamp(expiry_time*1e-3).isoformat()
+
+
+class Aggregates:
+    def __init__(self):
+        # inbound id -> (account kind, account, protocol, used, quota, expiry day)
+        self.state = {}
+        self.updates = 0
+        self.last_changes = 0
+        self._conn = None
+        # the next update reads every inbound, not only the changed ones
+        self._full = True
+        self._lock = threading.Lock()
+        self._serial = None
+        self._tasks = set()
+
+    def open(self, path, load=True):
+        """load=False opens the rollups for the queries only, without updating them."""
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        with self._lock:
+            self._conn = conn
+            if not load:
+                return self
+            self.state = {
+                row[0]: row[1:]
+                for row in conn.execute("SELECT id, account_kind, account, protocol, "
+                                        "used, quota, expires FROM inbounds")
+            }
+            # inbounds changed while the bot was down
+            self._full = True
+        return self
+
+    @staticmethod
+    def _row(snapshot, stat):
+        kind, account = snapshot.account_of(stat.id) or (None, None)
+        return (kind,
+                None if account is None else str(account),
+                stat.protocol,
+                stat.up + stat.down,
+                stat.total,
+                _expiry_day(stat.expiry_time))
+
+    def update(self, snapshot, changed=None, reowned=None, full=False, now=None) -> int:
+        """
+            Moves the rollups by what changed in the snapshot since the last
+            update, returns how many inbounds changed. changed and reowned
+            default to the snapshot's. Blocking.
+        """
+        today = date.fromtimestamp(now or time.time()).isoformat()
+        deltas = {}
+
+        def move(state, sign):
+            kind, account, protocol, used, quota, expires = state
+            keys = [("fleet", ""), ("protocol", protocol or "")]
+            if kind is not None:
+                keys.append((kind, account))
+            if expires is not None:
+                keys.append(("expiry", expires))
+            for key in keys:
+                delta = deltas.setdefault(key, [0, 0, 0])
+                delta[0] += sign
+                delta[1] += sign*used
+                delta[2] += sign*quota
+
+        with self._lock:
+            # an unrefreshed snapshot has no inbounds, not all of them removed
+            if self._conn is None or snapshot.refreshed_at is None:
+                return 0
+            inbounds = snapshot.inbounds
+            full, self._full = full or self._full, False
+            if full:
+                ids = inbounds.keys()
+            else:
+                ids = set(snapshot.changed if changed is None else changed)
+                ids.update(snapshot.reowned if reowned is None else reowned)
+            stored, deleted = [], []
+            for inbound_id in ids:
+                stat = inbounds.get(inbound_id)
+                if stat is None:
+                    continue
+                state = self._row(snapshot, stat)
+                old = self.state.get(inbound_id)
+                if old == state:
+                    continue
+                if old is not None:
+                    move(old, -1)
+                    # a counter reset by an admin adds nothing
+                    used = state[3] - old[3]
+                    if used > 0:
+                        deltas.setdefault(("day", today), [0, 0, 0])[1] += used
+                move(state, 1)
+                self.state[inbound_id] = state
+                stored.append((inbound_id, *state))
+            # the changed ids don't include removed inbounds, the counts tell
+            if full or len(self.state) != len(inbounds):
+                deleted = list(self.state.keys() - inbounds.keys())
+                for inbound_id in deleted:
+                    move(self.state.pop(inbound_id), -1)
+            deltas = {k: v for k, v in deltas.items() if any(v)}
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO rollups (kind, key, count, used, quota) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (kind, key) DO UPDATE SET count=count+excluded.count, "
+                    "used=used+excluded.used, quota=quota+excluded.quota",
+                    [(*key, *delta) for key, delta in deltas.items()])
+                self._conn.executemany(
+                    "DELETE FROM rollups WHERE kind=? AND key=? AND count<=0",
+                    [key for key, delta in deltas.items()
+                     if key[0] in COUNTED_KINDS and delta[0] < 0])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO inbounds (id, account_kind, account, protocol, "
+                    "used, quota, expires) VALUES (?, ?, ?, ?, ?, ?, ?)", stored)
+                self._conn.executemany("DELETE FROM inbounds WHERE id=?",
+                                       [(i,) for i in deleted])
+                if full or snapshot.links_changed:
+                    guests, converted = snapshot.trial_conversions()
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO rollups (kind, key, count) VALUES (?, ?, ?)",
+                        [("trials", "guests", guests), ("trials", "converted", converted)])
+            self.updates += 1
+            self.last_changes = len(stored) + len(deleted)
+            return self.last_changes
+
+    def rebuild(self, snapshot) -> int:
+        """Recounts every rollup but the daily traffic from a refreshed snapshot."""
+        with self._lock:
+            self.state = {}
+            with self._conn:
+                self._conn.execute("DELETE FROM rollups WHERE kind!='day'")
+                self._conn.execute("DELETE FROM inbounds")
+        return self.update(snapshot, full=True)
+
+    def observe(self, snapshot, now=None):
+        """Snapshot listener. Updates run on a thread, in the order of the refreshes."""
+        if self._conn is None:
+            return
+        if self._serial is None:
+            self._serial = asyncio.Lock()
+        # the snapshot replaces these lists on its next refresh
+        changed, reowned = snapshot.changed, snapshot.reowned
+
+        async def update():
+            async with self._serial:
+                try:
+                    await asyncio.to_thread(self.update, snapshot, changed, reowned, now=now)
+                except Exception:
+                    logger.exception("updating the aggregates failed")
+
+        task = asyncio.ensure_future(update())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _rows(self, query, *parameters):
+        with self._lock:
+            return self._conn.execute(query, parameters).fetchall()
+
+    def totals(self) -> dict:
+        """Inbounds, traffic used and quota of the whole fleet and of every protocol."""
+        rows = self._rows("SELECT kind, key, count, used, quota FROM rollups "
+                          "WHERE kind IN ('fleet', 'protocol')")
+        return {
+            (key if kind == "protocol" else "all"): {"inbounds": count, "used": used, "quota": quota}
+            for kind, key, count, used, quota in rows
+        }
+
+    def top_consumers(self, n=10) -> list:
+        """(bot user id, traffic used, quota, inbounds) of the n bot users that used the most."""
+        return [
+            (int(key), used, quota, count)
+            for key, count, used, quota in self._rows(
+                "SELECT key, count, used, quota FROM rollups WHERE kind='bot' "
+                "ORDER BY used DESC LIMIT ?", n)
+        ]
+
+    def expiring(self, days=7, now=None) -> dict:
+        """expiry day -> how many inbounds expire that day, over the next `days` days."""
+        today = date.fromtimestamp(now or time.time())
+        return dict(self._rows(
+            "SELECT key, count FROM rollups WHERE kind='expiry' AND key BETWEEN ? AND ? "
+            "ORDER BY key", today.isoformat(), (today + timedelta(days=days)).isoformat()))
+
+    def expiring_accounts(self, days=7, now=None, limit=100) -> list:
+        """(account kind, account, expiry day) of the inbounds expiring in the next `days` days."""
+        today = date.fromtimestamp(now or time.time())
+        return self._rows(
+            "SELECT account_kind, account, expires FROM inbounds WHERE expires BETWEEN ? AND ? "
+            "ORDER BY expires LIMIT ?",
+            today.isoformat(), (today + timedelta(days=days)).isoformat(), limit)
+
+    def trial_conversion(self) -> dict:
+        """How many guests there are and how many of them went on to log into a bot user."""
+        counts = dict(self._rows("SELECT key, count FROM rollups WHERE kind='trials'"))
+        guests, converted = counts.get("guests", 0), counts.get("converted", 0)
+        return {"guests": guests,
+                "converted": converted,
+                "rate": converted / guests if guests else 0.0}
+
+    def daily_usage(self, days=30, now=None) -> dict:
+        """day -> traffic used over the fleet that day, for the last `days` days."""
+        today = date.fromtimestamp(now or time.time())
+        return dict(self._rows(
+            "SELECT key, used FROM rollups WHERE kind='day' AND key BETWEEN ? AND ? "
+            "ORDER BY key", (today - timedelta(days=days)).isoformat(), today.isoformat()))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "inbounds": len(self.state),
+            "updates": self.updates,
+            "last_changes": self.last_changes,
+        }
+
+
+if __name__ == "__main__":
+    from snapshots import TrafficSnapshot
+    from configs import AGGREGATES_DB
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    snapshot = TrafficSnapshot()
+    snapshot.refresh()
+    aggregates = Aggregates().open(AGGREGATES_DB)
+    aggregates.rebuild(snapshot)
+    aggregates.close()
+    print(f"rebuilt the aggregates of {len(snapshot.inbounds)} inbounds "
+          f"in {time.perf_counter() - started:.2f}s")
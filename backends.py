@@ -1,91 +1,294 @@
-import pickle, uuid, random, subprocess, shlex
+import uuid, json, asyncio, weakref, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta as rel_delta
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError
 
-from models import engine, BotUsers, TelegramUsers, GuestUsers, Inbounds
-from configs import BOT_SESSIONS_PATH, SSL_PRIVATE, SSL_PUBLIC, URL
+from caches import TTLCache
+from snapshots import TrafficSnapshot
+from timeseries import TrafficHistory
+from aggregates import Aggregates
+from dashboards import load_dashboard, InboundView, INBOUND_COLUMNS
+from reloads import XUIReloader
+from ports import PortAllocator, PortTaken, check_taken
+from trials import TrialPool
+from fleet import Node, Fleet
+from watchers import ChangeWatcher
+from session_stores import PickleFileStore, SQLiteSessionStore
+from models import (Session, 
+                    engine,
+                    create_xui_engine,
+                    session_scope, 
+                    BotUsers, 
+                    TelegramUsers, 
+                    GuestUsers, 
+                    Inbounds,
+                    UsersInboundsRelation)
+from utils import qr_cache
+from configs import (XUI_DB_PATH,
+                     XUI_NODE_NAME,
+                     XUI_NODES,
+                     XUI_NODE_RELOAD_COMMAND,
+                     BOT_SESSIONS_PATH, 
+                     BOT_SESSIONS_STORE,
+                     BOT_SESSIONS_DB,
+                     BOT_SESSIONS_FLUSH_INTERVAL,
+                     SSL_PRIVATE, 
+                     SSL_PUBLIC, 
+                     URL, 
+                     DB_WORKERS,
+                     AUTH_CACHE_TTL,
+                     AUTH_CACHE_SIZE,
+                     STATS_POLL_INTERVAL,
+                     TRAFFIC_HISTORY_INTERVAL,
+                     XUI_RELOAD_COMMAND,
+                     XUI_RELOAD_DEBOUNCE,
+                     XUI_RELOAD_MAX_DELAY,
+                     INBOUND_PORT_MIN,
+                     INBOUND_PORT_MAX,
+                     INBOUND_PORT_CHECK_OS,
+                     TRIAL_POOL_SIZE,
+                     TRIAL_QUOTA,
+                     TRIAL_DAYS)
+
+
+# the protocols inbound_values can build the settings of
+PROTOCOLS = ("vless", "vmess", "trojan")
+# a bounded pool for the blocking sqlalchemy calls, so a slow sqlite read
+# doesn't freeze the event loop for every other telegram update
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS,
+                                 thread_name_prefix="db")
+
+
+# username -> (is_auth, bot_id)
+auth_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+# filled by traffic_snapshot.poll(), started next to the bot
+traffic_snapshot = TrafficSnapshot(stale_after=STATS_POLL_INTERVAL*3)
+# sampled from traffic_snapshot, opened next to the bot
+traffic_history = TrafficHistory(interval=TRAFFIC_HISTORY_INTERVAL)
+# rollups for the admins, moved by every snapshot refresh once opened next to the bot
+fleet_aggregates = Aggregates()
+# started next to the bot; until then reloads run synchronously
+xui_reloader = XUIReloader(XUI_RELOAD_COMMAND,
+                           debounce=XUI_RELOAD_DEBOUNCE,
+                           max_delay=XUI_RELOAD_MAX_DELAY)
+port_allocator = PortAllocator(INBOUND_PORT_MIN, 
+                               INBOUND_PORT_MAX, 
+                               check_os=INBOUND_PORT_CHECK_OS)
+# run next to the bot, tells the caches above what changed in the database
+db_watcher = ChangeWatcher(XUI_DB_PATH)
+
+
+def _remote_node(name, db_path, host):
+    node_engine = create_xui_engine(db_path)
+    return Node(name,
+                host,
+                node_engine,
+                PortAllocator(INBOUND_PORT_MIN, INBOUND_PORT_MAX, engine=node_engine),
+                XUIReloader(XUI_NODE_RELOAD_COMMAND.format(name=name, host=host.split(":")[0]),
+                            debounce=XUI_RELOAD_DEBOUNCE,
+                            max_delay=XUI_RELOAD_MAX_DELAY))
+
+
+# the caches, snapshot and jobs above only cover the local node
+fleet = Fleet([Node(XUI_NODE_NAME, URL, engine, port_allocator, xui_reloader)]
+              + [_remote_node(*node) for node in XUI_NODES],
+              placements_cache=TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL))
+
+
+def _forget_auth_states(changes):
+    for username in changes:
+        auth_cache.invalidate(username)
+
+
+def _track_ports(changes):
+    # until it's loaded the allocator reads the ports itself
+    if not port_allocator.loaded:
+        return
+    for old, new in changes.values():
+        if old is not None and (new is None or new[0] != old[0]):
+            port_allocator.release(old[0])
+        if new is not None:
+            port_allocator.mark_used(new[0])
+
+
+db_watcher.subscribe("users", _forget_auth_states)
+db_watcher.subscribe("inbounds", _track_ports)
+db_watcher.subscribe("owners", lambda changes: fleet.placements_cache.clear())
+# the counters x-ui writes every few seconds are still left to the poll interval
+for event in ("inbounds", "users", "owners"):
+    db_watcher.subscribe(event, lambda changes: traffic_snapshot.request_refresh())
+
+
+async def run_in_db(function, *args, **kwargs):
+    """Runs a blocking database call on the db executor and awaits it."""
+    loop = asyncio.get_running_loop()
+    # carry context variables over, like models.count_statements() uses
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor,
+                                      partial(context.run, function, *args, **kwargs))
 
 
 class BotUsersBackend:
+    """
+        Holds one session for its lifetime; close it, or use it as a
+        context manager, once you're done with it.
+    """
     def __init__(self, username):
-        self.Session = sessionmaker(bind=engine)()
+        self.Session = Session()
         self.username = username
-        self.instance = (
-            self
-            .Session
-            .query(BotUsers)
-            .join(TelegramUsers)
-            .filter(TelegramUsers.username==username)
-        )
-        self.bot = None
-        self._get_bot_ready()
+        self._dashboard = None
+        self._remote_inbounds = None
         
-    def _get_bot_ready(self):
-        bot_qs = (
-            self
-            .Session
-            .query(BotUsers)
-            .join(TelegramUsers)
-            .filter(TelegramUsers.username==self.username)
-        )
-        if bot_qs.scalar():
-            self.bot = bot_qs.first()
+    @property
+    def dashboard(self):
+        """The user, its bot user and their inbounds, loaded once with one query."""
+        if self._dashboard is None:
+            self._dashboard = load_dashboard(self.Session, self.username)
+        return self._dashboard
+
+    @property
+    def remote_inbounds(self):
+        """
+            (node, InboundView) of the bot user's inbounds on the other nodes,
+            read at once. Unless the dashboard was loaded already, it's read
+            in the same fan_out when the bot id and placements are cached.
+        """
+        if self._remote_inbounds is not None:
+            return self._remote_inbounds
+        if self._dashboard is None:
+            state = auth_cache.get(self.username)
+            bot_id = state[1] if state else None
+            loaded = fleet.inbounds_alongside(
+                bot_id, partial(load_dashboard, self.Session, self.username))
+            if loaded is not None:
+                self._dashboard, remote_inbounds = loaded
+                if self._dashboard.bot_id == bot_id:
+                    self._remote_inbounds = remote_inbounds
+                    return remote_inbounds
+        self._remote_inbounds = fleet.inbounds_of(self.dashboard.bot_id)
+        return self._remote_inbounds
+    
+    @property
+    def bot(self):
+        bot_id = self.dashboard.bot_id
+        return self.Session.get(BotUsers, bot_id) if bot_id else None
+            
+    def close(self):
+        self.Session.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
         
     def log_in_from_code(self, login_code):
         bot_qs = self.Session.query(BotUsers).filter_by(login_code=login_code)
         if not bot_qs.scalar():
             return False
-        if not self.instance.scalar():
+        bot_id = bot_qs.first().id
+        tel_qs = self.Session.query(TelegramUsers).filter_by(username=self.username)
+        if not tel_qs.scalar():
             tel_user = TelegramUsers(username=self.username,
                                      is_auth=True,
-                                     bot_id=bot_qs.first().id)
+                                     bot_id=bot_id)
             self.Session.add(tel_user)
-            self.Session.commit()
         else:
-            self.instance.update({"is_auth": True}, synchronize_session=False)
-            self.Session.commit()
+            tel_qs.update({"is_auth": True, "bot_id": bot_id}, 
+                          synchronize_session=False)
+        self.Session.commit()
+        auth_cache.invalidate(self.username)
+        self._dashboard = None
+        self._remote_inbounds = None
+        return True
 
-    def log_user_out(self, username):
-        Session = sessionmaker(bind=engine)()
-        qs = Session.query(TelegramUsers).filter_by(username=username)
+    def log_user_out(self, username=None):
+        username = username or self.username
+        qs = self.Session.query(TelegramUsers).filter_by(username=username)
         if qs.scalar():
-            self.instance.delete(synchronize_session=False)
+            qs.delete(synchronize_session=False)
             self.Session.commit()
+        auth_cache.invalidate(username)
+        self._dashboard = None
+        self._remote_inbounds = None
     
     def get_connection_urls(self):
-        qs = (
-            self
-            .Session
-            .query(Inbounds)
-            .join(TelegramUsers)
-            .filter(TelegramUsers.username==self.username)
-            .all()
-        )
-        return {i.protocol: i.get_login_url() for i in qs}
+        remote_inbounds = self.remote_inbounds
+        inbounds = self.dashboard.inbounds
+        urls = Inbounds.get_login_urls(inbounds)
+        accounts = {i.protocol: urls[i.id] for i in inbounds}
+        for node, inbound in remote_inbounds:
+            accounts[f"{inbound.protocol} ({node.name})"] = inbound.get_login_url(node.host)
+        return accounts
     
-    def get_inbound_stats(self):
-        inbounds = (
-            self.Session
-            .query(Inbounds)
-            .join(TelegramUsers)
-            .join(GuestUsers)
-            .filter(TelegramUsers.username==self.username
-                    or GuestUsers.username==self.username)
-            .all()
-        )
-        stats = {
+    @staticmethod
+    def _daily_usage(inbound):
+        """Bytes used over the last day, None until there is some history."""
+        rate = traffic_history.usage_rate(inbound.id)
+        return None if rate is None else int(rate*86400)
+
+    @staticmethod
+    def _exhaustion_date(inbound):
+        """The day the traffic runs out at the current rate, None if it won't."""
+        exhaustion = traffic_history.projected_exhaustion(inbound)
+        return None if exhaustion is None else exhaustion.date().isoformat()
+
+    @classmethod
+    def _format_stats(cls, inbounds, node=None):
+        """
+            Takes Inbounds, dashboards.InboundView or snapshots.InboundStat
+            objects. The traffic history only has the local node's inbounds.
+        """
+        if node is not None:
+            return {
+                f"{i.remark} ({node.name})": {
+                    "دانلود": i.down,
+                    "آپلود": i.up,
+                    "سهم کل": i.total,
+                    "حجم باقی مانده": i.remaining_traffic,
+                    "روز های باقی مانده": i.expires_in,
+                }
+                for i in inbounds
+            }
+        return {
             i.remark: {
                 "دانلود": i.down,
                 "آپلود": i.up,
                 "سهم کل": i.total,
                 "حجم باقی مانده": i.remaining_traffic,
                 "روز های باقی مانده": i.expires_in,
+                "مصرف روزانه": cls._daily_usage(i),
+                "پایان حجم": cls._exhaustion_date(i),
             }
             for i in inbounds
         }
+    
+    def get_inbound_stats(self):
+        remote_inbounds = self.remote_inbounds
+        if traffic_snapshot.ready:
+            stats = self._format_stats(traffic_snapshot.of_username(self.username))
+        else:
+            stats = self._format_stats(self.dashboard.all_inbounds)
+        for node, inbound in remote_inbounds:
+            stats.update(self._format_stats([inbound], node))
         return stats
     
+    @classmethod
+    async def ainbound_stats(cls, username):
+        """
+            Stats of the username, answered in memory while the snapshot is
+            fresh and the bot serves only the local node.
+        """
+        if traffic_snapshot.ready and not fleet.remote:
+            return cls._format_stats(traffic_snapshot.of_username(username))
+        async with cls.aopen(username) as bot_user:
+            return await bot_user.aget_inbound_stats()
+    
     @property
     def connected_usernames(self):
         bot = (
@@ -98,78 +301,181 @@ class BotUsersBackend:
         )
         return [i.username for i in bot]
     
+    @property
+    def _bot_inbounds(self):
+        remote_inbounds = self.remote_inbounds
+        if traffic_snapshot.ready:
+            inbounds = traffic_snapshot.of_bot(self.dashboard.bot_id)
+        else:
+            inbounds = list(self.dashboard.inbounds)
+        return inbounds + [inbound for _, inbound in remote_inbounds]
+    
     @property
     def remaining_traffic(self):
-        if not self.bot:
+        if not self.dashboard.bot_id:
             return False
-        remainings = [i.total-(i.down+i.up) for i in self.bot.inbounds]
+        remainings = [i.total-(i.down+i.up) for i in self._bot_inbounds]
         return sum(remainings) if len(remainings) > 0 else 0
     
     @property
     def get_remaining_days(self):
-        if not self.bot:
+        if not self.dashboard.bot_id:
             return False
         remaining = {
             i.protocol: i.expires_in
-            for i in self.bot.inbounds
+            for i in self._bot_inbounds
         }
         return remaining
     
     @property
     def enabled_accounts(self):
-        if not self.bot:
+        if not self.dashboard.bot_id:
             return False
-        enabled = [i for i in self.bot.inbounds if i.enable]
+        enabled = [i for i in self._bot_inbounds if i.enable]
         return enabled if len(enabled) > 0 else None
     
     @classmethod
     def user_exists(cls, username):
-        Session = sessionmaker(bind=engine)()
-        return Session.query(TelegramUsers).filter_by(username=username)
+        with session_scope() as session:
+            return bool(session.query(TelegramUsers).filter_by(username=username).scalar())
     
     @classmethod
     def is_login_code_valid(cls, login_code):
-        Session = sessionmaker(bind=engine)()
-        return bool(Session.query(BotUsers).filter_by(login_code=login_code).scalar())
+        with session_scope() as session:
+            return bool(session.query(BotUsers).filter_by(login_code=login_code).scalar())
+    
+    @classmethod
+    def get_auth_state(cls, username):
+        """Returns (is_auth, bot_id) of the username, from auth_cache when possible."""
+        state = auth_cache.get(username)
+        if state is None:
+            state = cls._load_auth_state(username)
+        return state
+    
+    @classmethod
+    def _load_auth_state(cls, username):
+        with session_scope() as session:
+            user = session.query(TelegramUsers).filter_by(username=username).first()
+            state = (bool(user and user.is_auth), user.bot_id if user else None)
+        auth_cache.set(username, state)
+        return state
+    
+    @classmethod
+    def is_authenticated(cls, username):
+        return cls.get_auth_state(username)[0]
+    
+    # awaitable versions of the above, for use inside the telegram handlers.
+    # each call runs entirely on the db executor and gives the session's
+    # connection back to the pool before it returns, so no connection is
+    # held while a handler awaits something else.
+    @classmethod
+    @asynccontextmanager
+    async def aopen(cls, username):
+        # creating the session doesn't touch the database yet
+        backend = cls(username)
+        try:
+            yield backend
+        finally:
+            backend.close()
+    
+    async def _run_in_db(self, function, *args):
+        def call():
+            try:
+                return function(*args)
+            finally:
+                self.Session.close()
+        return await run_in_db(call)
+    
+    @classmethod
+    async def ais_authenticated(cls, username):
+        # a cache hit is answered without a trip to the executor
+        state = auth_cache.get(username)
+        if state is None:
+            state = await run_in_db(cls._load_auth_state, username)
+        return state[0]
+    
+    @classmethod
+    async def ais_login_code_valid(cls, login_code):
+        return await run_in_db(cls.is_login_code_valid, login_code)
+    
+    async def alog_in_from_code(self, login_code):
+        return await self._run_in_db(self.log_in_from_code, login_code)
+    
+    async def alog_user_out(self, username=None):
+        return await self._run_in_db(self.log_user_out, username)
+    
+    async def aget_connection_urls(self):
+        return await self._run_in_db(self.get_connection_urls)
+    
+    async def aget_inbound_stats(self):
+        return await self._run_in_db(self.get_inbound_stats)
         
     
 class InboundsBackend:
     def __init__(self, username):
-        self.Session = sessionmaker(bind=engine)()
-        self.inbounds = (
-            self
-            .Session
-            .query(Inbounds)
-            .join(GuestUsers)
-            .join(TelegramUsers)
-            .filter(
-                GuestUsers.username==username
-                or TelegramUsers.username==username
+        with session_scope() as session:
+            self.inbounds = (
+                session
+                .query(Inbounds)
+                .outerjoin(Inbounds.guest)
+                .outerjoin(Inbounds.bot_users)
+                .outerjoin(BotUsers.accounts)
+                .filter(or_(GuestUsers.username==username,
+                            TelegramUsers.username==username))
+                .distinct()
+                .all()
             )
-            .all()
-        )
         
     @classmethod
-    def create_inbound(cls,
+    def inbound_values(cls,
                        protocol,
                        remark,
+                       port,
                        quota=0,
-                       expires_in=0):
-        settings = {
-            "clients": [
-                {
-                    "id": str(uuid.uuid4()),
-                    "flow": "xtls-rprx-direct"
-                }
-            ],
-            "decryption": "none",
-            "fallbacks": []
-        }
+                       expires_in=0,
+                       host=None) -> dict:
+        """
+            Column values of a new inbound. quota is in GB and expires_in in
+            days, 0 meaning unlimited for both. host is the node's, URL by default.
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"unsupported protocol {protocol!r}, "
+                             f"expected one of {', '.join(PROTOCOLS)}")
+        if protocol == "vless":
+            settings = {
+                "clients": [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "flow": "xtls-rprx-direct"
+                    }
+                ],
+                "decryption": "none",
+                "fallbacks": []
+            }
+        elif protocol == "vmess":
+            settings = {
+                "clients": [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "alterId": 0
+                    }
+                ],
+                "disableInsecureEncryption": False
+            }
+        else:
+            settings = {
+                "clients": [
+                    {
+                        "password": uuid.uuid4().hex
+                    }
+                ],
+                "fallbacks": []
+            }
         stream_settings = {
             "network": "tcp",
             "security": "tls",
             "tlsSettings": {
-                "serverName": URL.split(":")[0],
+                "serverName": (host or URL).split(":")[0],
                 "certificates": [
                     {
                         "certificateFile": SSL_PUBLIC,
@@ -190,81 +496,214 @@ class InboundsBackend:
                 "tls"
             ]
         }
+        expiration = 0
         if expires_in != 0:
-            expiration = (datetime.now() + timedelta(days=expires_in)).timestamp()*1e3
-        if quota != 0:
-            quota *= 2**30
-        Session = sessionmaker(bind=engine)()
-        ports_in_use = [
-            i.port 
-            for i in Session.query(Inbounds).all()
-        ]
-        port = random.randint(1e4, 65353)
-        while port in ports_in_use:
-            port = random.randint(1e4, 65353)
-        inbound = Inbounds(
-            total=quota,
-            remark=remark,
-            enable=True,
-            expiry_time=expiration,
-            port=port,
-            protocol=protocol,
-            settings=settings,
-            stream_settings=stream_settings,
-            tag=f"inbound-{port}",
-            sniffing=sniffing
-        )
-        Session.add(inbound)
-        Session.commit()
-        subprocess.run(
-            shlex.split("systemctl restart x-ui"),
-            check=True
-        )
+            expiration = int((datetime.now() + timedelta(days=expires_in)).timestamp()*1e3)
+        return {
+            "total": quota * 2**30,
+            "remark": remark,
+            "enable": True,
+            "expiry_time": expiration,
+            "port": port,
+            "protocol": protocol,
+            "settings": json.dumps(settings),
+            "stream_settings": json.dumps(stream_settings),
+            "tag": f"inbound-{port}",
+            "sniffing": json.dumps(sniffing),
+        }
+    
+    @classmethod
+    def create_inbound(cls,
+                       protocol,
+                       remark,
+                       quota=0,
+                       expires_in=0,
+                       node=None):
+        """
+            Creates an inbound on node, the least loaded one by default (see
+            Fleet.place). The inbound's node attribute says which it went to.
+        """
+        node = node or fleet.place()[0]
+        port = node.ports.allocate()
+        try:
+            while True:
+                try:
+                    with session_scope(node.engine) as session:
+                        inbound = Inbounds(**cls.inbound_values(protocol,
+                                                                remark,
+                                                                port,
+                                                                quota,
+                                                                expires_in,
+                                                                host=node.host))
+                        session.add(inbound)
+                        session.flush()
+                        check_taken(session.connection(), [port])
+                    break
+                except PortTaken:
+                    # created elsewhere since, it stays out of the free ports
+                    port = node.ports.allocate()
+        except Exception:
+            node.ports.release(port)
+            raise
+        inbound.node = node
+        # x-ui only picks the inbound up after a restart. inbound.reload
+        # resolves once that happened.
+        inbound.reload = node.reloader.request()
         return inbound
     
+    @staticmethod
+    def _find_guest(session, username):
+        return (
+            session
+            .query(GuestUsers)
+            .options(joinedload(GuestUsers.inbound))
+            .filter_by(username=username)
+            .first()
+        )
+    
+    @classmethod
+    def _create_guest(cls, username):
+        """The slow path for an empty trial pool: a new inbound and an x-ui reload."""
+        # guest_users references the local inbounds table
+        inbound = cls.create_inbound("vless", f"{username}_test", TRIAL_QUOTA, TRIAL_DAYS,
+                                     node=fleet.local)
+        try:
+            with session_scope() as session:
+                session.add(GuestUsers(username=username, inbound_id=inbound.id))
+        except IntegrityError:
+            with session_scope() as session:
+                session.query(Inbounds).filter_by(id=inbound.id).delete()
+            port_allocator.release(inbound.port)
+            raise
+    
     @classmethod
     def guest_inbound(cls, username):
-        Session = sessionmaker(bind=engine)()
-        qs = (
-            Session
-            .query(Inbounds)
-            .join(GuestUsers)
-            .filter(GuestUsers.username==username)
-        )
-        if not qs.scalar():
-            inbound = cls.create_inbound("vless", f"{username}_test", 1, 30)
-            guest = GuestUsers(username=username, inbound_id=inbound.id)
-            Session.add(guest)
-            Session.commit()
+        """
+            Returns the guest, with its inbound loaded so it outlives the
+            session. Gives username a trial first if it has none; calling it
+            again, or concurrently, returns the same one.
+        """
+        with session_scope() as session:
+            guest = cls._find_guest(session, username)
+            if guest is None:
+                try:
+                    if not trial_pool.claim(username):
+                        cls._create_guest(username)
+                except IntegrityError:
+                    # another call issued the trial in the meantime
+                    pass
+                guest = cls._find_guest(session, username)
+            elif guest.updated <= datetime.now() - rel_delta(months=1):
+                guest.updated = datetime.now()
             return guest
-        elif (
-            rel_delta(seconds=(datetime.now() - qs.first().guest.updated).total_seconds())
-            >= rel_delta(months=1)
-        ):
-            Session.query(GuestUsers).filter_by(
-                username=username).update({"updated": datetime.now()},
-                                          synchronize_session=False)
-            Session.commit()
-        guest = Session.query(GuestUsers).filter_by(username=username).first()
-        return guest
+    
+    @classmethod
+    def guest_login_url(cls, username):
+        return cls.guest_inbound(username).inbound.get_login_url()
+    
+    @classmethod
+    async def aguest_login_url(cls, username):
+        # repeated taps of the same guest wait for the first one's trial
+        lock = guest_locks.setdefault(username, asyncio.Lock())
+        async with lock:
+            return await run_in_db(cls.guest_login_url, username)
+
+
+# filled by trial_pool.run(), started next to the bot; without it guests
+# get a newly created inbound
+trial_pool = TrialPool(port_allocator,
+                       xui_reloader,
+                       InboundsBackend.inbound_values,
+                       size=TRIAL_POOL_SIZE,
+                       quota=TRIAL_QUOTA,
+                       days=TRIAL_DAYS)
+# username -> lock of its trial issuance, dropped once nobody holds it
+guest_locks = weakref.WeakValueDictionary()
+    
+    
+# created on first use, so importing backends doesn't touch the sessions dir
+session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global session_store
+    if session_store is None:
+        # db_executor's threads may get here at once, only one builds the store
+        with _session_store_lock:
+            if session_store is None:
+                if BOT_SESSIONS_STORE == "pickle":
+                    session_store = PickleFileStore(BOT_SESSIONS_PATH)
+                else:
+                    session_store = SQLiteSessionStore(BOT_SESSIONS_DB, 
+                                                       BOT_SESSIONS_FLUSH_INTERVAL)
+    return session_store
+    
+    
+# username -> the last chat id written to its session, to skip rewriting
+# it, for the most recently active users
+_known_chat_ids = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=float("inf"))
+
+
+def remember_chat_id(username, chat_id):
+    """Keeps the chat id of the user in its session, so we can message it later."""
+    if _known_chat_ids.get(username) == chat_id:
+        return
+    session = UserSession(username)
+    if session.get("chat_id") != chat_id:
+        session["chat_id"] = chat_id
+    _known_chat_ids.set(username, chat_id)
+    
+    
+async def aremember_chat_id(username, chat_id):
+    if _known_chat_ids.get(username) != chat_id:
+        await run_in_db(remember_chat_id, username, chat_id)
+    
+    
+def chat_id_of(username):
+    return _known_chat_ids.get(username) or UserSession(username).get("chat_id")
+
+
+def warm_caches(qr_limit=200):
+    """
+        Loads the login state of every telegram user into auth_cache and
+        renders the qr codes of up to qr_limit logged in users' inbounds.
+        Meant to run in the background once the bot is up.
+    """
+    with engine.connect() as conn:
+        users = conn.execute(
+            select(TelegramUsers.username, TelegramUsers.is_auth, TelegramUsers.bot_id)
+            .limit(AUTH_CACHE_SIZE)
+        ).all()
+        inbounds = conn.execute(
+            select(*INBOUND_COLUMNS)
+            .join(UsersInboundsRelation, UsersInboundsRelation.inbound_id==Inbounds.id)
+            .join(TelegramUsers, TelegramUsers.bot_id==UsersInboundsRelation.bot_id)
+            .where(TelegramUsers.is_auth==True)
+            .distinct()
+            .limit(qr_limit)
+        ).all()
+    for username, is_auth, bot_id in users:
+        # a login since the query above already cached the newer state
+        auth_cache.set_if_missing(username, (bool(is_auth), bot_id))
+    urls = InboundView.get_login_urls([InboundView(*row) for row in inbounds])
+    for url in urls.values():
+        qr_cache.png(url)
+    return len(users), len(urls)
     
     
 class UserSession(dict):    
-    def __init__(self, username):
+    def __init__(self, username, store=None):
         self.username = username
-        self.session_path = BOT_SESSIONS_PATH.joinpath(f"{self.username}.pickle")
+        self.store = store or get_session_store()
         self._load_session()
     
     def _load_session(self):
-        try:
-            with open(self.session_path, "rb") as f:
-                self.update(pickle.load(f))
-        except FileNotFoundError:
-            pass
+        super().update(self.store.load(self.username))
         
     def _save(self):
-        with open(self.session_path, "wb") as f:
-            pickle.dump(self, f)
+        # buffered by the store, see session_stores.SQLiteSessionStore
+        self.store.save(self.username, self)
             
     def __setitem__(self, key, value):
         super().__setitem__(key, value)
@@ -276,10 +715,9 @@ class UserSession(dict):
     
     def clear(self):
         super().clear()
-        self._save()
+        self.store.delete(self.username)
     
     def pop(self, key, default=None):
         val = super().pop(key, default)
         self._save()
         return val
-    
\ No newline at end of file
@@ -0,0 +1,1042 @@
+"""
+    Offline benchmarks for the bot. They run against a throwaway sqlite
+    file shaped like the x-ui database, so no telegram token or live x-ui
+    install is needed.
+
+    usage: python benchmarks.py <benchmark> [options]
+"""
+
+import os, sys, json, time, uuid, socket, random, asyncio, argparse, tempfile, statistics
+from collections import deque
+from itertools import islice
+
+# models binds its engine at import time, so the fixture db has to be
+# configured before anything from this project is imported
+_fixture_dir = tempfile.mkdtemp(prefix="xui-bench-")
+os.environ.setdefault("XUI_DB_PATH", os.path.join(_fixture_dir, "x-ui.db"))
+os.environ.setdefault("XUI_URL", "bench.example.com:443")
+# and the sessions the handlers write go there too, not to the working directory
+os.environ.setdefault("BOT_SESSIONS_PATH", os.path.join(_fixture_dir, "sessions"))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def report(name, samples, elapsed=None):
+    line = (
+        f"{name:<28} n={len(samples):<7} "
+        f"p50={percentile(samples, 50)*1e3:8.2f}ms "
+        f"p99={percentile(samples, 99)*1e3:8.2f}ms "
+        f"mean={statistics.fmean(samples)*1e3:8.2f}ms"
+    )
+    if elapsed:
+        line += f" rate={len(samples)/elapsed:9.1f}/s"
+    print(line)
+
+
+def build_fixture(users=500, inbounds_per_user=2, guests=100, telegram_per_bot=1,
+                  spare_inbounds=0):
+    """
+        Fills the fixture db with bot users, their telegram accounts and
+        inbounds, guests with one inbound each and inbounds nobody owns.
+        Returns the usernames of the telegram accounts.
+    """
+    from models import (engine,
+                        Base,
+                        Inbounds,
+                        BotUsers,
+                        TelegramUsers,
+                        GuestUsers,
+                        UsersInboundsRelation)
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    now = time.time()
+    inbounds, bot_users, tel_users, relations, guest_users = [], [], [], [], []
+    port = 10000
+    for _ in range(spare_inbounds):
+        port += 1
+        inbounds.append({
+            "id": len(inbounds) + 1,
+            "up": 0,
+            "down": 0,
+            "total": 2**34,
+            "remark": f"spare_{port}",
+            "enable": True,
+            "expiry_time": 0,
+            "port": port,
+            "protocol": "vless",
+            "settings": json.dumps({"clients": [{"id": str(uuid.uuid4())}]}),
+            "stream_settings": json.dumps({"network": "tcp", "security": "tls"}),
+            "tag": f"inbound-{port}",
+            "sniffing": json.dumps({"enabled": True}),
+        })
+    for user_id in range(1, users+guests+1):
+        for _ in range(1 if user_id > users else inbounds_per_user):
+            port += 1
+            settings = {"clients": [{"id": str(uuid.uuid4()),
+                                     "flow": "xtls-rprx-direct"}],
+                        "decryption": "none",
+                        "fallbacks": []}
+            inbounds.append({
+                "id": len(inbounds) + 1,
+                "up": random.randint(0, 2**30),
+                "down": random.randint(0, 2**31),
+                "total": 2**34,
+                "remark": f"user{user_id}_{port}",
+                "enable": True,
+                "expiry_time": int((now + random.randint(-5, 60)*86400)*1e3),
+                "port": port,
+                "protocol": random.choice(["vless", "vmess"]),
+                "settings": json.dumps(settings),
+                "stream_settings": json.dumps({"network": "tcp", "security": "tls"}),
+                "tag": f"inbound-{port}",
+                "sniffing": json.dumps({"enabled": True}),
+            })
+            if user_id <= users:
+                relations.append({"bot_id": user_id, "inbound_id": len(inbounds)})
+            else:
+                guest_users.append({"username": f"guest{user_id}",
+                                    "inbound_id": len(inbounds)})
+        if user_id <= users:
+            bot_users.append({"id": user_id, "login_code": f"code{user_id}"})
+            for k in range(telegram_per_bot):
+                tel_users.append({"username": f"user{user_id}" + (f"_{k}" if k else ""),
+                                  "bot_id": user_id,
+                                  "is_auth": True})
+    with engine.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(), inbounds)
+        conn.execute(BotUsers.__table__.insert(), bot_users)
+        conn.execute(TelegramUsers.__table__.insert(), tel_users)
+        conn.execute(UsersInboundsRelation.__table__.insert(), relations)
+        if guest_users:
+            conn.execute(GuestUsers.__table__.insert(), guest_users)
+    return [u["username"] for u in tel_users]
+
+
+def node_paths(nodes):
+    """
+        Databases of the other x-ui nodes next to the fixture db, as XUI_NODES
+        entries. It has to be set before anything from this project is imported.
+    """
+    directory = os.path.dirname(os.environ["XUI_DB_PATH"])
+    return ",".join(f"node{k}={os.path.join(directory, f'node{k}.db')}@node{k}.example.com:443"
+                    for k in range(1, nodes))
+
+
+def build_fleet_fixture(users=500, inbounds_per_user=2, guests=100, spare_inbounds=0):
+    """
+        build_fixture() for the local node, and inbounds_per_user inbounds
+        of every bot user on each node of XUI_NODES. Returns the usernames
+        of the telegram accounts.
+    """
+    usernames = build_fixture(users=users,
+                              inbounds_per_user=inbounds_per_user,
+                              guests=guests,
+                              spare_inbounds=spare_inbounds)
+    from models import engine, create_xui_engine, Inbounds, NodeInboundsRelation
+    from configs import XUI_NODES
+
+    relations = []
+    for name, path, host in XUI_NODES:
+        node_engine = create_xui_engine(path)
+        Inbounds.__table__.drop(node_engine, checkfirst=True)
+        Inbounds.__table__.create(node_engine)
+        inbounds = []
+        for bot_id in range(1, users+1):
+            for _ in range(inbounds_per_user):
+                port = 10001 + len(inbounds)
+                inbounds.append({
+                    "id": len(inbounds) + 1,
+                    "up": random.randint(0, 2**30),
+                    "down": random.randint(0, 2**31),
+                    "total": 2**34,
+                    "remark": f"user{bot_id}_{port}",
+                    "enable": True,
+                    "expiry_time": int((time.time() + random.randint(-5, 60)*86400)*1e3),
+                    "port": port,
+                    "protocol": random.choice(["vless", "vmess"]),
+                    "settings": json.dumps({"clients": [{"id": str(uuid.uuid4())}]}),
+                    "stream_settings": json.dumps({"network": "tcp", "security": "tls"}),
+                    "tag": f"inbound-{port}",
+                    "sniffing": json.dumps({"enabled": True}),
+                })
+                relations.append({"node": name, "bot_id": bot_id, "inbound_id": len(inbounds)})
+        with node_engine.begin() as conn:
+            conn.execute(Inbounds.__table__.insert(), inbounds)
+        node_engine.dispose()
+    if relations:
+        with engine.begin() as conn:
+            conn.execute(NodeInboundsRelation.__table__.insert(), relations)
+    return usernames
+
+
+class FakeMessage:
+    """Stands in for telegram.Message, records replies instead of sending them."""
+    def __init__(self, text):
+        self.text = text
+        self.replies = 0
+
+    async def reply_text(self, *args, **kwargs):
+        self.replies += 1
+
+    reply_photo = reply_document = reply_chat_action = reply_media_group = reply_text
+
+
+class FakeUser:
+    def __init__(self, username):
+        self.id = abs(hash(username)) % 10**9
+        self.username = username
+        self.name = f"@{username}"
+
+
+class FakeChat:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeUpdate:
+    def __init__(self, username, text):
+        self.effective_user = FakeUser(username)
+        self.effective_chat = FakeChat(self.effective_user.id)
+        self.message = FakeMessage(text)
+
+
+class StubBot:
+    """Stands in for telegram.Bot, counts the api calls made through it."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+
+    async def _call(self, method, *args, **kwargs):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return FakeMessage(None)
+
+    async def send_message(self, *args, **kwargs):
+        return await self._call("send_message", *args, **kwargs)
+
+    async def send_photo(self, *args, **kwargs):
+        return await self._call("send_photo", *args, **kwargs)
+
+    async def send_document(self, *args, **kwargs):
+        return await self._call("send_document", *args, **kwargs)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._call("send_media_group", chat_id, media, **kwargs)
+        return [FakeMessage(None) for _ in media]
+
+
+def stub_request(latency=0.0):
+    """
+        A telegram.request.BaseRequest answering every bot api call locally,
+        so a real Application can run without a token or network.
+    """
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        def __init__(self):
+            self.latency = latency
+            self.calls = {}
+            # update json handed out by getUpdates
+            self.updates = deque()
+            self._message_id = 0
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, chat_id, **fields):
+            self._message_id += 1
+            return {"message_id": self._message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": int(chat_id), "type": "private"},
+                    **fields}
+
+        def _photo(self, chat_id):
+            file_id = f"photo{self._message_id+1}"
+            return self._message(chat_id, photo=[{"file_id": file_id,
+                                                  "file_unique_id": file_id,
+                                                  "width": 410,
+                                                  "height": 410}])
+
+        def _result(self, api_method, parameters):
+            chat_id = parameters.get("chat_id", 0)
+            if api_method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            if api_method == "sendMessage":
+                return self._message(chat_id, text=parameters.get("text", ""))
+            if api_method == "sendPhoto":
+                return self._photo(chat_id)
+            if api_method == "sendDocument":
+                return self._message(chat_id, document={"file_id": "document",
+                                                        "file_unique_id": "document"})
+            if api_method == "sendMediaGroup":
+                media = parameters.get("media", [])
+                if isinstance(media, str):
+                    media = json.loads(media)
+                return [self._photo(chat_id) for _ in media]
+            if api_method == "getUpdates":
+                offset = int(parameters.get("offset") or 0)
+                while self.updates and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+                return list(islice(self.updates, int(parameters.get("limit") or 100)))
+            return True
+
+        async def do_request(self, url, method, request_data=None, *args, **kwargs):
+            api_method = url.rsplit("/", 1)[-1]
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            parameters = request_data.parameters if request_data is not None else {}
+            result = self._result(api_method, parameters)
+            if api_method == "getUpdates" and not result:
+                # stands in for the long poll waiting on new updates
+                await asyncio.sleep(0.01)
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return StubRequest()
+
+
+def text_update(update_id, username, text):
+    """The json of a private text message from username, as telegram sends it."""
+    user_id = abs(hash(username)) % 10**9
+    message = {"message_id": update_id,
+               "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id,
+                        "is_bot": False,
+                        "first_name": username,
+                        "username": username},
+               "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command",
+                                "offset": 0,
+                                "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+# most sql statements a handler may run, checked by --check
+HANDLER_SQL_BUDGETS = {
+    "auth": 1,
+    "pro_dash": 1,
+}
+
+
+async def _simulate_user(handlers, username, rounds, samples, statements):
+    from models import count_statements
+
+    for _ in range(rounds):
+        for handler, text in handlers:
+            started = time.perf_counter()
+            with count_statements() as counter:
+                await handler(FakeUpdate(username, text), None)
+            samples.setdefault(handler.__name__, []).append(time.perf_counter()-started)
+            statements.setdefault(handler.__name__, []).append(counter.count)
+
+
+def bench_handlers(args):
+    """p50/p99 latency of the handlers under many concurrent users."""
+    usernames = build_fixture(users=args.users)
+    from clients import auth, pro_dash, outbound, PRO_RULES
+    handlers = [(auth, PRO_RULES[0]), (pro_dash, PRO_RULES[0])]
+    samples, statements = {}, {}
+    bot = StubBot()
+
+    async def main():
+        # the stub answers instantly, don't hold the handlers to telegram's limits
+        outbound.global_bucket.rate = outbound.global_bucket.capacity = 1e9
+        outbound.chat_rate = outbound.chat_burst = 1e9
+        outbound.start(bot)
+        await asyncio.gather(*[
+            _simulate_user(handlers, username, args.rounds, samples, statements)
+            for username in usernames[:args.concurrency]
+        ])
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    print(f"{args.concurrency} concurrent users x {args.rounds} rounds")
+    for name, values in samples.items():
+        report(name, values)
+        counts = statements[name]
+        print(f"{'':<28} sql/update mean={statistics.fmean(counts):.2f} max={max(counts)}")
+        if args.check:
+            budget = HANDLER_SQL_BUDGETS.get(name)
+            assert budget is None or max(counts) <= budget, (
+                f"{name} ran {max(counts)} sql statements, the budget is {budget}")
+    report("all handlers", sum(samples.values(), []), elapsed)
+
+    from models import pool_metrics
+    from backends import auth_cache
+    print("pool:", pool_metrics.snapshot())
+    print("auth cache:", auth_cache.stats)
+    print("bot calls:", bot.calls)
+
+
+# most sql statements one update of a conversation may run, checked by --check
+CONVERSATION_SQL_BUDGETS = {
+    "/start": 1,
+    "stats": 1,
+    "accounts": 1,
+}
+
+
+def bench_conversation(args):
+    """updates/s, latency and sql per update through clients' ConversationHandler."""
+    usernames = build_fixture(users=args.users,
+                              inbounds_per_user=args.inbounds_per_user,
+                              guests=args.guests,
+                              telegram_per_bot=args.telegram_per_bot,
+                              spare_inbounds=args.spare_inbounds)
+    guests = [f"guest{i}" for i in range(args.users+1, args.users+args.guests+1)]
+    from telegram import Update
+    from clients import build_application, outbound, PRO_RULES, GUEST_RULES
+    from persistence import SQLitePersistence
+    from models import count_statements
+
+    # (label, text) sent one after another by every simulated user
+    pro_script = [("/start", "/start"),
+                  ("stats", PRO_RULES[0]),
+                  ("accounts", PRO_RULES[1])]
+    guest_script = [("/start", "/start"),
+                    ("guest offer", GUEST_RULES[2])]
+    request = stub_request(args.latency)
+    samples, statements = {}, {}
+    update_ids = iter(range(1, 10**9))
+
+    async def on_init(application):
+        # the stub answers instantly, don't hold the handlers to telegram's limits
+        outbound.global_bucket.rate = outbound.global_bucket.capacity = 1e9
+        outbound.chat_rate = outbound.chat_burst = 1e9
+        outbound.start(application.bot)
+
+    async def simulate(application, username, script):
+        for _ in range(args.rounds):
+            for label, text in script:
+                update = Update.de_json(text_update(next(update_ids), username, text),
+                                        application.bot)
+                started = time.perf_counter()
+                with count_statements() as counter:
+                    await application.process_update(update)
+                samples.setdefault(label, []).append(time.perf_counter()-started)
+                statements.setdefault(label, []).append(counter.count)
+
+    async def main():
+        persistence_path = os.path.join(tempfile.mkdtemp(prefix="xui-bench-conv-"),
+                                        "persistence.db")
+        application = build_application(token="123456:bench",
+                                        persistence=SQLitePersistence(persistence_path),
+                                        request=request,
+                                        get_updates_request=stub_request(),
+                                        on_init=on_init)
+        async with application:
+            await on_init(application)
+            users = [(u, pro_script) for u in usernames[:args.concurrency]]
+            users += [(g, guest_script) for g in guests[:max(0, args.concurrency-len(users))]]
+            started = time.perf_counter()
+            await asyncio.gather(*[simulate(application, u, script) for u, script in users])
+            return time.perf_counter() - started
+
+    elapsed = asyncio.run(main())
+    print(f"{args.concurrency} concurrent users x {args.rounds} rounds, "
+          f"bot api latency {args.latency*1e3:.0f}ms")
+    failures = []
+    for label, values in samples.items():
+        report(label, values)
+        counts = statements[label]
+        print(f"{'':<28} sql/update mean={statistics.fmean(counts):.2f} max={max(counts)}")
+        budget = CONVERSATION_SQL_BUDGETS.get(label)
+        if args.check and budget is not None and max(counts) > budget:
+            failures.append(f"{label} ran {max(counts)} sql statements, the budget is {budget}")
+    all_samples = sum(samples.values(), [])
+    report("all updates", all_samples, elapsed)
+    print("bot api calls:", request.calls)
+    if args.check and args.max_p99 and percentile(all_samples, 99)*1e3 > args.max_p99:
+        failures.append(f"p99 {percentile(all_samples, 99)*1e3:.2f}ms is over {args.max_p99}ms")
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+async def _post_updates(port, path, updates):
+    """A stand-in for telegram's side of a webhook: posts updates over one connection."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for update in updates:
+            body = json.dumps(update).encode()
+            writer.write(
+                f"POST /{path} HTTP/1.1\r\n"
+                "Host: 127.0.0.1\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status = await reader.readline()
+            assert b" 200 " in status, status
+            length = 0
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+def bench_webhook(args):
+    """updates/s of the conversation when updates come by polling vs by webhook."""
+    usernames = build_fixture(users=args.users)[:args.concurrency]
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from clients import build_application, outbound, PRO_RULES
+    from persistence import SQLitePersistence
+
+    script = ["/start", PRO_RULES[0]]
+    update_ids = iter(range(1, 10**9))
+    # every user's updates in order, the users interleaved
+    updates = [text_update(next(update_ids), username, text)
+               for _ in range(args.rounds)
+               for text in script
+               for username in usernames]
+
+    async def run(mode, workers):
+        request, updates_request = stub_request(args.latency), stub_request()
+        processed, done = [0], asyncio.Event()
+
+        async def on_init(application):
+            outbound.global_bucket.rate = outbound.global_bucket.capacity = 1e9
+            outbound.chat_rate = outbound.chat_burst = 1e9
+            outbound.start(application.bot)
+
+        async def count(update, context):
+            processed[0] += 1
+            if processed[0] == len(updates):
+                done.set()
+
+        persistence_path = os.path.join(tempfile.mkdtemp(prefix="xui-bench-webhook-"),
+                                        "persistence.db")
+        application = build_application(token="123456:bench",
+                                        persistence=SQLitePersistence(persistence_path),
+                                        request=request,
+                                        get_updates_request=updates_request,
+                                        on_init=on_init,
+                                        workers=workers)
+        # group 1 runs once the conversation in group 0 handled the update
+        application.add_handler(TypeHandler(Update, count), group=1)
+        async with application:
+            await on_init(application)
+            await application.start()
+            started = time.perf_counter()
+            if mode == "polling":
+                updates_request.updates.extend(updates)
+                await application.updater.start_polling(poll_interval=0)
+            else:
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", 0))
+                    port = s.getsockname()[1]
+                await application.updater.start_webhook(
+                    listen="127.0.0.1",
+                    port=port,
+                    url_path="bench",
+                    webhook_url=f"https://127.0.0.1:{port}/bench"
+                )
+                # a user's updates share a connection, so they arrive in order
+                connections = [[] for _ in range(min(args.connections, len(usernames)))]
+                for update in updates:
+                    user_id = update["message"]["from"]["id"]
+                    connections[user_id % len(connections)].append(update)
+                await asyncio.gather(*[_post_updates(port, "bench", c) for c in connections])
+            await done.wait()
+            elapsed = time.perf_counter() - started
+            await application.updater.stop()
+            await application.stop()
+            await outbound.stop()
+        print(f"{mode:<8} workers={workers:<4} updates={len(updates):<7} "
+              f"took={elapsed:7.2f}s rate={len(updates)/elapsed:9.1f}/s")
+
+    async def main():
+        for mode in ("polling", "webhook"):
+            for workers in (1, args.workers):
+                await run(mode, workers)
+
+    print(f"{len(usernames)} users x {args.rounds} rounds, "
+          f"bot api latency {args.latency*1e3:.0f}ms")
+    asyncio.run(main())
+
+
+def bench_startup(args):
+    """import time of the bot, with -X importtime's slowest modules, and the schema check."""
+    import subprocess
+
+    code = ("import sys, time; started = time.perf_counter(); import clients; "
+            "print(time.perf_counter()-started, "
+            "' '.join(m for m in ('qrcode', 'PIL') if m in sys.modules) or '-')")
+    times, importtime = [], ""
+    for _ in range(args.rounds):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 capture_output=True,
+                                 text=True,
+                                 check=True)
+        elapsed, loaded = process.stdout.split(maxsplit=1)
+        times.append(float(elapsed))
+        importtime = process.stderr
+    report("import clients", times)
+    print(f"{'':<28} imaging modules loaded at import: {loaded.strip()}")
+    # "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), int(own), name.rstrip()))
+    print("slowest imports (cumulative, self):")
+    for cumulative, own, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"  {cumulative/1e3:9.2f}ms {own/1e3:9.2f}ms {name}")
+
+    build_fixture(users=10, guests=0)
+    from models import verify_schema
+    cache_path = os.path.join(tempfile.mkdtemp(prefix="xui-bench-schema-"), "schema")
+    for run in ("schema check", "cached schema check"):
+        started = time.perf_counter()
+        verify_schema(cache_path)
+        print(f"{run:<28} took={(time.perf_counter()-started)*1e3:.2f}ms")
+
+
+def bench_broadcast(args):
+    """a broadcast to every fixture user and guest through the sender and a stub bot."""
+    build_fixture(users=args.users, guests=args.guests)
+    from admins import Broadcaster, BroadcastStore, print_report
+    from senders import OutboundSender
+
+    async def main():
+        bot = StubBot(latency=args.latency)
+        # the stub has no limits of its own, the broadcast's rate still applies
+        sender = OutboundSender(global_rate=1e9, chat_rate=1e9, chat_burst=10**9)
+        sender.start(bot)
+        store = BroadcastStore(os.path.join(tempfile.mkdtemp(prefix="xui-bench-broadcast-"),
+                                            "broadcasts.db"))
+        broadcaster = Broadcaster(sender,
+                                  lambda username: abs(hash(username)) % 10**9,
+                                  store=store,
+                                  rate=args.rate)
+        report = await broadcaster.run(store.create("bench"))
+        await sender.stop()
+        print_report(report)
+        print("bot calls:", bot.calls)
+
+    asyncio.run(main())
+
+
+def bench_qr(args):
+    """qr code rendering vs memory cache vs disk cache vs file_id reuse."""
+    from caches import QRCache
+    from utils import render_qr
+
+    urls = [f"vless://{uuid.uuid4()}@bench.example.com:443?security=tls#user{i}"
+            for i in range(args.rounds*20)]
+    cache = QRCache(render_qr, directory=tempfile.mkdtemp(prefix="xui-bench-qr-"))
+
+    def measure(name, function):
+        samples = []
+        for url in urls:
+            started = time.perf_counter()
+            function(url)
+            samples.append(time.perf_counter()-started)
+        report(name, samples)
+
+    measure("render", render_qr)
+    measure("render + cache fill", cache.png)
+    measure("memory hit", cache.png)
+    cache._data.clear()
+    cache.size = 0
+    measure("disk hit", cache.png)
+    for url in urls:
+        cache.set_file_id(url, f"file-{url}")
+    measure("file_id reuse", cache.file_id)
+    print("qr cache:", cache.stats)
+
+
+def bench_ports(args):
+    """free port allocation with 50k existing inbounds, old scan vs PortAllocator."""
+    import random
+    from models import engine, Base, Inbounds, Session
+    from ports import PortAllocator
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    ports = random.sample(range(10000, 65354), args.inbounds)
+    with engine.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(), [
+            {"port": port, "remark": f"bench{port}", "settings": "{}",
+             "stream_settings": "{}", "sniffing": "{}", "protocol": "vless"}
+            for port in ports
+        ])
+    print(f"{args.inbounds} existing inbounds")
+
+    def scan():
+        session = Session()
+        ports_in_use = [i.port for i in session.query(Inbounds).all()]
+        session.close()
+        port = random.randint(10000, 65353)
+        while port in ports_in_use:
+            port = random.randint(10000, 65353)
+        return port
+
+    allocator = PortAllocator()
+    started = time.perf_counter()
+    allocator.load()
+    print(f"allocator load: {(time.perf_counter()-started)*1e3:.2f}ms")
+    for name, function, rounds in [("scan all rows", scan, args.rounds),
+                                   ("allocator", allocator.allocate, 1000)]:
+        samples = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            function()
+            samples.append(time.perf_counter()-started)
+        report(name, samples)
+
+
+def bench_persistence(args):
+    """flush and startup time of PicklePersistence vs SQLitePersistence."""
+    from telegram.ext import PicklePersistence
+    from persistence import SQLitePersistence
+
+    directory = tempfile.mkdtemp(prefix="xui-bench-persistence-")
+    states = [chr(i) for i in range(4)]
+
+    async def timed(coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        return time.perf_counter()-started, result
+
+    async def run(name, make, users):
+        persistence = make()
+        for user_id in range(users):
+            await persistence.update_conversation("bench", (user_id, user_id),
+                                                  random.choice(states))
+        await persistence.flush()
+        # a busy interval: 1% of the users move to another state
+        for user_id in random.sample(range(users), max(1, users//100)):
+            await persistence.update_conversation("bench", (user_id, user_id),
+                                                  random.choice(states))
+        flush_time, _ = await timed(persistence.flush())
+        load_time, conversations = await timed(make().get_conversations("bench"))
+        assert len(conversations) == users
+        print(f"{name:<20} users={users:<7} flush={flush_time*1e3:9.2f}ms "
+              f"startup load={load_time*1e3:9.2f}ms")
+
+    async def main():
+        for users in (10000, 100000):
+            path = os.path.join(directory, f"pickle-{users}")
+            await run("PicklePersistence",
+                      lambda: PicklePersistence(path, on_flush=True),
+                      users)
+            path_db = os.path.join(directory, f"sqlite-{users}.db")
+            await run("SQLitePersistence",
+                      lambda: SQLitePersistence(path_db, batch_size=10**9),
+                      users)
+
+    asyncio.run(main())
+
+
+def bench_enforcement(args):
+    """one disable_exhausted() pass over a large inbounds table."""
+    from models import engine, Base, Inbounds
+    from enforcement import disable_exhausted
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    now = time.time()
+    rows = []
+    for i in range(args.inbounds):
+        # about 1% over quota and 1% expired
+        exhausted = i % 100 == 0
+        expired = i % 100 == 1
+        rows.append({
+            "port": 10000 + i % 55000,
+            "remark": f"bench{i}",
+            "protocol": "vless",
+            "up": 2**30 if exhausted else 0,
+            "down": 0,
+            "total": 2**30,
+            "expiry_time": int((now - 86400 if expired else now + 86400)*1e3),
+            "enable": True,
+            "settings": "{}",
+            "stream_settings": "{}",
+            "sniffing": "{}",
+        })
+    with engine.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(), rows)
+    for run in ("first run", "nothing to do"):
+        started = time.perf_counter()
+        disabled = disable_exhausted(now)
+        print(f"{run:<16} inbounds={args.inbounds} disabled={len(disabled)} "
+              f"took={(time.perf_counter()-started)*1e3:.2f}ms")
+
+
+def bench_timeseries(args):
+    """
+        a month of traffic history for --history-inbounds inbounds, saved after
+        every sample like the bot does: sampling, saving, queries and load.
+    """
+    from timeseries import TrafficHistory
+
+    path = os.path.join(tempfile.mkdtemp(prefix="xui-bench-history-"), "history.db")
+    history = TrafficHistory(interval=0)
+    history.open(path)
+    interval = 300
+    start = time.time() - 31*86400
+    samples = 31*86400 // interval
+    inbounds = args.history_inbounds
+    # about a tenth of the inbounds move between two samples
+    counters = {i: 0 for i in range(inbounds)}
+    record_times, save_times = [], []
+    for k in range(samples):
+        for i in random.sample(range(inbounds), max(1, inbounds//10)):
+            counters[i] += random.randrange(2**20)
+        started = time.perf_counter()
+        history.record([(i, c, c) for i, c in counters.items()], start + k*interval)
+        record_times.append(time.perf_counter()-started)
+        started = time.perf_counter()
+        history.save()
+        save_times.append(time.perf_counter()-started)
+    report("record (all inbounds)", record_times)
+    report("save after a sample", save_times)
+    now = start + samples*interval
+    ids = random.sample(range(inbounds), min(inbounds, 1000))
+    for name, query in (("range last day", lambda i: history.range(i, now-86400, now)),
+                        ("range last month", lambda i: history.range(i, now-31*86400, now)),
+                        ("usage_rate", lambda i: history.usage_rate(i, now=now))):
+        times = []
+        for i in ids:
+            started = time.perf_counter()
+            query(i)
+            times.append(time.perf_counter()-started)
+        report(name, times)
+    started = time.perf_counter()
+    loaded = TrafficHistory()
+    loaded.open(path)
+    load_time = time.perf_counter()-started
+    assert all(loaded.range(i, start, now) == history.range(i, start, now) for i in ids)
+    print(f"load={load_time*1e3:.2f}ms file={os.path.getsize(path)/2**20:.1f}MiB "
+          f"compactions={history.compactions}")
+
+
+def bench_aggregates(args):
+    """
+        the admin rollups over an --inbounds sized fixture: rebuild, an update
+        after a refresh and the queries, against reading every inbound.
+    """
+    owned = args.users*args.inbounds_per_user + args.guests
+    build_fixture(users=args.users,
+                  inbounds_per_user=args.inbounds_per_user,
+                  guests=args.guests,
+                  spare_inbounds=max(0, args.inbounds - owned))
+    from sqlalchemy import text
+    from models import engine, session_scope, Inbounds, BotUsers
+    from snapshots import TrafficSnapshot
+    from aggregates import Aggregates
+
+    snapshot = TrafficSnapshot()
+    started = time.perf_counter()
+    snapshot.refresh()
+    refresh_time = time.perf_counter()-started
+    aggregates = Aggregates().open(os.path.join(tempfile.mkdtemp(prefix="xui-bench-aggregates-"),
+                                                "aggregates.db"))
+    started = time.perf_counter()
+    aggregates.rebuild(snapshot)
+    print(f"inbounds={len(snapshot.inbounds)} refresh={refresh_time*1e3:.2f}ms "
+          f"rebuild={(time.perf_counter()-started)*1e3:.2f}ms")
+
+    # about a tenth of the inbounds move between two refreshes
+    ids = list(snapshot.inbounds)
+    update_times = []
+    for _ in range(args.rounds):
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE inbounds SET down=down+:used WHERE id=:id"),
+                         [{"id": i, "used": random.randrange(2**20)}
+                          for i in random.sample(ids, max(1, len(ids)//10))])
+        snapshot.refresh()
+        started = time.perf_counter()
+        aggregates.update(snapshot)
+        update_times.append(time.perf_counter()-started)
+    report("update (a tenth changed)", update_times)
+
+    for name, query in (("totals", aggregates.totals),
+                        ("top_consumers", lambda: aggregates.top_consumers(10)),
+                        ("expiring", aggregates.expiring),
+                        ("expiring_accounts", aggregates.expiring_accounts),
+                        ("trial_conversion", aggregates.trial_conversion),
+                        ("daily_usage", aggregates.daily_usage)):
+        times = []
+        for _ in range(100):
+            started = time.perf_counter()
+            query()
+            times.append(time.perf_counter()-started)
+        report(name, times)
+
+    def orm_totals():
+        with session_scope() as session:
+            return sum(i.up + i.down for i in session.query(Inbounds))
+
+    def orm_top_consumers():
+        with session_scope() as session:
+            return sorted(((sum(i.up + i.down for i in bot.inbounds), bot.id)
+                           for bot in session.query(BotUsers)), reverse=True)[:10]
+
+    for name, query in (("orm totals", orm_totals), ("orm top_consumers", orm_top_consumers)):
+        times = []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            query()
+            times.append(time.perf_counter()-started)
+        report(name, times)
+
+    with engine.connect() as conn:
+        used = conn.execute(text("SELECT total(up+down) FROM inbounds")).scalar()
+    counted = aggregates.totals()["all"]["used"]
+    print(f"fleet traffic: counted={counted} in the database={int(used)}")
+    if args.check and counted != used:
+        sys.exit("the rollups don't match the inbounds")
+
+
+def bench_fleet(args):
+    """
+        per-user reads fanned out over --nodes x-ui databases, against reading
+        the nodes one after another, and placing new inbounds by load.
+    """
+    os.environ["XUI_NODES"] = node_paths(args.nodes)
+    usernames = build_fleet_fixture(users=args.users,
+                                    inbounds_per_user=args.inbounds_per_user,
+                                    guests=args.guests)
+    from sqlalchemy import event
+    from backends import BotUsersBackend, fleet
+    from provisioning import provision
+
+    if args.node_latency:
+        # the other nodes' databases behind a network mount
+        for node in fleet.remote:
+            event.listen(node.engine, "before_cursor_execute",
+                         lambda *_: time.sleep(args.node_latency))
+
+    sample = random.sample(usernames, min(len(usernames), 200))
+    bot_ids = {}
+    for username in sample:
+        with BotUsersBackend(username) as backend:
+            bot_ids[username] = backend.dashboard.bot_id
+
+    def one_after_another(bot_id):
+        placements = fleet.placements(bot_id)
+        return [fleet.nodes[name].inbounds(ids) for name, ids in placements.items()]
+
+    def dashboard_then_nodes(username):
+        with BotUsersBackend(username) as backend:
+            backend.dashboard
+            return fleet.inbounds_of(backend.dashboard.bot_id)
+
+    def dashboard_with_nodes(username):
+        with BotUsersBackend(username) as backend:
+            return backend.remote_inbounds
+
+    # the handlers find the bot ids and placements cached
+    for username in sample:
+        BotUsersBackend.is_authenticated(username)
+        fleet.placements(bot_ids[username])
+    for name, query in (("other nodes, one by one", lambda u: one_after_another(bot_ids[u])),
+                        ("other nodes, fanned out", lambda u: fleet.inbounds_of(bot_ids[u])),
+                        ("dashboard, then the nodes", dashboard_then_nodes),
+                        ("dashboard+nodes, one fan_out", dashboard_with_nodes)):
+        times = []
+        for username in sample:
+            started = time.perf_counter()
+            query(username)
+            times.append(time.perf_counter()-started)
+        report(name, times)
+
+    for name in ("get_inbound_stats", "get_connection_urls"):
+        times = []
+        for username in sample:
+            started = time.perf_counter()
+            with BotUsersBackend(username) as backend:
+                getattr(backend, name)()
+            times.append(time.perf_counter()-started)
+        report(name, times)
+
+    started = time.perf_counter()
+    created = provision([{"protocol": "vless", "remark": f"placed{i}", "quota": 10, "days": 30}
+                         for i in range(args.accounts)],
+                        reload=False)
+    elapsed = time.perf_counter()-started
+    placed = {}
+    for account in created:
+        placed[account["node"]] = placed.get(account["node"], 0) + 1
+    print(f"provisioned {len(created)} accounts in {elapsed*1e3:.2f}ms: {placed}")
+    print("fleet:", fleet.stats)
+
+
+BENCHMARKS = {
+    "handlers": bench_handlers,
+    "conversation": bench_conversation,
+    "webhook": bench_webhook,
+    "startup": bench_startup,
+    "broadcast": bench_broadcast,
+    "qr": bench_qr,
+    "ports": bench_ports,
+    "persistence": bench_persistence,
+    "enforcement": bench_enforcement,
+    "timeseries": bench_timeseries,
+    "aggregates": bench_aggregates,
+    "fleet": bench_fleet,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=BENCHMARKS)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--inbounds", type=int, default=50000)
+    parser.add_argument("--history-inbounds", type=int, default=1000,
+                        help="inbounds of the timeseries benchmark, a month of samples each")
+    parser.add_argument("--inbounds-per-user", type=int, default=2)
+    parser.add_argument("--guests", type=int, default=100)
+    parser.add_argument("--telegram-per-bot", type=int, default=1)
+    parser.add_argument("--spare-inbounds", type=int, default=0,
+                        help="inbounds no user owns, to grow the table")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the stub bot api takes to answer")
+    parser.add_argument("--workers", type=int, default=64,
+                        help="updates the bot handles at once in the webhook benchmark")
+    parser.add_argument("--connections", type=int, default=40,
+                        help="parallel webhook connections, telegram's default is 40")
+    parser.add_argument("--top", type=int, default=20,
+                        help="slowest imports listed by the startup benchmark")
+    parser.add_argument("--rate", type=float, default=1e6,
+                        help="messages per second the broadcast benchmark may send")
+    parser.add_argument("--nodes", type=int, default=3,
+                        help="x-ui databases of the fleet benchmark, the local one included")
+    parser.add_argument("--node-latency", type=float, default=0.0,
+                        help="seconds every statement on the fleet benchmark's other nodes takes extra")
+    parser.add_argument("--accounts", type=int, default=100,
+                        help="accounts the fleet benchmark provisions over the nodes")
+    parser.add_argument("--max-p99", type=float, default=None,
+                        help="with --check, fail if the p99 latency is over this many ms")
+    parser.add_argument("--check", action="store_true",
+                        help="fail if a handler exceeds its sql statement or latency budget")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
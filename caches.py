@@ -0,0 +1,169 @@
+"""
+    Process-local caches for hot database lookups and rendered content.
+"""
+
+import os, time, hashlib, pathlib, threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A thread safe LRU mapping whose entries also expire after `ttl` seconds."""
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_if_missing(self, key, value):
+        """Sets key unless it holds a live entry, which may be newer than value."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class QRCache:
+    """
+        Rendered qr code PNGs keyed by the sha256 of their content. Keeps up
+        to `max_bytes` in memory, optionally backed by files in `directory`,
+        and remembers the telegram file_id a PNG got once it was uploaded,
+        for up to `max_file_ids` of the most recently used.
+    """
+    def __init__(self, render, max_bytes=16*2**20, directory=None, max_file_ids=10000):
+        self.render = render
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self.directory = pathlib.Path(directory) if directory else None
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._file_ids = OrderedDict()
+        self._lock = threading.Lock()
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(data) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def png(self, data) -> bytes:
+        key = self.key(data)
+        with self._lock:
+            png = self._data.get(key)
+            if png is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return png
+        png = self._read_disk(key)
+        if png is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            png = self.render(data)
+            self._write_disk(key, png)
+        self._remember(key, png)
+        return png
+
+    def file_id(self, data):
+        key = self.key(data)
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+            return file_id
+
+    def set_file_id(self, data, file_id):
+        key = self.key(data)
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_file_ids:
+                self._file_ids.popitem(last=False)
+
+    def _remember(self, key, png):
+        with self._lock:
+            if key in self._data or len(png) > self.max_bytes:
+                return
+            self._data[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            return self.directory.joinpath(f"{key}.png").read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, png):
+        if not self.directory:
+            return
+        path = self.directory.joinpath(f"{key}.png")
+        # unique per thread, two of them may render the same code at once
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(png)
+        os.replace(tmp_path, path)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size_bytes": self.size,
+            "entries": len(self._data),
+            "file_ids": len(self._file_ids),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
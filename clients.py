@@ -1,21 +1,65 @@
-import pathlib
+import time, pathlib, asyncio, logging.config
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (Application,
-                          PicklePersistence,
                           MessageHandler,
                           ConversationHandler,
                           CommandHandler,
                           ContextTypes,
                           filters)
-from sqlalchemy.orm import sessionmaker
+from configs import (ACCESS_TOKEN, 
+                     BOT_NAME, 
+                     BOT_PERSISTENCE_DB,
+                     STATS_POLL_INTERVAL,
+                     TELEGRAM_GLOBAL_RATE,
+                     TELEGRAM_CHAT_RATE,
+                     TELEGRAM_CHAT_BURST,
+                     SENDER_WORKERS,
+                     ENFORCEMENT_INTERVAL,
+                     NOTIFY_USAGE_THRESHOLDS,
+                     NOTIFY_DAYS_THRESHOLDS,
+                     TRAFFIC_HISTORY_DB,
+                     AGGREGATES_DB,
+                     METRICS_HOST,
+                     METRICS_PORT,
+                     METRICS_FILE,
+                     METRICS_FILE_INTERVAL,
+                     LOG_PATH,
+                     QR_WARMUP_LIMIT,
+                     DB_WATCH_INTERVAL,
+                     SSL_PUBLIC,
+                     SSL_PRIVATE,
+                     BOT_MODE,
+                     UPDATE_WORKERS,
+                     WEBHOOK_LISTEN,
+                     WEBHOOK_PORT,
+                     WEBHOOK_PATH,
+                     WEBHOOK_URL,
+                     WEBHOOK_SECRET,
+                     LOGGING)
+from models import verify_schema, pool_metrics, login_url_cache
+from backends import (BotUsersBackend, 
+                      InboundsBackend, 
+                      traffic_snapshot, 
+                      traffic_history,
+                      fleet_aggregates,
+                      auth_cache,
+                      trial_pool,
+                      fleet,
+                      db_watcher,
+                      xui_reloader,
+                      aremember_chat_id,
+                      chat_id_of,
+                      warm_caches)
+from enforcement import QuotaEnforcer
+from notifications import ThresholdNotifier
+from senders import OutboundSender, MeteredRequest
+from persistence import SQLitePersistence
+from admins import Broadcaster
+from processors import PerChatUpdateProcessor
+from utils import login_required, qr_photo, remember_qr_upload, qr_cache
+import metrics
 
-from configs import ACCESS_TOKEN, BOT_NAME
-from models import engine, Base
-from backends import BotUsersBackend, InboundsBackend
-from utils import login_required, generate_qr
 
-
-Session = sessionmaker(bind=engine)()
 AUTH, PRO_DASH, DASH, LOGIN = [chr(i) for i in range(4)]
 PRO_RULES = [
     "وضعیت اکانت ها",
@@ -27,46 +71,67 @@ GUEST_RULES = [
     "برنامه ها",
     "پیشنهاد رایگان"
 ]
+logger = logging.getLogger(__name__)
+background_tasks = set()
+outbound = OutboundSender(global_rate=TELEGRAM_GLOBAL_RATE,
+                          chat_rate=TELEGRAM_CHAT_RATE,
+                          chat_burst=TELEGRAM_CHAT_BURST,
+                          workers=SENDER_WORKERS)
+enforcer = QuotaEnforcer(outbound, xui_reloader, chat_id_of)
+notifier = ThresholdNotifier(outbound,
+                             chat_id_of,
+                             usage_thresholds=NOTIFY_USAGE_THRESHOLDS,
+                             day_thresholds=NOTIFY_DAYS_THRESHOLDS)
+
+
+async def reply(update: Update, text, reply_markup=None):
+    """Answers the update's chat through outbound, like every other message."""
+    message, = await (
+        outbound
+        .batch(update.effective_chat.id)
+        .text(text, reply_markup=reply_markup)
+        .send()
+    )
+    return message
 
 
+@metrics.timed_handler
 async def auth(update: Update, context):
     username = update.effective_user.username
-    user_qs = BotUsersBackend.user_exists(username)
-    if user_qs.scalar() and user_qs.first().is_auth:
+    await aremember_chat_id(username, update.effective_chat.id)
+    if await BotUsersBackend.ais_authenticated(username):
         markup = ReplyKeyboardMarkup([PRO_RULES],
                                      True)
-        await update.message.reply_text("به حساب خود خوش آمدید", 
-                                        reply_markup=markup)
+        await reply(update, "به حساب خود خوش آمدید", reply_markup=markup)
         return PRO_DASH
     else:
         markup = ReplyKeyboardMarkup([GUEST_RULES], 
                                      True)
-        await update.message.reply_text(f"خوش آمدی {update.effective_user.name}",
-                                        reply_markup=markup)
+        await reply(update, f"خوش آمدی {update.effective_user.name}", reply_markup=markup)
         return DASH
     
     
+@metrics.timed_handler
 async def dash(update: Update, context):
     username = update.effective_user.username
     op = update.message.text
     if op == GUEST_RULES[0]:
         markup = ReplyKeyboardMarkup([["لغو"]], resize_keyboard=True)
-        await update.message.reply_text("لطفا کد ورود خود را وارد کنید",
-                                        reply_markup=markup)
+        await reply(update, "لطفا کد ورود خود را وارد کنید", reply_markup=markup)
         return LOGIN
     
     elif op == GUEST_RULES[1]:
-        await update.message.reply_text(
-            "به طور کلی ما V2rayN رو برای اتصال پیشنهاد میکنیم اما ممکنه همیشه کار نکنه"
-        )
         await update.message.reply_chat_action("upload_document")
-        await update.message.reply_document(
-            pathlib.Path.cwd().joinpath("NapsternetV53.0.0.apk"))
-        await update.message.reply_text(
-            "یا اگر از آی او اس استفاده میکنین:"
-            "https://apps.apple.com/us/app/fair-vpn/id1533873488",
-            reply_markup=ReplyKeyboardMarkup([GUEST_RULES],
-                                             resize_keyboard=True)
+        await (
+            outbound
+            .batch(update.effective_chat.id)
+            .text("به طور کلی ما V2rayN رو برای اتصال پیشنهاد میکنیم اما ممکنه همیشه کار نکنه")
+            .document(pathlib.Path.cwd().joinpath("NapsternetV53.0.0.apk"))
+            .text("یا اگر از آی او اس استفاده میکنین:"
+                  "https://apps.apple.com/us/app/fair-vpn/id1533873488",
+                  reply_markup=ReplyKeyboardMarkup([GUEST_RULES],
+                                                   resize_keyboard=True))
+            .send()
         )
         return DASH
         
@@ -74,94 +139,194 @@ async def dash(update: Update, context):
         msg = (
             "اینجا ما به تو یک حساب فیلترشکن یکماهه یک گیگ به صورت رایگان پیشنهاد میکنیم"
         )
-        await update.message.reply_text(msg)
-        guest = InboundsBackend.guest_inbound(username)
-        await update.message.reply_text("لینک شما")
-        await update.message.reply_text(guest.inbound.get_login_url())
-        qr_buff = generate_qr(guest.inbound.get_login_url())
+        login_url = await InboundsBackend.aguest_login_url(username)
         markup = ReplyKeyboardMarkup([GUEST_RULES],
                                      resize_keyboard=True)
-        await update.message.reply_photo(photo=qr_buff,
-                                         caption="کیوآر کد اکانت شما",
-                                         reply_markup=markup)
+        # the texts go out as one message, the qr code as a second
+        *_, qr_message = await (
+            outbound
+            .batch(update.effective_chat.id)
+            .text(msg)
+            .text("لینک شما")
+            .text(login_url)
+            .photo(await qr_photo(login_url), 
+                   caption="کیوآر کد اکانت شما", 
+                   reply_markup=markup)
+            .send()
+        )
+        remember_qr_upload(login_url, qr_message)
         return DASH
     
 
+@metrics.timed_handler
 async def login(update: Update, context):
     username = update.effective_user.username
     login_code = update.message.text
-    if BotUsersBackend.is_login_code_valid(login_code):
-        BotUsersBackend(username).log_in_from_code(login_code)
+    if await BotUsersBackend.ais_login_code_valid(login_code):
+        async with BotUsersBackend.aopen(username) as bot_user:
+            await bot_user.alog_in_from_code(login_code)
         markup = ReplyKeyboardMarkup([PRO_RULES],
                                      resize_keyboard=True)
-        await update.message.reply_text("ورود با موفقیت انجام شد",
-                                        reply_markup=markup)
+        await reply(update, "ورود با موفقیت انجام شد", reply_markup=markup)
         return PRO_DASH
     else:
         markup = ReplyKeyboardMarkup([["لغو"]], resize_keyboard=True)
-        await update.message.reply_text("کد ورود نامعتبر است. دوباره امتحان کن",
-                                        reply_markup=markup)
+        await reply(update, "کد ورود نامعتبر است. دوباره امتحان کن", reply_markup=markup)
         return LOGIN
     
     
+@metrics.timed_handler
 @login_required
 async def pro_dash(update: Update, context):
     answer = update.message.text
     username = update.effective_user.username
     if answer == PRO_RULES[0]:
-        stats = BotUsersBackend(username).get_inbound_stats()
-        await update.message.reply_text(
-            "وضعیت های شما به شرح زیر است:"
-        )
+        stats = await BotUsersBackend.ainbound_stats(username)
         markup = ReplyKeyboardMarkup([PRO_RULES],
                                      resize_keyboard=True)
-        await update.message.reply_text(str(stats),
-                                        reply_markup=markup)
+        await (
+            outbound
+            .batch(update.effective_chat.id)
+            .text("وضعیت های شما به شرح زیر است:")
+            .text(str(stats), reply_markup=markup)
+            .send()
+        )
         return PRO_DASH
     
     elif answer == PRO_RULES[1]:
-        accounts = BotUsersBackend(username).get_connection_urls()
+        async with BotUsersBackend.aopen(username) as bot_user:
+            accounts = await bot_user.aget_connection_urls()
+        batch = outbound.batch(update.effective_chat.id)
+        # captioned qr codes are sent together as media groups
         for protocol, url in accounts.items():
-            await update.message.reply_text(f"{protocol}:")
-            await update.message.reply_text(url)
-            qr = generate_qr(url)
-            await update.message.reply_photo(qr)
-        markup = ReplyKeyboardMarkup([PRO_DASH],
+            batch.photo(await qr_photo(url), caption=f"{protocol}:\n{url}")
+        markup = ReplyKeyboardMarkup([PRO_RULES],
                                      resize_keyboard=True)
-        await update.message.reply_text("دیگه چطوری میتونم بهت کمک کنم؟",
-                                        reply_markup=markup)
+        batch.text("دیگه چطوری میتونم بهت کمک کنم؟", reply_markup=markup)
+        messages = await batch.send()
+        for url, message in zip(accounts.values(), messages):
+            remember_qr_upload(url, message)
         return PRO_DASH
         
     elif answer == PRO_RULES[2]:
-        BotUsersBackend(username).log_user_out()
+        async with BotUsersBackend.aopen(username) as bot_user:
+            await bot_user.alog_user_out()
         markup = ReplyKeyboardMarkup([GUEST_RULES],
                                      resize_keyboard=True)
-        await update.message.reply_text("با موفقیت خارج شدی",
-                                        reply_markup=markup)
+        await reply(update, "با موفقیت خارج شدی", reply_markup=markup)
         return DASH
 
 
-if __name__ == "__main__":
-    Base.metadata.create_all(engine)
-    
-    application = (
-        Application
-        .builder()
-        .token(ACCESS_TOKEN)
-        .persistence(PicklePersistence("vpn_bot_persistence"))
-        .build()
-    )
-    conv_handler = ConversationHandler(
-        entry_points=[auth],
+async def warm_up():
+    """Startup work that doesn't have to finish before the first update is handled."""
+    started = time.perf_counter()
+    await asyncio.to_thread(traffic_history.open, TRAFFIC_HISTORY_DB)
+    traffic_snapshot.listeners.append(traffic_history.observe)
+    await asyncio.to_thread(fleet_aggregates.open, AGGREGATES_DB)
+    traffic_snapshot.listeners.append(fleet_aggregates.observe)
+    users, qr_codes = await asyncio.to_thread(warm_caches, QR_WARMUP_LIMIT)
+    logger.info("warmed up %s login states and %s qr codes in %.2fs",
+                users, qr_codes, time.perf_counter() - started)
+
+
+async def post_init(application: Application):
+    traffic_snapshot.listeners.append(notifier.observe)
+    # the loop only keeps weak references to tasks
+    background_tasks.add(
+        asyncio.create_task(traffic_snapshot.poll(STATS_POLL_INTERVAL)))
+    outbound.start(application.bot)
+    xui_reloader.start()
+    fleet.start()
+    background_tasks.add(
+        asyncio.create_task(enforcer.run(ENFORCEMENT_INTERVAL)))
+    background_tasks.add(
+        asyncio.create_task(db_watcher.run(DB_WATCH_INTERVAL)))
+    trial_pool.start()
+    background_tasks.add(asyncio.create_task(trial_pool.run()))
+    # the broadcasts queued with `python admins.py broadcast` go through outbound
+    # too, opened here so importing clients doesn't create BROADCASTS_DB
+    background_tasks.add(
+        asyncio.create_task(Broadcaster(outbound, chat_id_of).watch()))
+    for prefix, stats in (("db_pool", pool_metrics.snapshot),
+                          ("auth_cache", lambda: auth_cache.stats),
+                          ("login_url_cache", lambda: login_url_cache.stats),
+                          ("qr_cache", lambda: qr_cache.stats),
+                          ("sender", lambda: outbound.stats),
+                          ("xui_reloader", lambda: xui_reloader.stats),
+                          ("enforcer", lambda: enforcer.stats),
+                          ("notifier", lambda: notifier.stats),
+                          ("trial_pool", lambda: trial_pool.stats),
+                          ("db_watcher", lambda: db_watcher.stats),
+                          ("traffic_history", lambda: traffic_history.stats),
+                          ("aggregates", lambda: fleet_aggregates.stats),
+                          ("fleet", lambda: fleet.stats)):
+        metrics.registry.collect(prefix, stats)
+    if isinstance(application.update_processor, PerChatUpdateProcessor):
+        metrics.registry.collect("updates", lambda: application.update_processor.stats)
+    background_tasks.add(asyncio.create_task(warm_up()))
+    if METRICS_PORT:
+        background_tasks.add(
+            asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT)))
+    if METRICS_FILE:
+        background_tasks.add(
+            asyncio.create_task(metrics.write_periodically(METRICS_FILE, 
+                                                           METRICS_FILE_INTERVAL)))
+
+
+def build_conversation():
+    return ConversationHandler(
+        entry_points=[CommandHandler("start", auth)],
         states={
             AUTH: [MessageHandler(filters.Text(PRO_RULES+GUEST_RULES), auth)],
             PRO_DASH: [MessageHandler(filters.Text(PRO_RULES), pro_dash)],
             DASH: [MessageHandler(filters.Text(GUEST_RULES), dash)],
             LOGIN: [MessageHandler(filters.ALL, login)]
         },
-        name=BOT_NAME,
+        name=BOT_NAME or "vpn_bot",
         persistent=True,
         fallbacks=[MessageHandler(filters.Text(PRO_RULES+GUEST_RULES), auth)]
     )
-    application.add_handler(conv_handler)
-    application.run_polling()
+
+
+def build_application(token=ACCESS_TOKEN,
+                      persistence=None,
+                      request=None,
+                      get_updates_request=None,
+                      on_init=post_init,
+                      workers=UPDATE_WORKERS):
+    """
+        The bot's application; benchmarks.py builds it with a stub request.
+        Up to `workers` updates are handled at once, one at a time per chat.
+    """
+    application = (
+        Application
+        .builder()
+        .token(token)
+        .request(request or MeteredRequest(connection_pool_size=256))
+        .get_updates_request(get_updates_request or MeteredRequest())
+        .persistence(persistence or SQLitePersistence(BOT_PERSISTENCE_DB))
+        .post_init(on_init)
+        .concurrent_updates(PerChatUpdateProcessor(workers))
+        .build()
+    )
+    application.add_handler(build_conversation())
+    return application
+
+
+if __name__ == "__main__":
+    pathlib.Path(LOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+    logging.config.dictConfig(LOGGING)
+    verify_schema()
+    
+    application = build_application()
+    if BOT_MODE == "webhook":
+        # telegram needs the certificate uploaded when it's self signed
+        application.run_webhook(listen=WEBHOOK_LISTEN,
+                                port=WEBHOOK_PORT,
+                                url_path=WEBHOOK_PATH,
+                                cert=SSL_PUBLIC,
+                                key=SSL_PRIVATE,
+                                webhook_url=WEBHOOK_URL,
+                                secret_token=WEBHOOK_SECRET)
+    else:
+        application.run_polling()
@@ -3,7 +3,7 @@ from datetime import date
 from dotenv import load_dotenv
 
 
-env_path = pathlib.Path(__file__).with_name()
+env_path = pathlib.Path(__file__).with_name(".env")
 load_dotenv(env_path)
 
 ACCESS_TOKEN = os.environ.get("BOT_TOKEN", None)
@@ -13,14 +13,124 @@ BOT_NAME = os.environ.get("BOT_NAME", None)
 SSL_PUBLIC = os.environ.get("SSL_PUBLIC", None)
 SSL_PRIVATE = os.environ.get("SSL_PRIVATE", None)
 URL = os.environ.get("XUI_URL", None)
-BOT_SESSIONS_PATH = os.environ.get("BOT_SESSIONS_PATH", 
-                                   pathlib.Path.cwd().joinpath("sessions"))
+# other x-ui nodes served by this bot, as comma separated name=database@host
+# entries. Their databases are local copies or mounts, the bot's own tables stay
+# in XUI_DB_PATH, the node named XUI_NODE_NAME.
+XUI_NODE_NAME = os.environ.get("XUI_NODE_NAME", "main")
+XUI_NODES = [
+    (name, *location.rsplit("@", 1))
+    for name, location in (
+        i.strip().split("=", 1) for i in os.environ.get("XUI_NODES", "").split(",") if i.strip()
+    )
+]
+# restarts the x-ui of another node, {name} and {host} are filled in
+XUI_NODE_RELOAD_COMMAND = os.environ.get("XUI_NODE_RELOAD_COMMAND", 
+                                         "ssh {host} systemctl restart x-ui")
+BOT_SESSIONS_PATH = pathlib.Path(os.environ.get("BOT_SESSIONS_PATH", 
+                                                pathlib.Path.cwd().joinpath("sessions")))
+# "sqlite" keeps all sessions in BOT_SESSIONS_DB, "pickle" one file per user
+BOT_SESSIONS_STORE = os.environ.get("BOT_SESSIONS_STORE", "sqlite")
+BOT_SESSIONS_DB = os.environ.get("BOT_SESSIONS_DB", 
+                                 BOT_SESSIONS_PATH.joinpath("sessions.db"))
+# seconds session changes are buffered before they're written together
+BOT_SESSIONS_FLUSH_INTERVAL = float(os.environ.get("BOT_SESSIONS_FLUSH_INTERVAL", 1))
+# where the conversation states of the users are kept between restarts
+BOT_PERSISTENCE_DB = os.environ.get("BOT_PERSISTENCE_DB", 
+                                    pathlib.Path.cwd().joinpath("vpn_bot_persistence.db"))
+# number of threads that run blocking database queries for the handlers
+DB_WORKERS = int(os.environ.get("DB_WORKERS", 8))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", DB_WORKERS))
+# seconds to wait for a free pooled connection
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+# milliseconds sqlite waits on a lock held by x-ui before giving up
+DB_BUSY_TIMEOUT = int(os.environ.get("DB_BUSY_TIMEOUT", 5000))
+# how long (seconds) and how many usernames' login state is kept in memory
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 300))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 50000))
+# seconds between two reads of the inbounds' traffic counters
+STATS_POLL_INTERVAL = float(os.environ.get("STATS_POLL_INTERVAL", 30))
+# telegram allows about 30 messages per second overall and 1 per second per chat
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+SENDER_WORKERS = int(os.environ.get("SENDER_WORKERS", 8))
+# rendered qr codes kept in memory, and an optional directory to keep them on disk
+QR_CACHE_BYTES = int(os.environ.get("QR_CACHE_BYTES", 16*2**20))
+QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", None)
+# telegram file_ids of uploaded qr codes remembered, the most recently used
+QR_CACHE_FILE_IDS = int(os.environ.get("QR_CACHE_FILE_IDS", 10000))
+# changes to the inbounds within XUI_RELOAD_DEBOUNCE seconds share one restart
+XUI_RELOAD_COMMAND = os.environ.get("XUI_RELOAD_COMMAND", "systemctl restart x-ui")
+XUI_RELOAD_DEBOUNCE = float(os.environ.get("XUI_RELOAD_DEBOUNCE", 2))
+XUI_RELOAD_MAX_DELAY = float(os.environ.get("XUI_RELOAD_MAX_DELAY", 10))
+# range new inbounds get their ports from, and whether to check the os for them too
+INBOUND_PORT_MIN = int(os.environ.get("INBOUND_PORT_MIN", 10000))
+INBOUND_PORT_MAX = int(os.environ.get("INBOUND_PORT_MAX", 65353))
+INBOUND_PORT_CHECK_OS = os.environ.get("INBOUND_PORT_CHECK_OS", "") == "1"
+# seconds between two runs of the job disabling exhausted and expired inbounds
+ENFORCEMENT_INTERVAL = float(os.environ.get("ENFORCEMENT_INTERVAL", 60))
+# users are warned once their used traffic passes these fractions of the quota,
+# and these many days before their account expires
+NOTIFY_USAGE_THRESHOLDS = [
+    float(i) for i in os.environ.get("NOTIFY_USAGE_THRESHOLDS", "0.8,0.95").split(",")
+]
+NOTIFY_DAYS_THRESHOLDS = [
+    int(i) for i in os.environ.get("NOTIFY_DAYS_THRESHOLDS", "3,1").split(",")
+]
+# where the traffic history of the inbounds is kept, and seconds between its samples
+TRAFFIC_HISTORY_DB = os.environ.get("TRAFFIC_HISTORY_DB", 
+                                    pathlib.Path.cwd().joinpath("traffic_history.db"))
+TRAFFIC_HISTORY_INTERVAL = float(os.environ.get("TRAFFIC_HISTORY_INTERVAL", 300))
+# free trial inbounds kept ready for guests, and the traffic (GB) and days they give
+TRIAL_POOL_SIZE = int(os.environ.get("TRIAL_POOL_SIZE", 20))
+TRIAL_QUOTA = int(os.environ.get("TRIAL_QUOTA", 1))
+TRIAL_DAYS = int(os.environ.get("TRIAL_DAYS", 30))
+# "polling" or "webhook". The webhook is served with SSL_PUBLIC/SSL_PRIVATE on
+# WEBHOOK_PORT (telegram accepts 443, 80, 88 and 8443) of URL's host
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get(
+    "WEBHOOK_URL", 
+    f"https://{(URL or 'localhost').split(':')[0]}:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+)
+# telegram sends it with every update, so requests not from telegram are refused
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", None)
+# updates handled at the same time; one chat's updates still run in order
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 64))
+# remembers that the bot's tables were checked, so restarts skip the check
+SCHEMA_CACHE_PATH = os.environ.get("SCHEMA_CACHE_PATH", 
+                                   pathlib.Path.cwd().joinpath(".schema_verified"))
+# how many qr codes of logged in users are rendered in the background at startup
+QR_WARMUP_LIMIT = int(os.environ.get("QR_WARMUP_LIMIT", 200))
+# seconds between two checks of the x-ui database for changes made outside the bot
+DB_WATCH_INTERVAL = float(os.environ.get("DB_WATCH_INTERVAL", 1))
+# where admin broadcasts and their progress are kept, how many messages per second
+# they send (telegram allows about 30 overall) and how many users are read at once
+BROADCASTS_DB = os.environ.get("BROADCASTS_DB", 
+                               pathlib.Path.cwd().joinpath("broadcasts.db"))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 500))
+# seconds between two looks of the running bot for queued broadcasts
+BROADCAST_POLL_INTERVAL = float(os.environ.get("BROADCAST_POLL_INTERVAL", 10))
+# where the fleet wide rollups the admin commands read are kept
+AGGREGATES_DB = os.environ.get("AGGREGATES_DB", 
+                               pathlib.Path.cwd().joinpath("aggregates.db"))
+# fraction of the sql statements logged with their duration, 0 turns it off
+SQL_ECHO_SAMPLE_RATE = float(os.environ.get("SQL_ECHO_SAMPLE_RATE", 0))
+# a local http endpoint serving /metrics, and/or a file the metrics are written to
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+METRICS_FILE = os.environ.get("METRICS_FILE", None)
+METRICS_FILE_INTERVAL = float(os.environ.get("METRICS_FILE_INTERVAL", 15))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 LOGGING = {
     "version": 1,
     "handlers": {
         "file": {
-            "level": "DEBUG",
-            "class": "loggin.FileHandler",
+            "level": LOG_LEVEL,
+            "class": "logging.FileHandler",
             "filename": LOG_PATH,
             "formatter": "default"
         }
@@ -28,11 +138,11 @@ LOGGING = {
     "formatters": {
         "default": {
             "format": "[%(levelname)s] - %(asctime)s (%(name)s %(lineno)s): %(message)s",
-            "date_fmt": "%Y-%m-%d %H:%M:%S"
+            "datefmt": "%Y-%m-%d %H:%M:%S"
         }
     },
     "root": {
         "handlers": ["file"],
-        "level": "DEBUG"
+        "level": LOG_LEVEL
     }
 }
@@ -0,0 +1,99 @@
+"""
+    Everything the bot shows a user, read with a single query.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select, literal, null, union_all
+
+from models import (Inbounds,
+                    TelegramUsers,
+                    GuestUsers,
+                    UsersInboundsRelation,
+                    LoginUrlMixin)
+
+
+INBOUND_COLUMNS = (Inbounds.id,
+                   Inbounds.remark,
+                   Inbounds.protocol,
+                   Inbounds.port,
+                   Inbounds.up,
+                   Inbounds.down,
+                   Inbounds.total,
+                   Inbounds.expiry_time,
+                   Inbounds.enable,
+                   Inbounds.settings,
+                   Inbounds.stream_settings)
+
+
+class InboundView(LoginUrlMixin, namedtuple("InboundView", [c.key for c in INBOUND_COLUMNS])):
+    """A read only inbound, without the columns the bot never shows."""
+    __slots__ = ()
+
+    @property
+    def remaining_traffic(self) -> int:
+        return (self.total or 0) - ((self.down or 0) + (self.up or 0))
+
+    @property
+    def expires_in(self) -> int:
+        """Returns number of days left to the expiration, None if it never expires."""
+        if not self.expiry_time:
+            return None
+        expiry = datetime.fromtimestamp(self.expiry_time*1e-3)
+        return (expiry-datetime.now()).days
+
+
+class Dashboard(namedtuple("Dashboard", ["username",
+                                         "is_auth",
+                                         "bot_id",
+                                         "inbounds",
+                                         "guest_inbounds"])):
+    """
+        inbounds are those of the bot user the username is logged into,
+        guest_inbounds the free trial given to the username.
+    """
+    __slots__ = ()
+
+    @property
+    def all_inbounds(self):
+        ids = {i.id for i in self.inbounds}
+        return self.inbounds + tuple(i for i in self.guest_inbounds if i.id not in ids)
+
+
+def dashboard_query(username):
+    bot_part = (
+        select(literal("bot"),
+               TelegramUsers.is_auth,
+               TelegramUsers.bot_id,
+               *INBOUND_COLUMNS)
+        .select_from(TelegramUsers)
+        .outerjoin(UsersInboundsRelation,
+                   UsersInboundsRelation.bot_id==TelegramUsers.bot_id)
+        .outerjoin(Inbounds, Inbounds.id==UsersInboundsRelation.inbound_id)
+        .where(TelegramUsers.username==username)
+    )
+    guest_part = (
+        select(literal("guest"),
+               null(),
+               null(),
+               *INBOUND_COLUMNS)
+        .select_from(GuestUsers)
+        .join(Inbounds, Inbounds.id==GuestUsers.inbound_id)
+        .where(GuestUsers.username==username)
+    )
+    return union_all(bot_part, guest_part)
+
+
+def load_dashboard(session, username) -> Dashboard:
+    is_auth, bot_id = False, None
+    inbounds, guest_inbounds = [], []
+    for source, row_is_auth, row_bot_id, *inbound in session.execute(dashboard_query(username)):
+        if source == "bot":
+            is_auth, bot_id = bool(row_is_auth), row_bot_id
+            target = inbounds
+        else:
+            target = guest_inbounds
+        # the outer join gives a row of nulls to a user without inbounds
+        if inbound[0] is not None:
+            target.append(InboundView(*inbound))
+    return Dashboard(username, is_auth, bot_id, tuple(inbounds), tuple(guest_inbounds))
@@ -0,0 +1,134 @@
+"""
+    Disables inbounds whose traffic ran out or whose time is over, with one
+    UPDATE over the whole table, then asks for a single x-ui reload and
+    tells the affected users.
+"""
+
+import time, asyncio, logging
+from sqlalchemy import select, update, and_, or_
+
+from models import (engine,
+                    Inbounds,
+                    TelegramUsers,
+                    GuestUsers,
+                    UsersInboundsRelation,
+                    HAS_RETURNING,
+                    chunks)
+
+
+logger = logging.getLogger(__name__)
+
+
+def exhausted_or_expired(now_ms):
+    return and_(
+        Inbounds.enable==True,
+        or_(
+            and_(Inbounds.total > 0, Inbounds.up + Inbounds.down >= Inbounds.total),
+            and_(Inbounds.expiry_time > 0, Inbounds.expiry_time <= now_ms),
+        )
+    )
+
+
+def disable_exhausted(now=None):
+    """Disables every enabled inbound over its quota or expiry, returns their rows."""
+    now_ms = int((now or time.time())*1e3)
+    condition = exhausted_or_expired(now_ms)
+    columns = (Inbounds.id,
+               Inbounds.remark,
+               Inbounds.up,
+               Inbounds.down,
+               Inbounds.total,
+               Inbounds.expiry_time)
+    with engine.begin() as conn:
+        if HAS_RETURNING:
+            return conn.execute(
+                update(Inbounds).where(condition).values(enable=False).returning(*columns)
+            ).all()
+        rows = conn.execute(select(*columns).where(condition)).all()
+        if rows:
+            conn.execute(update(Inbounds).where(condition).values(enable=False))
+        return rows
+
+
+def usernames_of(inbound_ids):
+    """inbound id -> usernames of the telegram users and guests it belongs to."""
+    owners = {}
+    with engine.connect() as conn:
+        for chunk in chunks(inbound_ids):
+            rows = conn.execute(
+                select(UsersInboundsRelation.inbound_id, TelegramUsers.username)
+                .join(TelegramUsers, TelegramUsers.bot_id==UsersInboundsRelation.bot_id)
+                .where(UsersInboundsRelation.inbound_id.in_(chunk))
+                .union_all(
+                    select(GuestUsers.inbound_id, GuestUsers.username)
+                    .where(GuestUsers.inbound_id.in_(chunk))
+                )
+            )
+            for inbound_id, username in rows:
+                owners.setdefault(inbound_id, []).append(username)
+    return owners
+
+
+class QuotaEnforcer:
+    """
+        sender is a senders.OutboundSender, reloader a reloads.XUIReloader
+        and chat_id_of(username) returns where to message a user, or None.
+    """
+    def __init__(self, sender, reloader, chat_id_of):
+        self.sender = sender
+        self.reloader = reloader
+        self.chat_id_of = chat_id_of
+        self.runs = 0
+        self.disabled = 0
+        self.last_duration = None
+
+    @staticmethod
+    def _message(row, now_ms):
+        if row.expiry_time and row.expiry_time <= now_ms:
+            return f"زمان اکانت {row.remark} به پایان رسید و غیرفعال شد"
+        return f"حجم اکانت {row.remark} به پایان رسید و غیرفعال شد"
+
+    def enforce(self):
+        """The blocking part of a run: disables and finds whom to notify."""
+        now = time.time()
+        started = time.perf_counter()
+        rows = disable_exhausted(now)
+        notifications = []
+        if rows:
+            self.reloader.request()
+            owners = usernames_of([row.id for row in rows])
+            for row in rows:
+                for username in owners.get(row.id, ()):
+                    chat_id = self.chat_id_of(username)
+                    if chat_id is not None:
+                        notifications.append((chat_id, self._message(row, now*1e3)))
+        self.runs += 1
+        self.disabled += len(rows)
+        self.last_duration = time.perf_counter() - started
+        return rows, notifications
+
+    async def run_once(self):
+        rows, notifications = await asyncio.to_thread(self.enforce)
+        if rows:
+            logger.info("disabled %s inbounds in %.3fs", len(rows), self.last_duration)
+        results = await asyncio.gather(
+            *[self.sender.batch(chat_id).text(text).send() for chat_id, text in notifications],
+            return_exceptions=True
+        )
+        return rows, results
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("enforcing quotas failed")
+            await asyncio.sleep(interval)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "disabled": self.disabled,
+            "last_duration": self.last_duration,
+        }
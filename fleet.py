@@ -0,0 +1,177 @@
+"""
+    Several x-ui nodes served by one bot. The local node is the database of
+    models.engine, which also holds the bot's own tables. The others (see
+    XUI_NODES) are read and written through their database files, local
+    copies or mounts, and their inbounds belong to bot users through
+    node_inbounds_relation.
+
+    A user's inbounds on the other nodes are read from all of those nodes
+    at once, together with the local dashboard once the user's placements
+    are cached, and new inbounds go to the node with the lowest load.
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, func
+
+from caches import TTLCache
+from models import engine, Inbounds, NodeInboundsRelation, chunks
+from dashboards import InboundView, INBOUND_COLUMNS
+from ports import NoFreePort
+
+
+class Node:
+    """
+        One x-ui: the engine of its database, the host its inbounds are
+        reached at, a ports.PortAllocator and a reloads.XUIReloader.
+    """
+    def __init__(self, name, host, engine, ports, reloader):
+        self.name = name
+        self.host = host
+        self.engine = engine
+        self.ports = ports
+        self.reloader = reloader
+
+    def inbounds(self, ids) -> list:
+        """InboundViews of the node's inbounds with these ids."""
+        ids, views = list(ids), []
+        with self.engine.connect() as conn:
+            for chunk in chunks(ids):
+                views += [
+                    InboundView(*row)
+                    for row in conn.execute(
+                        select(*INBOUND_COLUMNS).where(Inbounds.id.in_(chunk)))
+                ]
+        return views
+
+    def load(self) -> dict:
+        with self.engine.connect() as conn:
+            inbounds, traffic = conn.execute(
+                select(func.count(), func.total(Inbounds.up + Inbounds.down))).one()
+        return {"inbounds": inbounds,
+                "traffic": traffic,
+                "ports": self.ports.high - self.ports.low + 1,
+                "free_ports": self.ports.free_count}
+
+    def __repr__(self):
+        return f"Node({self.name!r}, {self.host!r})"
+
+
+class Fleet:
+    """
+        nodes[0] is the local node. placements_cache holds the placements
+        of bot users; clear it when node_inbounds_relation changes.
+    """
+    def __init__(self, nodes, placements_cache=None):
+        self.local = nodes[0]
+        self.nodes = {node.name: node for node in nodes}
+        self.fan_outs = 0
+        self.placed = {node.name: 0 for node in nodes}
+        self.placements_cache = placements_cache or TTLCache()
+        self._executor = ThreadPoolExecutor(max_workers=len(nodes),
+                                            thread_name_prefix="fleet")
+
+    @property
+    def remote(self) -> list:
+        return [node for node in self.nodes.values() if node is not self.local]
+
+    def start(self, loop=None):
+        """Binds the reloaders of the other nodes to the loop, like the local one."""
+        for node in self.remote:
+            node.reloader.start(loop)
+
+    def fan_out(self, function, nodes=None) -> dict:
+        """Runs function(node) on every node, or those given, at once. Blocking."""
+        nodes = list(self.nodes.values() if nodes is None else nodes)
+        if len(nodes) < 2:
+            return {node.name: function(node) for node in nodes}
+        self.fan_outs += 1
+        # each call gets a copy of the context, like backends.run_in_db
+        futures = {
+            node.name: self._executor.submit(contextvars.copy_context().run, function, node)
+            for node in nodes
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+    def placements(self, bot_id) -> dict:
+        """node name -> ids of the bot user's inbounds on that node, for the other nodes."""
+        placements = self.placements_cache.get(bot_id)
+        if placements is not None:
+            return placements
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(NodeInboundsRelation.node, NodeInboundsRelation.inbound_id)
+                .where(NodeInboundsRelation.bot_id==bot_id)
+            ).all()
+        placements = {}
+        for node, inbound_id in rows:
+            placements.setdefault(node, []).append(inbound_id)
+        self.placements_cache.set(bot_id, placements)
+        return placements
+
+    def inbounds_of(self, bot_id) -> list:
+        """(node, InboundView) of the bot user's inbounds on the other nodes."""
+        if bot_id is None or not self.remote:
+            return []
+        placements = self.placements(bot_id)
+        nodes = [self.nodes[name] for name in placements if name in self.nodes]
+        views = self.fan_out(lambda node: node.inbounds(placements[node.name]), nodes)
+        return [(self.nodes[name], view) for name, node_views in views.items()
+                for view in node_views]
+
+    def inbounds_alongside(self, bot_id, local_read):
+        """
+            Runs local_read() on the local node in the same fan_out that
+            reads the bot user's inbounds on the other nodes. Returns
+            (local_read(), inbounds_of(bot_id)), or None if the bot user's
+            placements aren't cached.
+        """
+        placements = None if bot_id is None else self.placements_cache.get(bot_id)
+        if placements is None:
+            return None
+        nodes = [self.local] + [self.nodes[name] for name in placements
+                                if name in self.nodes and name != self.local.name]
+        results = self.fan_out(
+            lambda node: local_read() if node is self.local
+            else node.inbounds(placements[node.name]),
+            nodes)
+        local = results.pop(self.local.name)
+        return local, [(self.nodes[name], view) for name, node_views in results.items()
+                       for view in node_views]
+
+    def place(self, count=1) -> list:
+        """
+            The nodes count new inbounds go to. A node's load is the share of
+            its ports in use plus its share of the fleet's traffic, and each
+            inbound placed on it adds a port and the average traffic.
+        """
+        loads = self.fan_out(lambda node: node.load())
+        inbounds = sum(load["inbounds"] for load in loads.values())
+        traffic = sum(load["traffic"] for load in loads.values())
+        average = traffic / inbounds if inbounds else 0
+        traffic = traffic or 1
+
+        def score(name):
+            load = loads[name]
+            return ((load["ports"] - load["free_ports"]) / load["ports"]
+                    + load["traffic"] / traffic)
+
+        placed = []
+        for _ in range(count):
+            candidates = [name for name, load in loads.items() if load["free_ports"] > 0]
+            if not candidates:
+                raise NoFreePort("every node's ports are used")
+            name = min(candidates, key=score)
+            loads[name]["free_ports"] -= 1
+            loads[name]["traffic"] += average
+            self.placed[name] += 1
+            placed.append(self.nodes[name])
+        return placed
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "nodes": len(self.nodes),
+            "fan_outs": self.fan_outs,
+            **{f"placed_{name}": n for name, n in self.placed.items()},
+        }
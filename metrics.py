@@ -0,0 +1,188 @@
+"""
+    Latency histograms and counters for the handlers, the sql statements and
+    the telegram api calls, exported in the prometheus text format. They can
+    be scraped from a local http endpoint or written to a file periodically.
+
+    The stats the other modules already keep (pool, caches, sender, ...)
+    are exported as gauges through `registry.collect(prefix, function)`.
+"""
+
+import os, time, asyncio, logging, threading
+from bisect import bisect_left
+from functools import wraps
+
+
+logger = logging.getLogger(__name__)
+
+# seconds, roughly doubling from 0.5ms to 30s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q) -> float:
+        """Upper bound of the bucket holding the q-th quantile."""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, seen = q * count, 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self, name, labels=()) -> list:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def collect(self, prefix, function):
+        """function() returns a dict of numbers, exported as prefix_<key> gauges."""
+        self._collectors[prefix] = function
+
+    def render(self) -> str:
+        lines, typed = [], set()
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            lines += histogram.render(name, labels)
+        with self._lock:
+            counters = sorted(self._counters.items())
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for prefix, function in list(self._collectors.items()):
+            try:
+                values = function()
+            except Exception:
+                logger.exception("collecting %s metrics failed", prefix)
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed_handler(function):
+    """Records the latency of a telegram handler, labelled with its name."""
+    histogram = registry.histogram("handler_seconds", handler=function.__name__)
+
+    @wraps(function)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await function(update, context)
+        except Exception:
+            registry.inc("handler_errors_total", handler=function.__name__)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+async def _serve_client(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # the headers aren't needed, but have to be read before answering
+        while (await reader.readline()).strip():
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else ""
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host="127.0.0.1", port=9100):
+    """A minimal http server answering GET /metrics."""
+    server = await asyncio.start_server(_serve_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def write_snapshot(path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+async def write_periodically(path, interval=15):
+    while True:
+        try:
+            await asyncio.to_thread(write_snapshot, path)
+        except Exception:
+            logger.exception("writing the metrics to %s failed", path)
+        await asyncio.sleep(interval)
@@ -3,27 +3,359 @@
 """
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import (Column, 
+from sqlalchemy import (inspect,
+                        text,
+                        UniqueConstraint,
+                        Column, 
                         Integer,
                         ForeignKey,
                         DateTime,
                         Text,
                         Boolean,
-                        create_engine)
-from sqlalchemy.orm import relationship
+                        create_engine,
+                        event)
+from sqlalchemy.orm import relationship, sessionmaker, Session as OrmSession
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from uuid import uuid4
-import json
+from urllib.parse import urlencode, quote
+import os, json, time, base64, sqlite3, hashlib, pathlib, random, logging, threading, weakref
 
+from caches import TTLCache
+from metrics import registry
 from utils import random_str
-from configs import XUI_DB_PATH, URL
+from configs import (XUI_DB_PATH, 
+                     URL, 
+                     DB_POOL_SIZE, 
+                     DB_POOL_TIMEOUT, 
+                     DB_BUSY_TIMEOUT,
+                     SQL_ECHO_SAMPLE_RATE,
+                     SCHEMA_CACHE_PATH)
+
+
+sql_logger = logging.getLogger("models.sql")
+
+
+class PoolMetrics:
+    """Counters for the connection pool and the sessions handed out by it."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.open_sessions = 0
+        self.leaked_sessions = 0
+        
+    def waited(self, seconds):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+    
+    def checkout(self):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            
+    def checkin(self):
+        with self._lock:
+            self.checked_out -= 1
+            
+    def session_opened(self):
+        with self._lock:
+            self.open_sessions += 1
+    
+    def session_closed(self):
+        with self._lock:
+            self.open_sessions -= 1
+    
+    def session_collected(self, closed):
+        # finalizer of a session that was garbage collected without close()
+        if not closed[0]:
+            with self._lock:
+                self.open_sessions -= 1
+                self.leaked_sessions += 1
+                
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+                "wait_max": self.wait_max,
+                "open_sessions": self.open_sessions,
+                "leaked_sessions": self.leaked_sessions,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_metrics.waited(time.perf_counter() - started)
+            
+
+class MeteredSession(OrmSession):
+    """A session that reports itself as leaked if it's collected unclosed."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._closed = [False]
+        pool_metrics.session_opened()
+        weakref.finalize(self, pool_metrics.session_collected, self._closed)
+        
+    def close(self):
+        if not self._closed[0]:
+            self._closed[0] = True
+            pool_metrics.session_closed()
+        super().close()
 
 
-engine = create_engine(f"sqlite+pysqlite:///{XUI_DB_PATH}", echo=True)
 Base = declarative_base()
+# (inbound id, host) -> (the columns the url was built from, url)
+login_url_cache = TTLCache(maxsize=100000, ttl=float("inf"))
+
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets the bot read while x-ui writes traffic counters
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+    
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.checkout()
+    
+
+def _on_checkin(dbapi_connection, connection_record):
+    pool_metrics.checkin()
+
+
+class StatementCounter:
+    def __init__(self):
+        self.statements = []
+        
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+    
+    def assert_at_most(self, limit):
+        assert self.count <= limit, (
+            f"expected at most {limit} sql statements, got {self.count}:\n"
+            + "\n".join(self.statements)
+        )
+
+
+# the counter of the innermost count_statements() block, if there's one.
+# backends.run_in_db copies the context into its threads, so queries a
+# handler runs on the executor are counted as well.
+_statement_counter = ContextVar("statement_counter", default=None)
+
+
+@contextmanager
+def count_statements(limit=None):
+    """
+        Records the sql statements executed inside the block. With limit,
+        raises AssertionError on exit if more than that many ran.
+    """
+    counter = StatementCounter()
+    token = _statement_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _statement_counter.reset(token)
+    if limit is not None:
+        counter.assert_at_most(limit)
+        
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statement_counter.get()
+    if counter is not None:
+        counter.statements.append(statement)
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["statement_started"].pop()
+    verb = statement.lstrip().split(None, 1)[0].upper()
+    registry.histogram("sql_statement_seconds", verb=verb).observe(duration)
+    # instead of echo=True, which logs every statement, log a sample of them
+    if SQL_ECHO_SAMPLE_RATE and random.random() < SQL_ECHO_SAMPLE_RATE:
+        sql_logger.info("%.2fms %s %r", duration*1e3, statement, parameters)
+
+
+def _forget_statement(context):
+    started = context.connection.info.get("statement_started") if context.connection else None
+    if started:
+        started.pop()
+    registry.inc("sql_errors_total")
+
+
+def create_xui_engine(path):
+    """An engine for an x-ui database, with the pool, pragmas and metrics above."""
+    # handlers run their queries on a thread pool (see backends.run_in_db), so
+    # connections must be usable from threads other than the one that opened them
+    xui_engine = create_engine(f"sqlite+pysqlite:///{path}",
+                               poolclass=MeteredQueuePool,
+                               pool_size=DB_POOL_SIZE,
+                               # guest_inbound nests a create_inbound session
+                               max_overflow=DB_POOL_SIZE,
+                               pool_timeout=DB_POOL_TIMEOUT,
+                               connect_args={"check_same_thread": False,
+                                             "timeout": DB_BUSY_TIMEOUT*1e-3})
+    for name, listener in (("connect", _configure_sqlite),
+                           ("checkout", _on_checkout),
+                           ("checkin", _on_checkin),
+                           ("before_cursor_execute", _count_statement),
+                           ("after_cursor_execute", _time_statement),
+                           ("handle_error", _forget_statement)):
+        event.listen(xui_engine, name, listener)
+    return xui_engine
+
+
+# the local x-ui database, which also holds the bot's own tables
+engine = create_xui_engine(XUI_DB_PATH)
+Session = sessionmaker(bind=engine, 
+                       class_=MeteredSession, 
+                       expire_on_commit=False)
+
+# UPDATE and DELETE ... RETURNING need sqlite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+# ids or ports per IN (...), to stay under sqlite's limit of variables per statement
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=CHUNK_SIZE):
+    """items, a list, in slices of at most size."""
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
 
 
-class Inbounds(Base):
+@contextmanager
+def session_scope(bind=None):
+    """
+        Yields a session that is committed on success and always closed.
+        bind is another node's engine, the local one by default.
+    """
+    session = Session(bind=bind) if bind is not None else Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class LoginUrlMixin:
+    """
+        Builds login urls for anything that has the id, protocol, port,
+        remark, settings and stream_settings columns of an inbound.
+    """
+    __slots__ = ()
+    
+    def _parsed(self, column):
+        text = getattr(self, column)
+        return json.loads(text) if text else {}
+    
+    @property
+    def parsed_settings(self) -> dict:
+        return self._parsed("settings")
+    
+    @property
+    def parsed_stream_settings(self) -> dict:
+        return self._parsed("stream_settings")
+    
+    def get_login_url(self, host_address:str=None):
+        """
+            Returns v2ray login url. host_address example: example.com, the
+            inbound's own port is used. Urls are cached per inbound until
+            any column they're built from changes.
+        """
+        host_address = (host_address or URL).split(":")[0]
+        fingerprint = (self.protocol, 
+                       self.port, 
+                       self.remark, 
+                       self.settings, 
+                       self.stream_settings)
+        cached = login_url_cache.get((self.id, host_address))
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        try:
+            url = self._build_login_url(host_address)
+        except Exception as e:
+            print(
+                f"[!] a corruption was detected for {self.__repr__()}:\n{e}"
+            )
+            return
+        login_url_cache.set((self.id, host_address), (fingerprint, url))
+        return url
+    
+    @classmethod
+    def get_login_urls(cls, inbounds, host_address:str=None) -> dict:
+        """Login urls of many inbounds in one pass, keyed by inbound id."""
+        return {i.id: i.get_login_url(host_address) for i in inbounds}
+    
+    def _build_login_url(self, host):
+        client = self.parsed_settings["clients"][0]
+        stream = self.parsed_stream_settings
+        network = stream.get("network", "tcp")
+        security = stream.get("security", "none")
+        tls = stream.get(f"{security}Settings", {})
+        sni = tls.get("serverName") or host
+        header_type = stream.get("tcpSettings", {}).get("header", {}).get("type", "none")
+        ws = stream.get("wsSettings", {})
+        path = ws.get("path", "")
+        ws_host = ws.get("headers", {}).get("Host", "")
+        service_name = stream.get("grpcSettings", {}).get("serviceName", "")
+        if self.protocol == "vmess":
+            config = {
+                "v": "2",
+                "ps": self.remark,
+                "add": host,
+                "port": self.port,
+                "id": client["id"],
+                "aid": client.get("alterId", 0),
+                "net": network,
+                "type": header_type,
+                "host": ws_host,
+                "path": path or service_name,
+                "tls": security if security != "none" else "",
+                "sni": sni if security != "none" else "",
+            }
+            return "vmess://" + base64.b64encode(json.dumps(config).encode()).decode()
+        query = {"type": network, "security": security}
+        if self.protocol == "vless":
+            query["encryption"] = "none"
+            if client.get("flow"):
+                query["flow"] = client["flow"]
+        if security != "none":
+            query["sni"] = sni
+        if network == "tcp":
+            query["headerType"] = header_type
+        elif network == "ws":
+            query.update(path=path, host=ws_host)
+        elif network == "grpc":
+            query["serviceName"] = service_name
+        credential = client.get("password") if self.protocol == "trojan" else client["id"]
+        if not credential:
+            raise ValueError(f"{self.protocol} client without a credential")
+        return (
+            f"{self.protocol}://{credential}@{host}:{self.port}?"
+            f"{urlencode(query)}#{quote(self.remark or '')}"
+        )
+
+
+class Inbounds(Base, LoginUrlMixin):
     __tablename__ = "inbounds"
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, default=1, autoincrement=True)
@@ -45,7 +377,7 @@ class Inbounds(Base):
     
     bot_users = relationship("BotUsers",
                              secondary="users_inbounds_relation",
-                             backref="inbounds")
+                             back_populates="inbounds")
     guest = relationship("GuestUsers", 
                          back_populates="inbound", 
                          uselist=False)
@@ -56,25 +388,11 @@ class Inbounds(Base):
     
     @property
     def expires_in(self) -> int:
-        """Returns number of days left to the expirations."""
+        """Returns number of days left to the expirations, None if it never expires."""
+        if not self.expiry_time:
+            return None
         expiry = datetime.fromtimestamp(self.expiry_time*1e-3)
-        return (datetime.now()-expiry).days
-    
-    def get_login_url(self, host_address:str=URL.split(":")[0]):
-        """Returns v2ray login url. host_address example: example.com:666"""
-        try:
-            uuid = json.loads(self.settings)["clients"]["id"]
-        except Exception as e:
-            print(
-                f"[!] a corruption was detected for {self.__repr__()}:\n{e}"
-            )
-            return
-        return (
-            f"{self.protocol}://{uuid}@{host_address}?"
-            "security=tls&encryption=none&"
-            "headerType=none&type=tcp&"
-            f"sni={host_address.split(':')[0]}#{self.remark}"
-        )
+        return (expiry-datetime.now()).days
         
     
 class BotUsers(Base):
@@ -84,19 +402,28 @@ class BotUsers(Base):
     accounts = relationship("TelegramUsers", backref="bot")
     inbounds = relationship("Inbounds", 
                             secondary="users_inbounds_relation", 
-                            backref="bot_users")
+                            back_populates="bot_users")
     
 
 class GuestUsers(Base):
+    __tablename__ = "guest_users"
     id = Column(Integer, primary_key=True)
     username = Column(Text, unique=True, index=True)
     created = Column(DateTime, default=datetime.now)
     updated = Column(DateTime, default=datetime.now)
-    inbound_id = Column(Integer, ForeignKey("inbounds.id"))
-    inbound = relationship("Inbounds", back_populates="inbound")
+    inbound_id = Column(Integer, ForeignKey("inbounds.id"), unique=True)
+    inbound = relationship("Inbounds", back_populates="guest")
+
+
+class TrialPoolInbounds(Base):
+    """Ready made guest inbounds, already loaded by x-ui, waiting for a guest."""
+    __tablename__ = "trial_pool"
+    inbound_id = Column(Integer, ForeignKey("inbounds.id"), primary_key=True)
+    created = Column(DateTime, default=datetime.now)
 
 
 class TelegramUsers(Base):
+    __tablename__ = "telegram_users"
     id = Column(Integer, primary_key=True)
     username = Column(Text, unique=True, index=True)
     bot_id = Column(Integer, ForeignKey("bot_users.id"))
@@ -105,8 +432,82 @@ class TelegramUsers(Base):
 
 class UsersInboundsRelation(Base):
     __tablename__ = "users_inbounds_relation"
+    __table_args__ = (UniqueConstraint("bot_id", "inbound_id"),)
     id = Column(Integer, primary_key=True)
     bot_id = Column(Integer, ForeignKey("bot_users.id"), 
-                    primary_key=True)
+                    nullable=False)
     inbound_id = Column(Integer, ForeignKey("inbounds.id"), 
-                        primary_key=True)
+                        nullable=False, 
+                        index=True)
+
+
+class NodeInboundsRelation(Base):
+    """Inbounds of the other x-ui nodes (see fleet.py) and the bot users they belong to."""
+    __tablename__ = "node_inbounds_relation"
+    id = Column(Integer, primary_key=True)
+    node = Column(Text, nullable=False)
+    bot_id = Column(Integer, ForeignKey("bot_users.id"), index=True)
+    # an inbounds.id of the node's own database
+    inbound_id = Column(Integer, nullable=False)
+
+
+# tables x-ui owns; the bot reads and writes them but never creates them
+XUI_TABLES = {"inbounds"}
+
+
+def schema_fingerprint() -> str:
+    """Changes whenever a table, column or primary key of the models changes."""
+    tables = sorted(
+        (table.name, sorted((column.name, column.primary_key) for column in table.columns))
+        for table in Base.metadata.sorted_tables
+    )
+    return hashlib.sha256(json.dumps(tables).encode()).hexdigest()
+
+
+def _migrate_relation_key(conn):
+    """
+        users_inbounds_relation used to have (id, bot_id, inbound_id) as its
+        primary key, so its id was never filled in. Rebuilds it with id as
+        the only key, keeping the rows.
+    """
+    key = inspect(conn).get_pk_constraint("users_inbounds_relation")["constrained_columns"]
+    if key == ["id"]:
+        return False
+    conn.execute(text("ALTER TABLE users_inbounds_relation RENAME TO users_inbounds_relation_old"))
+    # the old table's indexes keep their names, which the new table needs
+    for index in inspect(conn).get_indexes("users_inbounds_relation_old"):
+        conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+    UsersInboundsRelation.__table__.create(conn)
+    conn.execute(text(
+        "INSERT OR IGNORE INTO users_inbounds_relation (bot_id, inbound_id) "
+        "SELECT bot_id, inbound_id FROM users_inbounds_relation_old ORDER BY rowid"))
+    conn.execute(text("DROP TABLE users_inbounds_relation_old"))
+    return True
+
+
+def verify_schema(cache_path=SCHEMA_CACHE_PATH):
+    """
+        Creates the bot's tables missing from the x-ui database and updates
+        the keys of older ones. The result is remembered in cache_path for
+        this database file and these models, so later starts don't inspect
+        the database at all.
+    """
+    db_path = pathlib.Path(XUI_DB_PATH)
+    key = f"{db_path.resolve()}:{os.stat(db_path).st_ino}:{schema_fingerprint()}"
+    cache_path = pathlib.Path(cache_path)
+    if cache_path.exists() and key in cache_path.read_text().splitlines():
+        return False
+    existing = set(inspect(engine).get_table_names())
+    if not XUI_TABLES <= existing:
+        raise RuntimeError(f"{db_path} has no {', '.join(XUI_TABLES - existing)} table, "
+                           "is it an x-ui database?")
+    missing = [t for t in Base.metadata.sorted_tables if t.name not in existing]
+    if missing:
+        Base.metadata.create_all(engine, tables=missing)
+    if "users_inbounds_relation" in existing:
+        with engine.begin() as conn:
+            _migrate_relation_key(conn)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "a") as f:
+        f.write(key + "\n")
+    return True
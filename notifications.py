@@ -0,0 +1,124 @@
+"""
+    Tells users when an account is about to run out, instead of waiting for
+    them to press "وضعیت اکانت ها". Fed by snapshots.TrafficSnapshot after
+    every refresh, it only looks at the inbounds whose counters changed, and
+    keeps the upcoming expiry warnings in a heap ordered by due time.
+"""
+
+import time, heapq, asyncio, logging
+
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86400*1000
+
+
+class ThresholdNotifier:
+    """
+        sender is a senders.OutboundSender and chat_id_of(username) returns
+        where to message a user, or None. Every threshold is announced once
+        per inbound, until the quota or expiry of that inbound changes or
+        its counters are reset below the threshold.
+    """
+    def __init__(self, sender, chat_id_of, usage_thresholds=(0.8, 0.95), day_thresholds=(3, 1)):
+        self.sender = sender
+        self.chat_id_of = chat_id_of
+        self.usage_thresholds = sorted(usage_thresholds)
+        self.day_thresholds = sorted(day_thresholds, reverse=True)
+        self.sent = 0
+        # inbound id -> the usage thresholds / day thresholds already announced
+        self._usage_alerted = {}
+        self._days_alerted = {}
+        # inbound id -> the (total, expiry_time) the alerts above belong to
+        self._limits = {}
+        # (due time in ms, inbound id, days, expiry_time it was scheduled for)
+        self._due = []
+        self._seeded = False
+        self._tasks = set()
+
+    def observe(self, snapshot, now=None):
+        """Snapshot listener: collects new crossings and sends them."""
+        now_ms = (now or time.time())*1e3
+        alerts = []
+        # on the first run only remember what is already crossed, so a
+        # restart doesn't repeat every warning
+        silent = not self._seeded
+        ids = snapshot.inbounds if silent else snapshot.changed
+        for inbound_id in ids:
+            stat = snapshot.inbounds.get(inbound_id)
+            if stat is None:
+                continue
+            self._reset_if_renewed(stat)
+            alerts += self._usage_alerts(stat)
+        while self._due and self._due[0][0] <= now_ms:
+            _, inbound_id, days, expiry_time = heapq.heappop(self._due)
+            stat = snapshot.inbounds.get(inbound_id)
+            alerted = self._days_alerted.setdefault(inbound_id, set())
+            if stat is None or stat.expiry_time != expiry_time or days in alerted:
+                continue
+            alerted.add(days)
+            if stat.enable and expiry_time > now_ms:
+                alerts.append((stat, f"{days} روز تا پایان اکانت {stat.remark} باقی مانده است"))
+        self._seeded = True
+        if alerts and not silent:
+            task = asyncio.ensure_future(self._send(snapshot, alerts))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return alerts
+
+    def _reset_if_renewed(self, stat):
+        limits = (stat.total, stat.expiry_time)
+        if self._limits.get(stat.id) == limits:
+            return
+        self._limits[stat.id] = limits
+        self._usage_alerted.pop(stat.id, None)
+        self._days_alerted.pop(stat.id, None)
+        if stat.expiry_time:
+            for days in self.day_thresholds:
+                heapq.heappush(self._due, (stat.expiry_time - days*DAY_MS,
+                                           stat.id,
+                                           days,
+                                           stat.expiry_time))
+
+    def _usage_alerts(self, stat):
+        if not stat.total or not stat.enable:
+            return []
+        used = (stat.up + stat.down) / stat.total
+        alerted = self._usage_alerted.setdefault(stat.id, set())
+        # usage only goes down when x-ui reset the counters
+        alerted.difference_update([t for t in alerted if used < t])
+        crossed = [t for t in self.usage_thresholds if used >= t and t not in alerted]
+        if not crossed:
+            return []
+        alerted.update(crossed)
+        # one message for the highest threshold crossed since the last sample
+        return [(stat, f"{int(crossed[-1]*100)}٪ حجم اکانت {stat.remark} مصرف شده است")]
+
+    async def _send(self, snapshot, alerts):
+        # chat_id_of may read the sessions store
+        def resolve():
+            messages = {}
+            for stat, text in alerts:
+                for username in snapshot.owners_of(stat.id):
+                    chat_id = self.chat_id_of(username)
+                    if chat_id is not None:
+                        messages.setdefault(chat_id, []).append(text)
+            return messages
+
+        messages = await asyncio.to_thread(resolve)
+        batches = []
+        for chat_id, texts in messages.items():
+            batch = self.sender.batch(chat_id)
+            for text in texts:
+                batch.text(text)
+            batches.append(batch.send())
+        results = await asyncio.gather(*batches, return_exceptions=True)
+        self.sent += sum(1 for r in results if not isinstance(r, Exception))
+        return results
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "scheduled_expiry_warnings": len(self._due),
+        }
@@ -0,0 +1,123 @@
+"""
+    A python-telegram-bot persistence that only keeps conversation states,
+    one sqlite row per conversation key, and only writes the keys that
+    changed. The bot doesn't use user/chat/bot data, so those aren't stored.
+"""
+
+import json, asyncio, sqlite3, pathlib
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path, commit_interval=1.0, batch_size=1000, update_interval=60):
+        super().__init__(store_data=PersistenceInput(bot_data=False,
+                                                     chat_data=False,
+                                                     user_data=False,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.path = pathlib.Path(path)
+        # changed states are committed together, at the latest this many
+        # seconds after the first change or once batch_size of them piled up
+        self.commit_interval = commit_interval
+        self.batch_size = batch_size
+        self.commits = 0
+        self._dirty = {}
+        self._commit_handle = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "name TEXT NOT NULL, key TEXT NOT NULL, state TEXT, "
+            "PRIMARY KEY (name, key))"
+        )
+        self._conn.commit()
+
+    async def get_conversations(self, name):
+        # the rows are joined into one json array of key, state, key, state...
+        # by sqlite, so it's parsed in one go instead of twice per row
+        flat, = self._conn.execute(
+            "SELECT '[' || coalesce(group_concat(key || ',' || state), '') || ']' "
+            "FROM conversations WHERE name=?", (name,)).fetchone()
+        flat = iter(json.loads(flat))
+        conversations = dict(zip(map(tuple, flat), flat))
+        for (dirty_name, key), state in self._dirty.items():
+            if dirty_name != name:
+                continue
+            if state is None:
+                conversations.pop(key, None)
+            else:
+                conversations[key] = state
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty[(name, tuple(key))] = new_state
+        if len(self._dirty) >= self.batch_size:
+            self._commit()
+        elif self._commit_handle is None:
+            self._commit_handle = asyncio.get_running_loop().call_later(
+                self.commit_interval, self._commit)
+
+    def _commit(self):
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, json.dumps(key), json.dumps(state))
+                 for (name, key), state in dirty.items() if state is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM conversations WHERE name=? AND key=?",
+                [(name, json.dumps(key))
+                 for (name, key), state in dirty.items() if state is None]
+            )
+        self.commits += 1
+
+    async def flush(self):
+        self._commit()
+
+    # nothing below is stored, see store_data above
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,134 @@
+"""
+    Hands out free ports for new inbounds without scanning the inbounds table.
+
+    The free ports are only known to this process, and the provisioning cli
+    or x-ui's panel can create inbounds meanwhile. So whatever inserts
+    inbounds calls check_taken() in the same transaction, after the insert,
+    and retries with new ports on PortTaken.
+"""
+
+import random, socket, threading
+from sqlalchemy import select, func
+
+from models import engine, Inbounds, chunks
+
+
+class NoFreePort(Exception):
+    pass
+
+
+class PortTaken(Exception):
+    """Inbounds were created on these ports after they were allocated."""
+    def __init__(self, ports):
+        super().__init__(f"ports {', '.join(map(str, sorted(ports)))} were taken meanwhile")
+        self.ports = set(ports)
+
+
+def check_taken(conn, ports):
+    """
+        Raises PortTaken if more than one inbound uses any of the ports. The
+        insert before it took sqlite's write lock for the transaction, so
+        every other writer's inbounds are visible and no new ones can be
+        added until it commits.
+    """
+    ports, taken = list(ports), set()
+    for chunk in chunks(ports):
+        taken.update(conn.execute(
+            select(Inbounds.port)
+            .where(Inbounds.port.in_(chunk))
+            .group_by(Inbounds.port)
+            .having(func.count() > 1)
+        ).scalars())
+    if taken:
+        raise PortTaken(taken)
+
+
+class PortAllocator:
+    """
+        Keeps the free ports of [low, high] in a list plus a port -> index
+        map, so picking a random free port and marking one as used are both
+        O(1). Allocated ports count as used right away, so concurrent
+        creations can't get the same one; release() gives one back.
+    """
+    def __init__(self, low=10000, high=65353, check_os=False, engine=engine):
+        self.low = low
+        self.high = high
+        # also make sure nothing else on the machine listens on the port
+        self.check_os = check_os
+        # the x-ui database the ports are read from
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._free = None
+        self._index = None
+
+    def load(self):
+        """(Re)reads the ports in use from the inbounds table."""
+        with self.engine.connect() as conn:
+            used = set(conn.execute(select(Inbounds.port)).scalars())
+        free = [p for p in range(self.low, self.high+1) if p not in used]
+        with self._lock:
+            self._free = free
+            self._index = {p: i for i, p in enumerate(free)}
+
+    @property
+    def loaded(self) -> bool:
+        return self._free is not None
+
+    def _ensure_loaded(self):
+        if self._free is None:
+            self.load()
+
+    def _take(self, port):
+        # swap the port with the last free one and pop it
+        i = self._index.pop(port)
+        last = self._free.pop()
+        if last != port:
+            self._free[i] = last
+            self._index[last] = i
+
+    def allocate(self) -> int:
+        self._ensure_loaded()
+        while True:
+            with self._lock:
+                if not self._free:
+                    raise NoFreePort(f"every port in {self.low}-{self.high} is used")
+                port = self._free[random.randrange(len(self._free))]
+                self._take(port)
+            if not self.check_os or self._is_bindable(port):
+                return port
+            # taken by some other process; it stays out of the free list
+
+    def mark_used(self, port):
+        self._ensure_loaded()
+        with self._lock:
+            if port in self._index:
+                self._take(port)
+
+    def replace(self, ports, taken):
+        """Swaps the taken ones of the list of ports for new ones, in place."""
+        for i, port in enumerate(ports):
+            if port in taken:
+                # the taken port stays out of the free ones
+                ports[i] = self.allocate()
+
+    def release(self, port):
+        """Gives back a port whose inbound wasn't created after all."""
+        self._ensure_loaded()
+        with self._lock:
+            if self.low <= port <= self.high and port not in self._index:
+                self._index[port] = len(self._free)
+                self._free.append(port)
+
+    @property
+    def free_count(self) -> int:
+        self._ensure_loaded()
+        return len(self._free)
+
+    @staticmethod
+    def _is_bindable(port) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.bind(("0.0.0.0", port))
+            except OSError:
+                return False
+        return True
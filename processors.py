@@ -0,0 +1,63 @@
+"""
+    Runs telegram updates concurrently, at most `max_concurrent_updates` at
+    a time, while the updates of one chat still run one after another in
+    the order they arrived. The ConversationHandler relies on that order.
+"""
+
+import sys, asyncio, weakref
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates=64):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        # process_update's own semaphore is sized from the property and lets
+        # every update in, the slots are taken once the update's chat is free
+        self._workers = sys.maxsize
+        super().__init__(sys.maxsize)
+        self._workers = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat id -> lock of its updates, dropped once no update holds it
+        self._chat_locks = weakref.WeakValueDictionary()
+        self.processed = 0
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._workers
+
+    @staticmethod
+    def _chat_id(update):
+        if isinstance(update, Update) and update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._slots:
+                await coroutine
+        else:
+            # process_update lets the updates in in the order they arrived and
+            # the lock is handed over in the order it was asked for. Only the
+            # update holding its chat's lock waits for a slot, so a chat with
+            # many queued updates takes one slot at most.
+            lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+            async with lock, self._slots:
+                await coroutine
+        self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "processed": self.processed,
+            "chats_in_flight": len(self._chat_locks),
+        }
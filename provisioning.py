@@ -0,0 +1,211 @@
+"""
+    Creates many accounts at once: an inbound and a bot user with a login
+    code for every row of a csv or json file, all in one transaction and
+    followed by a single x-ui reload. With several x-ui nodes (see fleet.py)
+    the inbounds are spread over them by load, one reload per node.
+
+    usage: python provisioning.py accounts.csv [--output codes.csv] [--no-reload]
+
+    The input has the columns/keys protocol (vless, vmess or trojan), remark,
+    quota (GB) and days.
+"""
+
+import csv, sys, json, time, argparse
+from sqlalchemy import select, delete
+
+from models import (engine,
+                    Inbounds,
+                    BotUsers,
+                    UsersInboundsRelation,
+                    NodeInboundsRelation,
+                    chunks)
+from backends import InboundsBackend, fleet, PROTOCOLS
+from ports import PortTaken, check_taken
+from utils import random_str
+
+
+def _unused_login_codes(conn, count):
+    codes = set()
+    while len(codes) < count:
+        candidates = {random_str() for _ in range(count-len(codes))} - codes
+        taken = set()
+        for chunk in chunks(list(candidates)):
+            taken.update(conn.execute(
+                select(BotUsers.login_code).where(BotUsers.login_code.in_(chunk))
+            ).scalars())
+        codes |= candidates - taken
+    return list(codes)
+
+
+def _inbound_row(account, node, port):
+    return InboundsBackend.inbound_values(account["protocol"],
+                                          account["remark"],
+                                          port,
+                                          int(account.get("quota") or 0),
+                                          int(account.get("days") or 0),
+                                          host=node.host)
+
+
+def _insert_inbounds(conn, rows) -> dict:
+    """
+        Inserts the inbounds, returns their ids by port. Raises PortTaken if
+        another process created inbounds on some of the ports meanwhile.
+    """
+    conn.execute(Inbounds.__table__.insert(), rows)
+    ports, inbound_ids = [row["port"] for row in rows], {}
+    check_taken(conn, ports)
+    for chunk in chunks(ports):
+        inbound_ids.update(conn.execute(
+            select(Inbounds.port, Inbounds.id).where(Inbounds.port.in_(chunk))
+        ).all())
+    return inbound_ids
+
+
+def _create_bot_users(nodes, ports, rows, inbound_ids):
+    """
+        Inserts the local node's inbounds and a bot user owning each account's
+        inbound, in one transaction. Returns the bot ids by login code and
+        the codes in the order of the accounts.
+    """
+    with engine.begin() as conn:
+        if fleet.local in nodes:
+            inbound_ids[fleet.local.name] = _insert_inbounds(
+                conn, [row for row, n in zip(rows, nodes) if n is fleet.local])
+
+        codes = _unused_login_codes(conn, len(nodes))
+        conn.execute(BotUsers.__table__.insert(),
+                     [{"login_code": code} for code in codes])
+        bot_ids = {}
+        for chunk in chunks(codes):
+            bot_ids.update(conn.execute(
+                select(BotUsers.login_code, BotUsers.id)
+                .where(BotUsers.login_code.in_(chunk))
+            ).all())
+
+        relations, node_relations = [], []
+        for code, node, port in zip(codes, nodes, ports):
+            relation = {"bot_id": bot_ids[code], "inbound_id": inbound_ids[node.name][port]}
+            if node is fleet.local:
+                relations.append(relation)
+            else:
+                node_relations.append({"node": node.name, **relation})
+        if relations:
+            conn.execute(UsersInboundsRelation.__table__.insert(), relations)
+        if node_relations:
+            conn.execute(NodeInboundsRelation.__table__.insert(), node_relations)
+    return bot_ids, codes
+
+
+def provision(accounts, reload=True):
+    """
+        Takes dicts with protocol, remark, quota and days and returns one
+        dict per account with its remark, protocol, node, port, inbound_id,
+        bot_id and login_code. Every inbound goes to the least loaded node.
+    """
+    if not accounts:
+        return []
+    check_accounts(accounts)
+    nodes = fleet.place(len(accounts))
+    # the nodes used, local one first if at all
+    used_nodes = list(dict.fromkeys(sorted(nodes, key=lambda node: node is not fleet.local)))
+    # node name -> {port: inbound id}
+    ports, inbound_ids = [], {}
+
+    def replace_taken(node, taken):
+        # the taken ports stay out of the node's free ones
+        for i, (account, n, port) in enumerate(zip(accounts, nodes, ports)):
+            if n is node and port in taken:
+                ports[i] = node.ports.allocate()
+                rows[i] = _inbound_row(account, node, ports[i])
+
+    try:
+        for node in nodes:
+            ports.append(node.ports.allocate())
+        rows = [_inbound_row(account, node, port)
+                for account, node, port in zip(accounts, nodes, ports)]
+        # the other nodes' inbounds are written first and removed again if
+        # the bot users can't be created
+        for node in used_nodes:
+            while node is not fleet.local:
+                try:
+                    with node.engine.begin() as conn:
+                        inbound_ids[node.name] = _insert_inbounds(
+                            conn, [row for row, n in zip(rows, nodes) if n is node])
+                    break
+                except PortTaken as e:
+                    replace_taken(node, e.ports)
+        while True:
+            try:
+                bot_ids, codes = _create_bot_users(nodes, ports, rows, inbound_ids)
+                break
+            except PortTaken as e:
+                replace_taken(fleet.local, e.ports)
+    except Exception:
+        for node in used_nodes:
+            if node is not fleet.local and node.name in inbound_ids:
+                with node.engine.begin() as conn:
+                    for chunk in chunks(list(inbound_ids[node.name].values())):
+                        conn.execute(delete(Inbounds).where(Inbounds.id.in_(chunk)))
+        for node, port in zip(nodes, ports):
+            node.ports.release(port)
+        raise
+    if reload:
+        for node in used_nodes:
+            node.reloader.request()
+    return [
+        {
+            "remark": row["remark"],
+            "protocol": row["protocol"],
+            "node": node.name,
+            "port": port,
+            "inbound_id": inbound_ids[node.name][port],
+            "bot_id": bot_ids[code],
+            "login_code": code,
+        }
+        for row, node, port, code in zip(rows, nodes, ports, codes)
+    ]
+
+
+def check_accounts(accounts):
+    """Raises ValueError naming the accounts whose protocol isn't supported."""
+    unsupported = [f"{i} ({account.get('protocol')!r})"
+                   for i, account in enumerate(accounts, 1)
+                   if account.get("protocol") not in PROTOCOLS]
+    if unsupported:
+        raise ValueError(f"unsupported protocol in account {', '.join(unsupported)}, "
+                         f"expected one of {', '.join(PROTOCOLS)}")
+
+
+def read_accounts(path):
+    with open(path, newline="") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        return list(csv.DictReader(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("accounts", help="a .csv or .json file")
+    parser.add_argument("--output", help="where to write the login codes, default stdout")
+    parser.add_argument("--no-reload", action="store_true")
+    args = parser.parse_args()
+
+    accounts = read_accounts(args.accounts)
+    try:
+        check_accounts(accounts)
+    except ValueError as e:
+        parser.error(str(e))
+    started = time.perf_counter()
+    created = provision(accounts, reload=not args.no_reload)
+    elapsed = time.perf_counter() - started
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.DictWriter(output, fieldnames=list(created[0]) if created else ["remark"])
+    writer.writeheader()
+    writer.writerows(created)
+    if args.output:
+        output.close()
+    print(f"created {len(created)} accounts in {elapsed:.2f}s "
+          f"({len(created)/elapsed if elapsed else 0:.1f} accounts/s)",
+          file=sys.stderr)
@@ -0,0 +1,135 @@
+"""
+    Coalesces x-ui restarts. Every change to the inbounds asks for a reload,
+    and all the requests made within the debounce window are applied by a
+    single run of the reload command.
+"""
+
+import time, shlex, asyncio, logging, threading, subprocess
+from concurrent.futures import Future
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReloadError(Exception):
+    pass
+
+
+class XUIReloader:
+    def __init__(self, command="systemctl restart x-ui", debounce=2.0, max_delay=10.0):
+        self.command = command
+        # wait this long after the last request before reloading, but never
+        # longer than max_delay after the first one
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.loop = None
+        self.requests = 0
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload = None
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._first_request = None
+        self._timer = None
+        self._running = False
+
+    def start(self, loop=None):
+        """Binds the reloader to the event loop it'll run the command on."""
+        self.loop = loop or asyncio.get_running_loop()
+
+    def request(self) -> Future:
+        """
+            Asks for a reload, safe to call from any thread. The returned
+            future is resolved once a reload that includes this change ran.
+            Without a started loop the reload runs right away, blocking.
+        """
+        future = Future()
+        with self._lock:
+            self.requests += 1
+            self._waiters.append(future)
+        if self.loop is None:
+            self._finish(self._waiters_to_run(), self.reload_sync)
+        else:
+            self.loop.call_soon_threadsafe(self._arm)
+        return future
+
+    async def arequest(self):
+        """Asks for a reload and waits until it was applied."""
+        return await asyncio.wrap_future(self.request())
+
+    def reload_sync(self):
+        subprocess.run(shlex.split(self.command), check=True)
+
+    def _waiters_to_run(self):
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+            self._first_request = None
+        return waiters
+
+    def _arm(self):
+        now = time.monotonic()
+        if self._first_request is None:
+            self._first_request = now
+        if self._running:
+            # picked up again once the running reload finishes
+            return
+        if self._timer:
+            self._timer.cancel()
+        delay = min(self.debounce, self._first_request + self.max_delay - now)
+        self._timer = self.loop.call_later(max(delay, 0), self._fire)
+
+    def _fire(self):
+        self._timer = None
+        if not self._waiters:
+            # already applied by the reload that was running when we armed
+            self._first_request = None
+            return
+        self._running = True
+        asyncio.ensure_future(self._reload(), loop=self.loop)
+
+    async def _reload(self):
+        waiters = self._waiters_to_run()
+        try:
+            await self._run_command()
+        except Exception as e:
+            self._finish(waiters, error=e)
+        else:
+            self._finish(waiters)
+        finally:
+            self._running = False
+            if self._waiters:
+                self._arm()
+
+    async def _run_command(self):
+        process = await asyncio.create_subprocess_exec(*shlex.split(self.command))
+        returncode = await process.wait()
+        if returncode != 0:
+            raise ReloadError(f"{self.command!r} exited with {returncode}")
+
+    def _finish(self, waiters, function=None, error=None):
+        if function is not None:
+            try:
+                function()
+            except Exception as e:
+                error = e
+        self.last_reload = time.time()
+        if error is None:
+            self.reloads += 1
+        else:
+            self.failures += 1
+            logger.error("reloading x-ui failed: %s", error)
+        for future in waiters:
+            if error is None:
+                future.set_result(self.last_reload)
+            else:
+                future.set_exception(error)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "pending": len(self._waiters),
+            "last_reload": self.last_reload,
+        }
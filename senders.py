@@ -0,0 +1,272 @@
+"""
+    A queue in front of the telegram api. Messages for a chat are merged
+    (consecutive texts into one message, consecutive photos into a media
+    group) and sent within telegram's global and per chat rate limits.
+"""
+
+import time, asyncio, logging
+from collections import deque
+from telegram import InputMediaPhoto
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+
+from metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+MAX_TEXT_LENGTH = 4096
+MAX_MEDIA_GROUP = 10
+MAX_RETRIES = 3
+
+
+class MeteredRequest(HTTPXRequest):
+    """Records the latency of every bot api call, labelled with its method."""
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            registry.inc("telegram_api_errors_total", method=api_method)
+            raise
+        finally:
+            registry.histogram("telegram_api_seconds",
+                               method=api_method).observe(time.perf_counter() - started)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens-self.tokens) / self.rate)
+
+
+class _Outgoing:
+    __slots__ = ("kind", "content", "caption", "reply_markup", "future")
+
+    def __init__(self, kind, content, caption=None, reply_markup=None):
+        self.kind = kind
+        self.content = content
+        self.caption = caption
+        self.reply_markup = reply_markup
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Batch:
+    """Messages for one chat that are queued together and in order."""
+    def __init__(self, sender, chat_id):
+        self.sender = sender
+        self.chat_id = chat_id
+        self.items = []
+
+    def text(self, text, reply_markup=None):
+        self.items.append(_Outgoing("text", text, reply_markup=reply_markup))
+        return self
+
+    def photo(self, photo, caption=None, reply_markup=None):
+        self.items.append(_Outgoing("photo", photo, caption, reply_markup))
+        return self
+
+    def document(self, document, caption=None, reply_markup=None):
+        self.items.append(_Outgoing("document", document, caption, reply_markup))
+        return self
+
+    async def send(self):
+        """Queues the batch and waits until all of it was delivered.
+        Returns the sent telegram messages, one per queued item."""
+        self.sender.submit(self.chat_id, self.items)
+        return await asyncio.gather(*[i.future for i in self.items])
+
+
+class OutboundSender:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=8):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.bot = None
+        self._chat_buckets = {}
+        self._pending = {}
+        # chats that are queued in _ready or being sent by a worker
+        self._scheduled = set()
+        self._ready = None
+        self._tasks = []
+        self.submitted = 0
+        self.api_calls = 0
+        self.retries = 0
+        self.failed = 0
+        self._sent_times = deque()
+
+    def start(self, bot):
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def batch(self, chat_id):
+        return Batch(self, chat_id)
+
+    def submit(self, chat_id, items):
+        self._pending.setdefault(chat_id, deque()).extend(items)
+        self.submitted += len(items)
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+
+    async def _work(self):
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                # items submitted while we're sending land in a new deque
+                # and are picked up by the next round
+                while self._pending.get(chat_id):
+                    items = self._pending.pop(chat_id)
+                    try:
+                        for call in self._merge(items):
+                            await self._send(chat_id, call)
+                    except Exception as e:
+                        # whatever the round didn't deliver fails instead of
+                        # leaving its senders waiting forever
+                        logger.exception("sending to %s failed", chat_id)
+                        self._fail(items, e)
+            finally:
+                self._scheduled.discard(chat_id)
+
+    @staticmethod
+    def _merge(items):
+        """Groups queued items into as few api calls as possible, keeping order."""
+        calls = []
+        for item in items:
+            last = calls[-1] if calls else None
+            if (
+                item.kind == "text" and last and last[0] == "text"
+                and sum(len(i.content)+2 for i in last[1]) + len(item.content) <= MAX_TEXT_LENGTH
+            ):
+                last[1].append(item)
+            elif (
+                item.kind == "photo" and item.reply_markup is None
+                and last and last[0] == "media_group"
+                and len(last[1]) < MAX_MEDIA_GROUP
+            ):
+                last[1].append(item)
+            elif item.kind == "photo" and item.reply_markup is None:
+                calls.append(("media_group", [item]))
+            else:
+                calls.append((item.kind, [item]))
+        return calls
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    k: v for k, v in self._chat_buckets.items() if not v.full
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate,
+                                                               self.chat_burst)
+        return bucket
+
+    async def _call_api(self, chat_id, kind, items):
+        for item in items:
+            # rewind buffers that a previous, rate limited attempt consumed
+            if hasattr(item.content, "seek"):
+                item.content.seek(0)
+        first = items[0]
+        reply_markup = next(
+            (i.reply_markup for i in reversed(items) if i.reply_markup is not None),
+            None
+        )
+        if kind == "text":
+            message = await self.bot.send_message(chat_id,
+                                                  "\n\n".join(i.content for i in items),
+                                                  reply_markup=reply_markup)
+            return [message] * len(items)
+        if kind == "media_group" and len(items) > 1:
+            return list(await self.bot.send_media_group(
+                chat_id,
+                [InputMediaPhoto(i.content, caption=i.caption) for i in items]
+            ))
+        if kind in ("photo", "media_group"):
+            return [await self.bot.send_photo(chat_id,
+                                              first.content,
+                                              caption=first.caption,
+                                              reply_markup=first.reply_markup)]
+        return [await self.bot.send_document(chat_id,
+                                             first.content,
+                                             caption=first.caption,
+                                             reply_markup=first.reply_markup)]
+
+    async def _send(self, chat_id, call):
+        kind, items = call
+        messages = 1 if kind == "text" else len(items)
+        for attempt in range(MAX_RETRIES+1):
+            await self.global_bucket.acquire(messages)
+            await self._chat_bucket(chat_id).acquire(messages)
+            try:
+                result = await self._call_api(chat_id, kind, items)
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    return self._fail(items, e)
+                self.retries += 1
+                retry_after = e.retry_after
+                await asyncio.sleep(getattr(retry_after, "total_seconds", lambda: retry_after)())
+                continue
+            except Exception as e:
+                logger.exception("sending to %s failed", chat_id)
+                return self._fail(items, e)
+            self.api_calls += 1
+            self._sent_times.append(time.monotonic())
+            for item, message in zip(items, result):
+                if not item.future.done():
+                    item.future.set_result(message)
+            return
+
+    def _fail(self, items, error):
+        for item in items:
+            if not item.future.done():
+                self.failed += 1
+                item.future.set_exception(error)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(i) for i in self._pending.values())
+
+    @property
+    def stats(self) -> dict:
+        now = time.monotonic()
+        while self._sent_times and now - self._sent_times[0] > 60:
+            self._sent_times.popleft()
+        return {
+            "queue_depth": self.queue_depth,
+            "submitted": self.submitted,
+            "api_calls": self.api_calls,
+            "retries": self.retries,
+            "failed": self.failed,
+            "calls_per_second": len(self._sent_times) / 60,
+        }
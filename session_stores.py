@@ -0,0 +1,167 @@
+"""
+    Storage behind backends.UserSession.
+
+    SQLiteSessionStore keeps every user's session in one sqlite file and
+    coalesces writes: saves are buffered and flushed together, in a single
+    transaction, every `flush_interval` seconds. PickleFileStore is the old
+    one-pickle-per-user layout, kept so existing sessions can be migrated:
+
+        python session_stores.py migrate
+"""
+
+import os, atexit, pickle, pathlib, sqlite3, argparse, threading
+
+
+class PickleFileStore:
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, username):
+        return self.directory.joinpath(f"{username}.pickle")
+
+    def load(self, username) -> dict:
+        try:
+            with open(self._path(username), "rb") as f:
+                return dict(pickle.load(f))
+        except FileNotFoundError:
+            return {}
+
+    def save(self, username, data):
+        path = self._path(username)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(dict(data), f)
+        os.replace(tmp_path, path)
+
+    def delete(self, username):
+        try:
+            self._path(username).unlink()
+        except FileNotFoundError:
+            pass
+
+    def usernames(self):
+        return [p.stem for p in self.directory.glob("*.pickle")]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    def __init__(self, path, flush_interval=1.0):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self._lock = threading.Lock()
+        # username -> pickled data, or None for a pending delete
+        self._dirty = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "username TEXT PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name="session-flusher",
+                                             daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def load(self, username) -> dict:
+        with self._lock:
+            if username in self._dirty:
+                data = self._dirty[username]
+            else:
+                row = self._conn.execute("SELECT data FROM sessions WHERE username=?",
+                                         (username,)).fetchone()
+                data = row[0] if row else None
+        return pickle.loads(data) if data is not None else {}
+
+    def save(self, username, data):
+        blob = pickle.dumps(dict(data))
+        with self._lock:
+            self._dirty[username] = blob
+        if not self.flush_interval:
+            self.flush()
+
+    def delete(self, username):
+        with self._lock:
+            self._dirty[username] = None
+        if not self.flush_interval:
+            self.flush()
+
+    def usernames(self):
+        self.flush()
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT username FROM sessions")]
+
+    def flush(self):
+        """Writes every buffered change in one transaction."""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO sessions (username, data) VALUES (?, ?)",
+                        [(u, d) for u, d in dirty.items() if d is not None]
+                    )
+                    self._conn.executemany(
+                        "DELETE FROM sessions WHERE username=?",
+                        [(u,) for u, d in dirty.items() if d is None]
+                    )
+            except Exception:
+                # keep the changes around for the next attempt, unless
+                # they were overwritten in the meantime
+                dirty.update(self._dirty)
+                self._dirty = dirty
+                raise
+            self.flushes += 1
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+        self._conn.close()
+
+
+def migrate(source, target):
+    """Copies every session of source into target, returns how many were copied."""
+    usernames = source.usernames()
+    for username in usernames:
+        target.save(username, source.load(username))
+    target.flush()
+    return len(usernames)
+
+
+if __name__ == "__main__":
+    from configs import BOT_SESSIONS_PATH, BOT_SESSIONS_DB
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--source", default=BOT_SESSIONS_PATH,
+                        help="directory of the {username}.pickle files")
+    parser.add_argument("--target", default=BOT_SESSIONS_DB,
+                        help="the sqlite file to copy them into")
+    args = parser.parse_args()
+
+    target = SQLiteSessionStore(args.target, flush_interval=0)
+    count = migrate(PickleFileStore(args.source), target)
+    target.close()
+    print(f"migrated {count} sessions into {args.target}")
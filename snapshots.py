@@ -0,0 +1,206 @@
+"""
+    An in-memory copy of the traffic counters of every inbound, refreshed in
+    the background so the stats buttons don't have to query x-ui's database.
+"""
+
+import time, asyncio, logging
+from datetime import datetime
+from sqlalchemy import select
+
+from models import engine, Inbounds, TelegramUsers, GuestUsers, UsersInboundsRelation
+
+
+logger = logging.getLogger(__name__)
+
+
+class InboundStat:
+    """
+        The counters of one inbound. It has the same attribute names as
+        models.Inbounds so either can be passed to code that only reads stats.
+    """
+    __slots__ = ("id",
+                 "remark",
+                 "protocol",
+                 "up",
+                 "down",
+                 "total",
+                 "expiry_time",
+                 "enable")
+
+    def __init__(self, id, remark, protocol, up, down, total, expiry_time, enable):
+        self.id = id
+        self.remark = remark
+        self.protocol = protocol
+        self.up = up or 0
+        self.down = down or 0
+        self.total = total or 0
+        self.expiry_time = expiry_time
+        self.enable = enable
+
+    def update(self, remark, protocol, up, down, total, expiry_time, enable) -> bool:
+        """Sets the columns, returns whether the counters, quota, expiry or protocol changed."""
+        up, down, total = up or 0, down or 0, total or 0
+        changed = (self.up, self.down, self.total, self.expiry_time, self.protocol) != (
+            up, down, total, expiry_time, protocol)
+        self.remark = remark
+        self.protocol = protocol
+        self.up = up
+        self.down = down
+        self.total = total
+        self.expiry_time = expiry_time
+        self.enable = enable
+        return changed
+
+    @property
+    def remaining_traffic(self) -> int:
+        return self.total - (self.down + self.up)
+
+    @property
+    def expires_in(self) -> int:
+        """Returns number of days left to the expiration, None if it never expires."""
+        if not self.expiry_time:
+            return None
+        expiry = datetime.fromtimestamp(self.expiry_time*1e-3)
+        return (expiry-datetime.now()).days
+
+
+class TrafficSnapshot:
+    def __init__(self, stale_after=None):
+        # serve from memory only while the last refresh is younger than this
+        self.stale_after = stale_after
+        self.refreshed_at = None
+        self.inbounds = {}
+        self._bot_inbounds = {}
+        self._user_bots = {}
+        self._guest_inbounds = {}
+        self._inbound_owners = {}
+        self._inbound_accounts = {}
+        self._links = None
+        # ids whose counters, quota, expiry or protocol changed in the last refresh
+        self.changed = []
+        # ids whose bot user or guest changed in the last refresh
+        self.reowned = []
+        # whether logins, guests or which inbounds bot users have changed
+        self.links_changed = False
+        # called with the snapshot, on the event loop, after every refresh
+        self.listeners = []
+        self._wanted = None
+
+    @property
+    def ready(self) -> bool:
+        if self.refreshed_at is None:
+            return False
+        if self.stale_after is None:
+            return True
+        return time.monotonic() - self.refreshed_at < self.stale_after
+
+    def refresh(self):
+        """Reads the counter columns and the user links, updating stats in place."""
+        inbounds_stmt = select(Inbounds.id,
+                               Inbounds.remark,
+                               Inbounds.protocol,
+                               Inbounds.up,
+                               Inbounds.down,
+                               Inbounds.total,
+                               Inbounds.expiry_time,
+                               Inbounds.enable)
+        with engine.connect() as conn:
+            rows = conn.execute(inbounds_stmt).all()
+            relations = conn.execute(select(UsersInboundsRelation.bot_id,
+                                            UsersInboundsRelation.inbound_id)).all()
+            users = conn.execute(select(TelegramUsers.username,
+                                        TelegramUsers.bot_id)).all()
+            guests = conn.execute(select(GuestUsers.username,
+                                         GuestUsers.inbound_id)).all()
+
+        inbounds, changed = {}, []
+        for row in rows:
+            stat = self.inbounds.get(row.id)
+            if stat is None:
+                stat = InboundStat(*row)
+                changed.append(row.id)
+            elif stat.update(*row[1:]):
+                changed.append(row.id)
+            inbounds[row.id] = stat
+        bot_inbounds, bot_usernames, inbound_owners, inbound_accounts = {}, {}, {}, {}
+        for username, bot_id in users:
+            bot_usernames.setdefault(bot_id, []).append(username)
+        for bot_id, inbound_id in relations:
+            bot_inbounds.setdefault(bot_id, []).append(inbound_id)
+            inbound_owners.setdefault(inbound_id, []).extend(bot_usernames.get(bot_id, ()))
+            inbound_accounts.setdefault(inbound_id, ("bot", bot_id))
+        guest_inbounds = {}
+        for username, inbound_id in guests:
+            guest_inbounds.setdefault(username, []).append(inbound_id)
+            inbound_owners.setdefault(inbound_id, []).append(username)
+            inbound_accounts.setdefault(inbound_id, ("guest", username))
+        links = (relations, users, guests)
+        links_changed = links != self._links
+        reowned = []
+        if links_changed:
+            previous = self._inbound_accounts
+            reowned = [i for i in previous.keys() | inbound_accounts.keys()
+                       if previous.get(i) != inbound_accounts.get(i)]
+
+        self.inbounds = inbounds
+        self.changed = changed
+        self.reowned = reowned
+        self.links_changed = links_changed
+        self._links = links
+        self._bot_inbounds = bot_inbounds
+        self._user_bots = dict(users)
+        self._guest_inbounds = guest_inbounds
+        self._inbound_owners = inbound_owners
+        self._inbound_accounts = inbound_accounts
+        self.refreshed_at = time.monotonic()
+
+    def of_bot(self, bot_id):
+        return [
+            self.inbounds[i]
+            for i in self._bot_inbounds.get(bot_id, ())
+            if i in self.inbounds
+        ]
+
+    def owners_of(self, inbound_id):
+        """Usernames of the telegram users and the guest the inbound belongs to."""
+        return self._inbound_owners.get(inbound_id, ())
+
+    def account_of(self, inbound_id):
+        """("bot", bot id) or ("guest", username) the inbound belongs to, or None."""
+        return self._inbound_accounts.get(inbound_id)
+
+    def trial_conversions(self) -> tuple:
+        """How many guests there are and how many of them also log into a bot user."""
+        guests = self._guest_inbounds
+        return len(guests), sum(1 for username in guests if self._user_bots.get(username))
+
+    def of_username(self, username):
+        """Inbounds of the bot user the username is logged into, and its guest inbound."""
+        ids = list(self._bot_inbounds.get(self._user_bots.get(username), ()))
+        ids += [i for i in self._guest_inbounds.get(username, ()) if i not in ids]
+        return [self.inbounds[i] for i in ids if i in self.inbounds]
+
+    def request_refresh(self):
+        """Makes poll() refresh now instead of at its next interval."""
+        if self._wanted is not None:
+            self._wanted.set()
+
+    async def poll(self, interval):
+        """
+            Refreshes every `interval` seconds, or sooner when asked to by
+            request_refresh(). Runs on the default executor, not the
+            handlers' db pool.
+        """
+        self._wanted = asyncio.Event()
+        while True:
+            self._wanted.clear()
+            try:
+                await asyncio.to_thread(self.refresh)
+                for listener in self.listeners:
+                    listener(self)
+            except Exception:
+                logger.exception("refreshing the traffic snapshot failed")
+            try:
+                await asyncio.wait_for(self._wanted.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
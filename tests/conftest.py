@@ -0,0 +1,121 @@
+"""
+    The tests run against a throwaway sqlite file shaped like the x-ui
+    database, like benchmarks.py. models binds its engine at import time, so
+    everything is pointed at a temporary directory before the project is
+    imported.
+"""
+
+import os, sys, json, uuid, tempfile, pathlib
+
+_tmp = tempfile.mkdtemp(prefix="xui-tests-")
+os.environ["XUI_DB_PATH"] = os.path.join(_tmp, "x-ui.db")
+os.environ["XUI_URL"] = "tests.example.com:443"
+os.environ["SCHEMA_CACHE_PATH"] = os.path.join(_tmp, "schema")
+os.environ["BOT_SESSIONS_PATH"] = os.path.join(_tmp, "sessions")
+os.environ["BOT_SESSIONS_DB"] = os.path.join(_tmp, "sessions", "sessions.db")
+os.environ["BOT_PERSISTENCE_DB"] = os.path.join(_tmp, "persistence.db")
+os.environ["TRAFFIC_HISTORY_DB"] = os.path.join(_tmp, "history.db")
+os.environ["AGGREGATES_DB"] = os.path.join(_tmp, "aggregates.db")
+os.environ["BROADCASTS_DB"] = os.path.join(_tmp, "broadcasts.db")
+os.environ["XUI_RELOAD_COMMAND"] = "true"
+os.environ["XUI_NODE_RELOAD_COMMAND"] = "true"
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import pytest
+
+
+@pytest.fixture
+def db():
+    """Empty tables, and the in-memory caches built on them emptied too."""
+    from models import engine, Base, login_url_cache
+    from backends import auth_cache, port_allocator, guest_locks, _known_chat_ids
+
+    engine.dispose()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    auth_cache.clear()
+    login_url_cache.clear()
+    guest_locks.clear()
+    _known_chat_ids.clear()
+    port_allocator.load()
+    yield engine
+
+
+class RecordingSender:
+    """Stands in for senders.OutboundSender, records (chat id, text) of every message."""
+    def __init__(self):
+        self.sent = []
+
+    def batch(self, chat_id):
+        sender, texts = self, []
+
+        class Batch:
+            def text(self, text):
+                texts.append(text)
+                return self
+
+            async def send(self):
+                sender.sent += [(chat_id, text) for text in texts]
+        return Batch()
+
+
+def inbound_row(port, remark=None, **columns):
+    """Column values of an inbound for the fixture, like x-ui writes them."""
+    return {
+        "up": 0,
+        "down": 0,
+        "total": 2**34,
+        "remark": remark or f"inbound{port}",
+        "enable": True,
+        "expiry_time": 0,
+        "port": port,
+        "protocol": "vless",
+        "settings": json.dumps({"clients": [{"id": str(uuid.uuid4())}]}),
+        "stream_settings": json.dumps({"network": "tcp", "security": "tls"}),
+        "tag": f"inbound-{port}",
+        "sniffing": json.dumps({"enabled": True}),
+        **columns,
+    }
+
+
+@pytest.fixture
+def logged_in(db):
+    """
+        A bot user with two inbounds and the telegram account "alice" logged
+        into it. Returns the bot user's id.
+    """
+    from models import Inbounds, BotUsers, TelegramUsers, UsersInboundsRelation
+
+    with db.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(),
+                     [inbound_row(20001, "alice_vless"),
+                      inbound_row(20002, "alice_vmess", protocol="vmess")])
+        conn.execute(BotUsers.__table__.insert(), [{"id": 1, "login_code": "code1"}])
+        conn.execute(TelegramUsers.__table__.insert(),
+                     [{"username": "alice", "bot_id": 1, "is_auth": True}])
+        conn.execute(UsersInboundsRelation.__table__.insert(),
+                     [{"bot_id": 1, "inbound_id": 1}, {"bot_id": 1, "inbound_id": 2}])
+    return 1
+
+
+@pytest.fixture
+def two_nodes(db, tmp_path, monkeypatch):
+    """
+        A fleet of the local node and two more, node1 and node2, each an
+        empty x-ui database in tmp_path. Returns the fleet.
+    """
+    import backends, provisioning
+    from fleet import Fleet
+    from models import Inbounds
+
+    nodes = [backends.fleet.local]
+    for name in ("node1", "node2"):
+        node = backends._remote_node(name, tmp_path/f"{name}.db", f"{name}.example.com:443")
+        Inbounds.__table__.create(node.engine)
+        nodes.append(node)
+    fleet = Fleet(nodes)
+    monkeypatch.setattr(backends, "fleet", fleet)
+    monkeypatch.setattr(provisioning, "fleet", fleet)
+    yield fleet
+    for node in fleet.remote:
+        node.engine.dispose()
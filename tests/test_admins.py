@@ -0,0 +1,163 @@
+import time, asyncio
+
+from models import TelegramUsers, GuestUsers
+from senders import OutboundSender
+from admins import recipients_after, Broadcaster, BroadcastStore, BroadcastTaken
+
+
+def fill(db, telegram_users, guests):
+    with db.begin() as conn:
+        conn.execute(TelegramUsers.__table__.insert(),
+                     [{"username": username} for username in telegram_users])
+        conn.execute(GuestUsers.__table__.insert(),
+                     [{"username": username} for username in guests])
+
+
+def test_recipients_pages(db):
+    fill(db, [f"user{i:03}" for i in range(0, 100, 2)] + ["both"],
+         [f"user{i:03}" for i in range(1, 100, 2)] + ["both", None])
+    pages, after = [], None
+    with db.connect() as conn:
+        while page := recipients_after(conn, after, 7):
+            pages.append(page)
+            after = page[-1]
+
+    assert sum(pages, []) == ["both"] + [f"user{i:03}" for i in range(100)]
+    assert all(len(page) == 7 for page in pages[:-1])
+
+
+def test_recipients_page_cost(db):
+    def steps():
+        """sqlite vm steps a page from the start takes."""
+        counted = [0]
+
+        def count():
+            counted[0] += 1
+
+        with db.connect() as conn:
+            raw = conn.connection.driver_connection
+            raw.set_progress_handler(count, 1)
+            try:
+                recipients_after(conn, None, 10)
+            finally:
+                raw.set_progress_handler(None, 1)
+        return counted[0]
+
+    fill(db, [f"a{i:05}" for i in range(20)], [f"b{i:05}" for i in range(20)])
+    few = steps()
+    fill(db, [f"a{i:05}" for i in range(20, 5000)], [f"b{i:05}" for i in range(20, 5000)])
+
+    # each table only gives its first 10, however many there are
+    assert steps() < 2*few
+
+
+class Bot:
+    """
+        Stands in for telegram's Bot behind a senders.OutboundSender, records
+        the chat ids messaged. After `hang_after` messages it stops answering.
+    """
+    def __init__(self, hang_after=None):
+        self.chat_ids = []
+        self.hang_after = hang_after
+        self.hanging = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.hang_after is not None and len(self.chat_ids) >= self.hang_after:
+            self.hanging.set()
+            await asyncio.Event().wait()
+        self.chat_ids.append(chat_id)
+        return (chat_id, text)
+
+
+async def broadcast(bot, broadcaster, broadcast_id):
+    """Runs the broadcast through an OutboundSender started on bot."""
+    broadcaster.sender.start(bot)
+    try:
+        return await broadcaster.run(broadcast_id)
+    finally:
+        await broadcaster.sender.stop()
+
+
+def broadcaster(tmp_path, **kwargs):
+    sender = OutboundSender(global_rate=1000, chat_rate=1000, chat_burst=1000, workers=4)
+    return Broadcaster(sender, lambda username: ord(username[-1]),
+                       store=BroadcastStore(tmp_path/"broadcasts.db"), rate=1000, **kwargs)
+
+
+def test_one_process_sends_a_broadcast(db, tmp_path):
+    fill(db, ["a", "b", "c"], ["d"])
+    bot, sending = Bot(), broadcaster(tmp_path, batch_size=2)
+    other = BroadcastStore(tmp_path/"broadcasts.db")
+    broadcast_id = sending.store.create("hello")
+    assert other.pending() == [broadcast_id]
+
+    report = asyncio.run(broadcast(bot, sending, broadcast_id))
+
+    assert sorted(bot.chat_ids) == [ord(u) for u in "abcd"]
+    assert report["delivered"] == 4
+    assert other.pending() == []
+    assert not other.claim(broadcast_id, 60)
+    try:
+        asyncio.run(broadcast(Bot(), sending, broadcast_id))
+    except BroadcastTaken:
+        pass
+    else:
+        raise AssertionError("a finished broadcast was sent again")
+
+
+def test_leased_broadcast_is_not_pending(tmp_path):
+    store = BroadcastStore(tmp_path/"broadcasts.db")
+    other = BroadcastStore(tmp_path/"broadcasts.db")
+    broadcast_id = store.create("hello")
+
+    assert store.claim(broadcast_id, 60)
+    assert other.pending() == []
+    assert not other.claim(broadcast_id, 60)
+    store.release(broadcast_id)
+    assert other.pending() == [broadcast_id]
+
+
+def test_taking_over_a_crashed_broadcast(db, tmp_path, monkeypatch):
+    usernames = [f"user{i:02}" for i in range(30)]
+    fill(db, usernames[::2], usernames[1::2])
+    # user00's chat isn't known
+    chat_id_of = {u: i for i, u in enumerate(usernames) if i}.get
+
+    first = broadcaster(tmp_path, batch_size=4)
+    first.chat_id_of = chat_id_of
+    first.lease = 0.5
+    broadcast_id = first.store.create("hello")
+    # the process dies mid batch, without giving the lease up
+    monkeypatch.setattr(first.store, "release", lambda broadcast_id: None)
+    crashed = Bot(hang_after=9)
+
+    async def crash():
+        task = asyncio.create_task(broadcast(crashed, first, broadcast_id))
+        await crashed.hanging.wait()
+        # let the messages sent so far be recorded
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(crash())
+    assert len(crashed.chat_ids) == 9
+
+    second = broadcaster(tmp_path, batch_size=4)
+    second.chat_id_of = chat_id_of
+    assert second.store.pending() == []
+    try:
+        asyncio.run(broadcast(Bot(), second, broadcast_id))
+    except BroadcastTaken:
+        pass
+    else:
+        raise AssertionError("a leased broadcast was taken over")
+
+    time.sleep(0.5)
+    assert second.store.pending() == [broadcast_id]
+    resumed = Bot()
+    report = asyncio.run(broadcast(resumed, second, broadcast_id))
+
+    # everyone with a chat once, whoever sent it
+    assert sorted(crashed.chat_ids + resumed.chat_ids) == list(range(1, 30))
+    assert (report["delivered"], report["failed"], report["skipped"]) == (29, 0, 1)
+    assert second.store.sent(broadcast_id) == {}
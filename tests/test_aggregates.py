@@ -0,0 +1,88 @@
+import time, random
+
+from sqlalchemy import update, delete
+
+from models import Inbounds, BotUsers, TelegramUsers, GuestUsers, UsersInboundsRelation
+from snapshots import TrafficSnapshot
+from aggregates import Aggregates
+from conftest import inbound_row
+
+
+GB = 2**30
+DAY_MS = 86400*1000
+
+
+def contents(aggregates):
+    """Everything but the daily traffic, which a rebuild doesn't recount."""
+    return (aggregates._rows("SELECT kind, key, count, used, quota FROM rollups "
+                             "WHERE kind!='day' ORDER BY kind, key"),
+            aggregates._rows("SELECT * FROM inbounds ORDER BY id"))
+
+
+def test_updates_match_rebuild(db, tmp_path):
+    rng = random.Random(1)
+    now_ms = int(time.time()*1e3)
+    with db.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(), [
+            inbound_row(20000 + i, protocol=rng.choice(["vless", "vmess"]),
+                        up=rng.randrange(GB), down=rng.randrange(GB), total=10*GB,
+                        expiry_time=now_ms + rng.randrange(1, 10)*DAY_MS)
+            for i in range(1, 31)])
+        conn.execute(BotUsers.__table__.insert(),
+                     [{"id": i, "login_code": f"code{i}"} for i in range(1, 6)])
+        conn.execute(TelegramUsers.__table__.insert(),
+                     [{"username": f"user{i}", "bot_id": i, "is_auth": True}
+                      for i in range(1, 6)])
+        conn.execute(UsersInboundsRelation.__table__.insert(),
+                     [{"bot_id": 1 + i % 5, "inbound_id": i} for i in range(1, 21)])
+        conn.execute(GuestUsers.__table__.insert(),
+                     [{"username": f"guest{i}", "inbound_id": i} for i in range(21, 26)])
+
+    def traffic(conn):
+        for i in rng.sample(range(1, 31), 10):
+            conn.execute(update(Inbounds).where(Inbounds.id==i)
+                         .values(up=Inbounds.up + rng.randrange(GB)))
+
+    steps = [
+        traffic,
+        # a renewal: counters reset, new quota and expiry
+        lambda conn: conn.execute(update(Inbounds).where(Inbounds.id==3)
+                                  .values(up=0, down=0, total=20*GB,
+                                          expiry_time=now_ms + 30*DAY_MS)),
+        lambda conn: conn.execute(update(Inbounds).where(Inbounds.id==4)
+                                  .values(protocol="trojan")),
+        # a guest logs into a bot user, another inbound changes hands
+        lambda conn: conn.execute(TelegramUsers.__table__.insert()
+                                  .values(username="guest21", bot_id=2, is_auth=True)),
+        lambda conn: conn.execute(update(UsersInboundsRelation)
+                                  .where(UsersInboundsRelation.inbound_id==5)
+                                  .values(bot_id=3)),
+        lambda conn: conn.execute(delete(Inbounds).where(Inbounds.id.in_([6, 22]))),
+        lambda conn: conn.execute(Inbounds.__table__.insert(),
+                                  [inbound_row(20100, up=GB, total=5*GB, expiry_time=0)]),
+        lambda conn: conn.execute(update(Inbounds).where(Inbounds.id==7).values(expiry_time=0)),
+        traffic,
+    ]
+
+    snapshot = TrafficSnapshot()
+    snapshot.refresh()
+    incremental = Aggregates().open(tmp_path/"incremental.db")
+    incremental.update(snapshot)
+    for step in steps:
+        with db.begin() as conn:
+            step(conn)
+        snapshot.refresh()
+        incremental.update(snapshot)
+
+        rebuilt = Aggregates().open(tmp_path/"rebuilt.db")
+        rebuilt.rebuild(snapshot)
+        assert contents(incremental) == contents(rebuilt)
+        assert incremental.state == rebuilt.state
+        rebuilt.close()
+
+    # and only the changed inbounds were looked at after the first update
+    assert incremental.last_changes == 10
+    totals = incremental.totals()
+    assert totals["all"]["inbounds"] == 29
+    assert incremental.trial_conversion() == {"guests": 5, "converted": 1, "rate": 0.2}
+    incremental.close()
@@ -0,0 +1,52 @@
+import asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from caches import QRCache
+
+
+def test_file_ids_bounded():
+    cache = QRCache(str.encode, max_file_ids=3)
+    for i in range(4):
+        cache.set_file_id(f"url{i}", f"file{i}")
+    # url1 is used again, so url2 is the least recently used one
+    assert cache.file_id("url0") is None
+    assert cache.file_id("url1") == "file1"
+    cache.set_file_id("url4", "file4")
+
+    assert [cache.file_id(f"url{i}") for i in range(5)] == [None, "file1", None, "file3", "file4"]
+    assert cache.stats["file_ids"] == 3
+
+
+def test_same_key_from_threads(tmp_path):
+    started = threading.Barrier(8)
+
+    def render(data):
+        # every thread misses and writes the file at the same time
+        started.wait()
+        return data.encode()*1000
+
+    cache = QRCache(render, directory=tmp_path)
+    with ThreadPoolExecutor(8) as executor:
+        pngs = list(executor.map(cache.png, ["url"]*8))
+
+    assert pngs == [b"url"*1000]*8
+    assert [path.name for path in tmp_path.iterdir()] == [f"{QRCache.key('url')}.png"]
+
+
+def test_qr_photo_renders_off_the_loop(monkeypatch):
+    threads = []
+
+    def render(data):
+        threads.append(threading.current_thread())
+        return b"png"
+
+    monkeypatch.setattr(utils, "qr_cache", QRCache(render))
+
+    async def main():
+        first = await utils.qr_photo("url")
+        utils.qr_cache.set_file_id("url", "file")
+        return first.getvalue(), await utils.qr_photo("url")
+
+    assert asyncio.run(main()) == (b"png", "file")
+    assert threads and threads[0] is not threading.main_thread()
@@ -0,0 +1,89 @@
+import time, asyncio
+
+import pytest
+from sqlalchemy import select
+
+import enforcement
+from models import Inbounds, BotUsers, TelegramUsers, GuestUsers, UsersInboundsRelation
+from enforcement import disable_exhausted, usernames_of, QuotaEnforcer
+from conftest import inbound_row, RecordingSender
+
+
+NOW = time.time()
+GB = 2**30
+
+
+@pytest.fixture
+def inbounds(db):
+    """
+        Inbound 1 is within its limits and 2 over its quota, both alice's and
+        alice_phone's. 3 is bob's expired guest trial, 4 unlimited, 5 over its
+        quota but disabled already.
+    """
+    with db.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(), [
+            inbound_row(20001, "fine", up=GB, down=GB, total=10*GB,
+                        expiry_time=int((NOW + 86400)*1e3)),
+            inbound_row(20002, "used_up", up=6*GB, down=4*GB, total=10*GB),
+            inbound_row(20003, "bob_test", total=GB, expiry_time=int((NOW - 60)*1e3)),
+            inbound_row(20004, "unlimited", up=100*GB, total=0, expiry_time=0),
+            inbound_row(20005, "off", up=20*GB, total=10*GB, enable=False),
+        ])
+        conn.execute(BotUsers.__table__.insert(), [{"id": 1, "login_code": "code1"}])
+        conn.execute(TelegramUsers.__table__.insert(),
+                     [{"username": "alice", "bot_id": 1, "is_auth": True},
+                      {"username": "alice_phone", "bot_id": 1, "is_auth": True}])
+        conn.execute(UsersInboundsRelation.__table__.insert(),
+                     [{"bot_id": 1, "inbound_id": 1}, {"bot_id": 1, "inbound_id": 2}])
+        conn.execute(GuestUsers.__table__.insert(), [{"username": "bob", "inbound_id": 3}])
+    return db
+
+
+def enabled(db):
+    with db.connect() as conn:
+        return dict(conn.execute(select(Inbounds.id, Inbounds.enable)).all())
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_disables_exhausted_and_expired(inbounds, monkeypatch, returning):
+    monkeypatch.setattr(enforcement, "HAS_RETURNING", returning and enforcement.HAS_RETURNING)
+
+    rows = disable_exhausted(NOW)
+
+    assert sorted(row.id for row in rows) == [2, 3]
+    assert enabled(inbounds) == {1: True, 2: False, 3: False, 4: True, 5: False}
+    assert disable_exhausted(NOW) == []
+
+
+def test_usernames_of(inbounds):
+    owners = usernames_of([1, 2, 3, 4])
+
+    assert sorted(owners[2]) == ["alice", "alice_phone"]
+    assert owners[3] == ["bob"]
+    assert 4 not in owners
+
+
+class Reloader:
+    def __init__(self):
+        self.requests = 0
+
+    def request(self):
+        self.requests += 1
+
+
+def test_enforcer(inbounds):
+    sender, reloader = RecordingSender(), Reloader()
+    # alice_phone never talked to the bot
+    chat_ids = {"alice": 1, "bob": 2}
+    enforcer = QuotaEnforcer(sender, reloader, chat_ids.get)
+
+    rows, _ = asyncio.run(enforcer.run_once())
+
+    assert len(rows) == 2 and reloader.requests == 1
+    assert sorted(sender.sent) == [(1, "حجم اکانت used_up به پایان رسید و غیرفعال شد"),
+                                   (2, "زمان اکانت bob_test به پایان رسید و غیرفعال شد")]
+
+    # nothing left to disable, so no reload and no messages
+    assert asyncio.run(enforcer.run_once()) == ([], [])
+    assert reloader.requests == 1 and len(sender.sent) == 2
+    assert (enforcer.runs, enforcer.disabled) == (2, 2)
@@ -0,0 +1,74 @@
+from sqlalchemy import select, func
+
+from models import Inbounds, NodeInboundsRelation, count_statements
+from backends import BotUsersBackend, InboundsBackend
+from provisioning import provision
+from conftest import inbound_row
+
+
+def inbound_count(node):
+    with node.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(Inbounds)).scalar()
+
+
+def test_provision_spreads(two_nodes):
+    created = provision([{"protocol": "vless", "remark": f"account{i}"} for i in range(9)],
+                        reload=False)
+
+    placed = {account["node"] for account in created}
+    assert placed == {"main", "node1", "node2"}
+    assert sum(inbound_count(node) for node in two_nodes.nodes.values()) == 9
+
+
+def test_create_inbound_placed(two_nodes):
+    # the local node is the busiest, the others are empty
+    with two_nodes.local.engine.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(),
+                     [inbound_row(port) for port in range(20001, 20101)])
+    two_nodes.local.ports.load()
+
+    inbound = InboundsBackend.create_inbound("vless", "placed")
+
+    assert inbound.node in two_nodes.remote
+    assert inbound_count(inbound.node) == 1
+    assert inbound.get_login_url(inbound.node.host).split("@")[1].startswith(
+        f"{inbound.node.host.split(':')[0]}:{inbound.port}?")
+
+
+def test_guest_inbound_stays_local(two_nodes):
+    inbound = InboundsBackend.create_inbound("vless", "guest", node=two_nodes.local)
+
+    assert inbound.node is two_nodes.local
+    assert [inbound_count(node) for node in two_nodes.remote] == [0, 0]
+
+
+def test_reads_in_one_fan_out(two_nodes, logged_in, db, monkeypatch):
+    # alice's bot user has an inbound on both other nodes too
+    for node in two_nodes.remote:
+        with node.engine.begin() as conn:
+            conn.execute(Inbounds.__table__.insert(), [inbound_row(30001, f"alice_{node.name}")])
+    with db.begin() as conn:
+        conn.execute(NodeInboundsRelation.__table__.insert(),
+                     [{"node": node.name, "bot_id": logged_in, "inbound_id": 1}
+                      for node in two_nodes.remote])
+
+    with BotUsersBackend("alice") as backend:
+        cold = backend.get_connection_urls()
+    assert cold.keys() == {"vless", "vmess", "vless (node1)", "vless (node2)"}
+    assert cold["vless (node1)"].split("@")[1].startswith("node1.example.com:30001?")
+
+    # with the bot id and placements cached, one fan_out over the three
+    # nodes with one statement each
+    assert BotUsersBackend.is_authenticated("alice")
+    fan_out, fanned_out = two_nodes.fan_out, []
+
+    def recorded_fan_out(function, nodes=None):
+        fanned_out.append(sorted(node.name for node in nodes))
+        return fan_out(function, nodes)
+
+    monkeypatch.setattr(two_nodes, "fan_out", recorded_fan_out)
+    with count_statements() as counter, BotUsersBackend("alice") as backend:
+        warm = backend.get_connection_urls()
+    assert warm == cold
+    assert fanned_out == [["main", "node1", "node2"]]
+    assert counter.count == 3
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from models import GuestUsers, session_scope
+from backends import InboundsBackend
+
+
+def test_tap_twice(db):
+    first = InboundsBackend.guest_inbound("bob")
+    second = InboundsBackend.guest_inbound("bob")
+
+    assert second.id == first.id
+    assert second.inbound.id == first.inbound.id
+    assert second.inbound.remark == "bob_test"
+    assert second.updated == first.updated
+    with session_scope() as session:
+        assert session.query(GuestUsers).count() == 1
+
+
+def test_tap_after_expiry(db):
+    first = InboundsBackend.guest_inbound("bob")
+    expired = datetime.now() - timedelta(days=40)
+    with session_scope() as session:
+        session.query(GuestUsers).filter_by(username="bob").update({"updated": expired})
+
+    again = InboundsBackend.guest_inbound("bob")
+
+    assert again.inbound.id == first.inbound.id
+    assert again.updated > datetime.now() - timedelta(minutes=1)
+    with session_scope() as session:
+        assert session.query(GuestUsers).filter_by(username="bob").one().updated == again.updated
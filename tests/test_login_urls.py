@@ -0,0 +1,109 @@
+import json, base64
+from urllib.parse import urlsplit, parse_qsl
+
+import pytest
+
+from models import login_url_cache
+from dashboards import InboundView
+
+
+HOST = "tests.example.com"
+ID = "3b9f5d2e-6a1c-4f0e-9d47-0c8f1a2b3c4d"
+
+
+@pytest.fixture(autouse=True)
+def no_cached_urls():
+    login_url_cache.clear()
+
+
+def inbound(protocol="vless", port=443, remark="alice", client=None, **stream):
+    stream = {"network": "tcp",
+              "security": "tls",
+              "tlsSettings": {"serverName": HOST},
+              "tcpSettings": {"header": {"type": "none"}},
+              **stream}
+    client = client or {"id": ID, "flow": "xtls-rprx-direct"}
+    return InboundView(id=port, remark=remark, protocol=protocol, port=port, up=0,
+                       down=0, total=0, expiry_time=0, enable=True,
+                       settings=json.dumps({"clients": [client]}),
+                       stream_settings=json.dumps(stream))
+
+
+def baseline_url(inbound, host_address):
+    # how the links were put together before the builder, for tcp with tls
+    uuid = json.loads(inbound.settings)["clients"][0]["id"]
+    return (
+        f"{inbound.protocol}://{uuid}@{host_address}?"
+        "security=tls&encryption=none&"
+        "headerType=none&type=tcp&"
+        f"sni={host_address.split(':')[0]}#{inbound.remark}"
+    )
+
+
+def split(url):
+    parts = urlsplit(url)
+    return parts.scheme, parts.netloc, dict(parse_qsl(parts.query)), parts.fragment
+
+
+def test_matches_baseline():
+    view = inbound()
+    scheme, netloc, query, remark = split(view.get_login_url(HOST))
+    old_scheme, old_netloc, old_query, old_remark = split(baseline_url(view, f"{HOST}:443"))
+
+    assert (scheme, netloc, remark) == (old_scheme, old_netloc, old_remark)
+    # the same parameters, plus the client's flow
+    assert query == {**old_query, "flow": "xtls-rprx-direct"}
+
+
+def test_port_and_host():
+    assert split(inbound(port=20001).get_login_url(f"{HOST}:443"))[1] == f"{ID}@{HOST}:20001"
+    assert split(inbound(port=20001).get_login_url("other.example.com"))[1] \
+        == f"{ID}@other.example.com:20001"
+
+
+def test_sni():
+    query = split(inbound(tlsSettings={"serverName": "cdn.example.com"}).get_login_url(HOST))[2]
+    assert (query["security"], query["sni"]) == ("tls", "cdn.example.com")
+    # without a server name the host is the sni
+    assert split(inbound(tlsSettings={}).get_login_url(HOST))[2]["sni"] == HOST
+    query = split(inbound(security="none").get_login_url(HOST))[2]
+    assert query["security"] == "none" and "sni" not in query
+
+
+def test_ws_and_grpc():
+    query = split(inbound(network="ws",
+                          wsSettings={"path": "/ray", "headers": {"Host": "cdn.example.com"}})
+                  .get_login_url(HOST))[2]
+    assert (query["type"], query["path"], query["host"]) == ("ws", "/ray", "cdn.example.com")
+    assert "headerType" not in query
+
+    query = split(inbound(network="grpc", grpcSettings={"serviceName": "tunnel"})
+                  .get_login_url(HOST))[2]
+    assert (query["type"], query["serviceName"]) == ("grpc", "tunnel")
+
+
+def test_vmess():
+    url = inbound("vmess", 20001, client={"id": ID, "alterId": 0},
+                  network="ws", wsSettings={"path": "/ray"}).get_login_url(HOST)
+
+    assert url.startswith("vmess://")
+    assert json.loads(base64.b64decode(url[len("vmess://"):])) == {
+        "v": "2", "ps": "alice", "add": HOST, "port": 20001, "id": ID, "aid": 0,
+        "net": "ws", "type": "none", "host": "", "path": "/ray", "tls": "tls", "sni": HOST,
+    }
+
+
+def test_trojan():
+    url = inbound("trojan", client={"password": "secret"}).get_login_url(HOST)
+    scheme, netloc, query, _ = split(url)
+    assert (scheme, netloc) == ("trojan", f"secret@{HOST}:443")
+    assert "encryption" not in query and "flow" not in query
+
+    # no password, no link rather than trojan://None@...
+    assert inbound("trojan", client={"flow": ""}).get_login_url(HOST) is None
+
+
+def test_cached_until_changed():
+    view = inbound(remark="before")
+    assert view.get_login_url(HOST).endswith("#before")
+    assert view._replace(remark="after").get_login_url(HOST).endswith("#after")
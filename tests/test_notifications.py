@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from sqlalchemy import update
+
+from models import Inbounds, GuestUsers
+from snapshots import TrafficSnapshot
+from notifications import ThresholdNotifier
+from conftest import inbound_row, RecordingSender
+
+
+GB = 2**30
+
+
+@pytest.fixture
+def guest(db):
+    """bob's 10GB trial inbound, 10% used."""
+    with db.begin() as conn:
+        conn.execute(Inbounds.__table__.insert(),
+                     [inbound_row(20001, "bob_test", up=GB, down=0, total=10*GB)])
+        conn.execute(GuestUsers.__table__.insert(), [{"username": "bob", "inbound_id": 1}])
+    return db
+
+
+def use(db, gb, **columns):
+    with db.begin() as conn:
+        conn.execute(update(Inbounds).values(up=int(gb*GB), down=0, **columns))
+
+
+def run(db, steps):
+    """
+        Runs the notifier over a refresh after each step(db), returns the
+        texts sent after every step.
+    """
+    sender = RecordingSender()
+    notifier = ThresholdNotifier(sender, {"bob": 1}.get, usage_thresholds=(0.8, 0.95))
+    snapshot = TrafficSnapshot()
+
+    async def main():
+        sent = []
+        for step in steps:
+            step(db)
+            before = len(sender.sent)
+            snapshot.refresh()
+            notifier.observe(snapshot)
+            await asyncio.gather(*notifier._tasks)
+            sent.append([text for _, text in sender.sent[before:]])
+        return sent
+
+    return asyncio.run(main())
+
+
+def test_each_threshold_once(guest):
+    sent = run(guest, [lambda db: None,
+                       lambda db: use(db, 8.5),
+                       lambda db: use(db, 9),
+                       lambda db: use(db, 9.6),
+                       lambda db: use(db, 9.9)])
+
+    assert sent == [[], ["80٪ حجم اکانت bob_test مصرف شده است"], [],
+                    ["95٪ حجم اکانت bob_test مصرف شده است"], []]
+
+
+def test_first_snapshot_silent(guest):
+    # already over 80% when the bot starts: no warning for that, only for 95%
+    sent = run(guest, [lambda db: use(db, 9),
+                       lambda db: use(db, 9.1),
+                       lambda db: use(db, 9.6)])
+
+    assert sent == [[], [], ["95٪ حجم اکانت bob_test مصرف شده است"]]
+
+
+def test_rearmed_after_reset(guest):
+    sent = run(guest, [lambda db: None,
+                       lambda db: use(db, 8.5),
+                       # x-ui reset the counters, the quota stayed the same
+                       lambda db: use(db, 0),
+                       lambda db: use(db, 8.5),
+                       # renewed with a bigger quota
+                       lambda db: use(db, 8.5, total=20*GB),
+                       lambda db: use(db, 16.5, total=20*GB)])
+
+    assert sent == [[], ["80٪ حجم اکانت bob_test مصرف شده است"], [],
+                    ["80٪ حجم اکانت bob_test مصرف شده است"], [],
+                    ["80٪ حجم اکانت bob_test مصرف شده است"]]
@@ -0,0 +1,28 @@
+import asyncio
+
+from persistence import SQLitePersistence
+
+
+def test_conversations_survive_a_restart(tmp_path):
+    path = tmp_path/"persistence.db"
+
+    async def main():
+        persistence = SQLitePersistence(path)
+        assert await persistence.get_conversations("conversation") == {}
+        for user_id in range(100):
+            await persistence.update_conversation("conversation", (user_id, user_id),
+                                                  chr(user_id % 4))
+        await persistence.update_conversation("conversation", (5, 5), None)
+        await persistence.update_conversation("other", (1, 2), 3)
+        await persistence.flush()
+        # not committed yet, still returned
+        await persistence.update_conversation("conversation", (6, 6), "\n,\"")
+        pending = await persistence.get_conversations("conversation")
+        await persistence.flush()
+        return pending, await SQLitePersistence(path).get_conversations("conversation")
+
+    pending, loaded = asyncio.run(main())
+
+    expected = {(i, i): chr(i % 4) for i in range(100) if i != 5}
+    expected[(6, 6)] = "\n,\""
+    assert pending == loaded == expected
@@ -0,0 +1,69 @@
+"""
+    Another process (the provisioning cli, x-ui's panel) creating an inbound
+    on a port this process' allocator still thinks is free.
+"""
+
+import pytest
+from sqlalchemy import select, func
+
+from models import Inbounds
+from backends import InboundsBackend, port_allocator, trial_pool
+from provisioning import provision
+from conftest import inbound_row
+
+
+TAKEN = 30000
+
+
+@pytest.fixture
+def taken_elsewhere(db, monkeypatch):
+    """The allocator's next port gets an inbound behind its back."""
+    allocate = port_allocator.allocate
+    handed_out = []
+
+    def allocate_taken_first():
+        if handed_out:
+            port = allocate()
+        else:
+            port = TAKEN
+            port_allocator.mark_used(port)
+            with db.begin() as conn:
+                conn.execute(Inbounds.__table__.insert(), [inbound_row(port, "elsewhere")])
+        handed_out.append(port)
+        return port
+
+    monkeypatch.setattr(port_allocator, "allocate", allocate_taken_first)
+    return db
+
+
+def ports_used_twice(engine):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(Inbounds.port).group_by(Inbounds.port).having(func.count() > 1)
+        ).scalars().all()
+
+
+def test_create_inbound(taken_elsewhere):
+    inbound = InboundsBackend.create_inbound("vless", "mine")
+
+    assert inbound.port != TAKEN
+    assert ports_used_twice(taken_elsewhere) == []
+
+
+def test_trial_pool_top_up(taken_elsewhere, monkeypatch):
+    monkeypatch.setattr(trial_pool, "size", 3)
+    monkeypatch.setattr(trial_pool.reloader, "request", lambda: None)
+
+    assert trial_pool.top_up() == 3
+    assert ports_used_twice(taken_elsewhere) == []
+    assert trial_pool.available() == 3
+
+
+def test_provision(taken_elsewhere):
+    created = provision([{"protocol": "vless", "remark": f"account{i}"} for i in range(3)],
+                        reload=False)
+
+    assert TAKEN not in {account["port"] for account in created}
+    assert ports_used_twice(taken_elsewhere) == []
+    with taken_elsewhere.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Inbounds)).scalar() == 4
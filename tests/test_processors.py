@@ -0,0 +1,90 @@
+import asyncio, random
+
+from telegram import Update
+
+from processors import PerChatUpdateProcessor
+
+
+def update(update_id, chat_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": str(update_id)},
+    }, None)
+
+
+def test_chat_order():
+    processor = PerChatUpdateProcessor(8)
+    started, finished = [], []
+
+    async def handle(update):
+        started.append(update)
+        # later updates are quicker, so without the lock they would overtake
+        await asyncio.sleep(random.random() * 0.01 / update.update_id)
+        finished.append(update)
+
+    async def main():
+        # two chats' updates interleaved, scheduled like the Application does
+        updates = [update(i, 1 + i % 2) for i in range(1, 41)]
+        await asyncio.gather(*[
+            asyncio.create_task(processor.process_update(u, handle(u))) for u in updates
+        ])
+
+    asyncio.run(main())
+
+    for chat_id in (1, 2):
+        ids = [u.update_id for u in finished if u.effective_chat.id == chat_id]
+        assert ids == sorted(ids) and len(ids) == 20
+    # one chat's update starts only after the one before it finished
+    for a, b in zip(started, started[1:]):
+        if a.effective_chat.id == b.effective_chat.id:
+            assert finished.index(a) < finished.index(b)
+    assert processor.processed == 40
+
+
+def test_other_chats_not_blocked():
+    processor = PerChatUpdateProcessor(4)
+    release, order = asyncio.Event(), []
+
+    async def slow():
+        await release.wait()
+        order.append("slow")
+
+    async def quick():
+        order.append("quick")
+        release.set()
+
+    async def main():
+        await asyncio.gather(processor.process_update(update(1, 1), slow()),
+                             processor.process_update(update(2, 2), quick()))
+
+    asyncio.run(main())
+
+    assert order == ["quick", "slow"]
+
+
+def test_busy_chat_takes_one_worker():
+    # more updates of chat 1 waiting than there are workers
+    processor = PerChatUpdateProcessor(2)
+    release, order = asyncio.Event(), []
+
+    async def slow(i):
+        await release.wait()
+        order.append(i)
+
+    async def quick():
+        order.append("quick")
+        release.set()
+
+    async def main():
+        tasks = [asyncio.create_task(processor.process_update(update(i, 1), slow(i)))
+                 for i in range(1, 7)]
+        tasks.append(asyncio.create_task(processor.process_update(update(7, 2), quick())))
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+
+    asyncio.run(main())
+
+    assert order == ["quick", 1, 2, 3, 4, 5, 6]
+    assert processor.max_concurrent_updates == 2
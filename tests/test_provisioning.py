@@ -0,0 +1,143 @@
+import os, sys, csv, json, base64, subprocess, pathlib
+
+import pytest
+
+from sqlalchemy import create_engine, inspect, select, text, func
+
+from models import (BotUsers,
+                    Inbounds,
+                    UsersInboundsRelation,
+                    _migrate_relation_key,
+                    verify_schema)
+from provisioning import provision, read_accounts
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+ACCOUNTS = [
+    {"protocol": "vless", "remark": "first", "quota": "10", "days": "30"},
+    {"protocol": "vmess", "remark": "second", "quota": "", "days": ""},
+    {"protocol": "vless", "remark": "third", "quota": "1", "days": "7"},
+]
+
+
+def write_accounts(path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["protocol", "remark", "quota", "days"])
+        writer.writeheader()
+        writer.writerows(ACCOUNTS)
+    return str(path)
+
+
+def owned_inbounds(engine):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(BotUsers.login_code, Inbounds.remark, Inbounds.port)
+            .join(UsersInboundsRelation, UsersInboundsRelation.bot_id==BotUsers.id)
+            .join(Inbounds, Inbounds.id==UsersInboundsRelation.inbound_id)
+        ).all()
+
+
+def test_provision_csv(db, tmp_path):
+    created = provision(read_accounts(write_accounts(tmp_path/"accounts.csv")), reload=False)
+
+    assert [account["remark"] for account in created] == ["first", "second", "third"]
+    assert len({account["port"] for account in created}) == 3
+    owned = {(code, remark, port) for code, remark, port in owned_inbounds(db)}
+    assert owned == {(a["login_code"], a["remark"], a["port"]) for a in created}
+
+
+def test_provision_twice(db, tmp_path):
+    path = write_accounts(tmp_path/"accounts.csv")
+    provision(read_accounts(path), reload=False)
+    provision(read_accounts(path), reload=False)
+
+    assert len(owned_inbounds(db)) == 6
+
+
+def test_provisioning_cli(db, tmp_path):
+    output = tmp_path/"codes.csv"
+    subprocess.run([sys.executable, str(ROOT/"provisioning.py"),
+                    write_accounts(tmp_path/"accounts.csv"),
+                    "--output", str(output), "--no-reload"],
+                   check=True, cwd=tmp_path, env=os.environ.copy(), capture_output=True)
+
+    with open(output, newline="") as f:
+        created = list(csv.DictReader(f))
+    assert {row["remark"] for row in created} == {"first", "second", "third"}
+    owned = {(code, remark) for code, remark, _ in owned_inbounds(db)}
+    assert owned == {(row["login_code"], row["remark"]) for row in created}
+
+
+def test_relation_key_migration(tmp_path):
+    # the relations table as older versions of the bot created it
+    engine = create_engine(f"sqlite:///{tmp_path/'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE users_inbounds_relation (id INTEGER NOT NULL, "
+            "bot_id INTEGER NOT NULL, inbound_id INTEGER NOT NULL, "
+            "PRIMARY KEY (id, bot_id, inbound_id))"))
+        conn.execute(text("CREATE INDEX ix_users_inbounds_relation_inbound_id "
+                          "ON users_inbounds_relation (inbound_id)"))
+        conn.execute(text("INSERT INTO users_inbounds_relation VALUES (1, 1, 1), (2, 1, 2)"))
+
+    with engine.begin() as conn:
+        assert _migrate_relation_key(conn)
+    with engine.begin() as conn:
+        assert not _migrate_relation_key(conn)
+        conn.execute(UsersInboundsRelation.__table__.insert(), [{"bot_id": 2, "inbound_id": 3}])
+        rows = conn.execute(text("SELECT id, bot_id, inbound_id FROM users_inbounds_relation "
+                                 "ORDER BY id")).all()
+    assert rows == [(1, 1, 1), (2, 1, 2), (3, 2, 3)]
+    assert inspect(engine).get_pk_constraint("users_inbounds_relation")["constrained_columns"] == ["id"]
+
+
+def test_verify_schema_migrates(db, tmp_path):
+    with db.begin() as conn:
+        conn.execute(text("DROP TABLE users_inbounds_relation"))
+        conn.execute(text(
+            "CREATE TABLE users_inbounds_relation (id INTEGER NOT NULL, "
+            "bot_id INTEGER NOT NULL, inbound_id INTEGER NOT NULL, "
+            "PRIMARY KEY (id, bot_id, inbound_id))"))
+    verify_schema(tmp_path/"schema")
+
+    assert inspect(db).get_pk_constraint("users_inbounds_relation")["constrained_columns"] == ["id"]
+
+
+def test_settings_per_protocol(db):
+    created = provision([{"protocol": protocol, "remark": protocol}
+                         for protocol in ("vless", "vmess", "trojan")], reload=False)
+
+    with db.connect() as conn:
+        inbounds = {i.protocol: i for i in conn.execute(select(Inbounds)).all()}
+    clients = {protocol: json.loads(i.settings)["clients"][0]
+               for protocol, i in inbounds.items()}
+    assert set(clients["vless"]) == {"id", "flow"}
+    assert json.loads(inbounds["vless"].settings)["decryption"] == "none"
+    assert clients["vmess"] == {"id": clients["vmess"]["id"], "alterId": 0}
+    assert set(clients["trojan"]) == {"password"} and clients["trojan"]["password"]
+
+    urls = {a["protocol"]: Inbounds(**inbounds[a["protocol"]]._mapping).get_login_url()
+            for a in created}
+    assert urls["vless"].startswith(f"vless://{clients['vless']['id']}@tests.example.com:")
+    assert "flow=xtls-rprx-direct" in urls["vless"]
+    vmess = json.loads(base64.b64decode(urls["vmess"][len("vmess://"):]))
+    assert (vmess["id"], vmess["aid"]) == (clients["vmess"]["id"], 0)
+    assert urls["trojan"].startswith(f"trojan://{clients['trojan']['password']}@")
+    assert "flow" not in urls["trojan"]
+
+
+def test_unsupported_protocol(db, tmp_path):
+    accounts = [{"protocol": "vless", "remark": "ok"},
+                {"protocol": "shadowsocks", "remark": "not ok"}]
+
+    with pytest.raises(ValueError, match=r"account 2 \('shadowsocks'\)"):
+        provision(accounts, reload=False)
+    with db.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Inbounds)).scalar() == 0
+
+    path = tmp_path/"accounts.json"
+    path.write_text(json.dumps(accounts))
+    result = subprocess.run([sys.executable, str(ROOT/"provisioning.py"), str(path),
+                             "--no-reload"],
+                            cwd=tmp_path, env=os.environ.copy(), capture_output=True, text=True)
+    assert result.returncode == 2 and "shadowsocks" in result.stderr
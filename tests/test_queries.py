@@ -0,0 +1,115 @@
+"""
+    How many sql statements the handlers users hit the most run for one
+    update, counted with models.count_statements. The handlers are called
+    directly with stand-ins for telegram's objects and an outbound sender
+    that sends to nowhere.
+"""
+
+import asyncio
+
+import pytest
+
+from models import count_statements
+from clients import auth, dash, login, pro_dash, outbound, PRO_RULES, GUEST_RULES, PRO_DASH
+
+
+class Message:
+    def __init__(self, text):
+        self.text = text
+        self.message_id = 1
+        self.photo = []
+
+    # replies go through the outbound sender, so there's no reply_text
+    async def reply_chat_action(self, *args, **kwargs):
+        return True
+
+
+class User:
+    def __init__(self, username):
+        self.id = abs(hash(username)) % 10**9
+        self.username = username
+        self.name = f"@{username}"
+
+
+class Chat:
+    def __init__(self, id):
+        self.id = id
+
+
+class Update:
+    def __init__(self, username, text):
+        self.effective_user = User(username)
+        self.effective_chat = Chat(self.effective_user.id)
+        self.message = Message(text)
+
+
+class Bot:
+    async def send_message(self, *args, **kwargs):
+        return Message(None)
+
+    send_photo = send_document = send_message
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        return [Message(None) for _ in media]
+
+
+def handle(handler, username, text):
+    """Runs handler on one update, returns (its result, sql statements it ran)."""
+    async def run():
+        outbound.start(Bot())
+        try:
+            with count_statements() as counter:
+                result = await handler(Update(username, text), None)
+        finally:
+            await outbound.stop()
+        return result, counter.count
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def unlimited_sender():
+    rates = (outbound.global_bucket.rate, outbound.global_bucket.capacity,
+             outbound.chat_rate, outbound.chat_burst)
+    outbound.global_bucket.rate = outbound.global_bucket.capacity = 1e9
+    outbound.chat_rate = outbound.chat_burst = 1e9
+    yield
+    (outbound.global_bucket.rate, outbound.global_bucket.capacity,
+     outbound.chat_rate, outbound.chat_burst) = rates
+
+
+def test_start(logged_in):
+    # the login state is read once, then answered from auth_cache
+    assert handle(auth, "alice", "/start") == (PRO_DASH, 1)
+    assert handle(auth, "alice", "/start") == (PRO_DASH, 0)
+
+
+def test_start_unknown_user(db):
+    assert handle(auth, "carol", "/start")[1] == 1
+    assert handle(auth, "carol", "/start")[1] == 0
+
+
+@pytest.mark.parametrize("text", [PRO_RULES[0], PRO_RULES[1]])
+def test_dashboard(logged_in, text):
+    # the login state, then the user, bot user and inbounds in one query
+    assert handle(pro_dash, "alice", text) == (PRO_DASH, 2)
+    assert handle(pro_dash, "alice", text) == (PRO_DASH, 1)
+
+
+def test_dashboard_logged_out(db):
+    assert handle(pro_dash, "carol", PRO_RULES[0])[1] == 1
+    assert handle(pro_dash, "carol", PRO_RULES[0])[1] == 0
+
+
+def test_log_in(logged_in):
+    handle(pro_dash, "alice", PRO_RULES[2])
+
+    assert handle(login, "alice", "code1") == (PRO_DASH, 5)
+    # logging in forgets the cached login state
+    assert handle(pro_dash, "alice", PRO_RULES[0]) == (PRO_DASH, 2)
+
+
+def test_guest_offer(db):
+    # issuing the trial inserts the inbound, checks its port and inserts the guest
+    assert handle(dash, "bob", GUEST_RULES[2])[1] <= 6
+    # later taps read the guest and its inbound in one query
+    assert handle(dash, "bob", GUEST_RULES[2])[1] == 1
@@ -0,0 +1,96 @@
+import time, asyncio
+
+import pytest
+
+from reloads import XUIReloader, ReloadError
+
+
+def stand_in(tmp_path, seconds=0.0):
+    """A reload command that logs when it ran to tmp_path/runs. Returns (command, runs)."""
+    runs = tmp_path/"runs"
+    return f"sh -c 'date +%s.%N >> {runs}; sleep {seconds}'", runs
+
+
+def run_count(runs):
+    return len(runs.read_text().split()) if runs.exists() else 0
+
+
+def test_requests_coalesce(tmp_path):
+    command, runs = stand_in(tmp_path)
+    reloader = XUIReloader(command, debounce=0.1, max_delay=1)
+
+    async def main():
+        reloader.start()
+        futures = [reloader.request() for _ in range(15)]
+        return await asyncio.gather(*map(asyncio.wrap_future, futures))
+
+    done = asyncio.run(main())
+
+    assert run_count(runs) == 1
+    assert len(set(done)) == 1
+    assert (reloader.requests, reloader.reloads) == (15, 1)
+
+
+def test_request_during_reload(tmp_path):
+    command, runs = stand_in(tmp_path, seconds=0.3)
+    reloader = XUIReloader(command, debounce=0.05, max_delay=1)
+
+    async def main():
+        reloader.start()
+        first = asyncio.wrap_future(reloader.request())
+        # the reload is running by now, this change isn't part of it
+        await asyncio.sleep(0.15)
+        assert reloader._running
+        second = asyncio.wrap_future(reloader.request())
+        return await first, await second
+
+    first, second = asyncio.run(main())
+
+    assert run_count(runs) == 2
+    assert second > first
+
+
+def test_max_delay(tmp_path):
+    command, runs = stand_in(tmp_path)
+    reloader = XUIReloader(command, debounce=0.2, max_delay=0.3)
+
+    async def main():
+        reloader.start()
+        started, futures = time.time(), []
+        # a request every 50ms would postpone the reload forever without the cap
+        for _ in range(16):
+            futures.append(asyncio.wrap_future(reloader.request()))
+            await asyncio.sleep(0.05)
+        await asyncio.gather(*futures)
+        return started
+
+    started = asyncio.run(main())
+
+    times = [float(t) for t in runs.read_text().split()]
+    assert len(times) >= 2
+    assert times[0] - started < 0.3 + 0.15
+
+
+def test_failure_reaches_every_waiter(tmp_path):
+    reloader = XUIReloader("false", debounce=0.05, max_delay=1)
+
+    async def main():
+        reloader.start()
+        futures = [asyncio.wrap_future(reloader.request()) for _ in range(3)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert len(results) == 3 and all(isinstance(r, ReloadError) for r in results)
+    assert (reloader.reloads, reloader.failures) == (0, 1)
+
+
+def test_without_loop(tmp_path):
+    command, runs = stand_in(tmp_path)
+    reloader = XUIReloader(command)
+
+    # not started, so the reload runs before request returns
+    assert reloader.request().done()
+    assert run_count(runs) == 1
+    with pytest.raises(Exception):
+        XUIReloader("false").request().result()
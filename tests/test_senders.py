@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from senders import OutboundSender, MAX_TEXT_LENGTH, MAX_MEDIA_GROUP, MAX_RETRIES
+
+
+class Bot:
+    """Records the api calls, failing the first `rate_limited` with RetryAfter."""
+    def __init__(self, rate_limited=0):
+        self.calls = []
+        self.rate_limited = rate_limited
+
+    async def _call(self, method, chat_id, content, **kwargs):
+        self.calls.append((method, chat_id, content))
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise RetryAfter(0)
+        return (method, len(self.calls))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call("send_message", chat_id, text)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self._call("send_photo", chat_id, photo)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._call("send_document", chat_id, document)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._call("send_media_group", chat_id, [m.media for m in media])
+        return [("send_media_group", i) for i in range(len(media))]
+
+
+def unlimited():
+    return OutboundSender(global_rate=1e9, chat_rate=1e9, chat_burst=1e9, workers=2)
+
+
+def send(bot, sender, build):
+    """Runs build(sender) -> awaitable on a started sender, returns its result."""
+    async def run():
+        sender.start(bot)
+        try:
+            return await asyncio.wait_for(build(sender), 5)
+        finally:
+            await sender.stop()
+    return asyncio.run(run())
+
+
+def kinds(batch):
+    return [(kind, len(items)) for kind, items in OutboundSender._merge(batch.items)]
+
+
+def test_merge():
+    async def run():
+        sender = OutboundSender()
+        assert kinds(sender.batch(1).text("a").text("b").photo("p1").photo("p2")
+                     .text("c", reply_markup="menu").document("d")) \
+            == [("text", 2), ("media_group", 2), ("text", 1), ("document", 1)]
+        # texts that don't fit one message go out as two
+        assert kinds(sender.batch(1).text("a" * (MAX_TEXT_LENGTH-10)).text("b" * 20)) \
+            == [("text", 1), ("text", 1)]
+        # a photo with a keyboard can't be part of a media group
+        assert kinds(sender.batch(1).photo("p1").photo("p2", reply_markup="menu")) \
+            == [("media_group", 1), ("photo", 1)]
+        assert kinds(sender.batch(1).photo("p1").text("a").photo("p2")) \
+            == [("media_group", 1), ("text", 1), ("media_group", 1)]
+    asyncio.run(run())
+
+
+def test_media_groups_split():
+    bot = Bot()
+
+    def build(sender):
+        batch = sender.batch(1)
+        for i in range(MAX_MEDIA_GROUP + 1):
+            batch.photo(f"p{i}")
+        return batch.send()
+
+    messages = send(bot, unlimited(), build)
+
+    assert [(method, len(content) if method == "send_media_group" else content)
+            for method, _, content in bot.calls] \
+        == [("send_media_group", MAX_MEDIA_GROUP), ("send_photo", f"p{MAX_MEDIA_GROUP}")]
+    assert len(messages) == MAX_MEDIA_GROUP + 1
+
+
+def test_retry_after():
+    bot, sender = Bot(rate_limited=2), unlimited()
+
+    messages = send(bot, sender, lambda sender: sender.batch(1).text("a").text("b").send())
+
+    assert [method for method, *_ in bot.calls] == ["send_message"] * 3
+    assert messages == [("send_message", 3)] * 2
+    assert (sender.retries, sender.api_calls, sender.failed) == (2, 1, 0)
+
+
+def test_retry_after_gives_up():
+    bot, sender = Bot(rate_limited=MAX_RETRIES + 1), unlimited()
+
+    with pytest.raises(RetryAfter):
+        send(bot, sender, lambda sender: sender.batch(1).text("a").send())
+    assert (sender.retries, sender.failed) == (MAX_RETRIES, 1)
+
+
+def test_bad_item_fails_its_batch():
+    bot, sender = Bot(), unlimited()
+
+    async def build(sender):
+        # None can't be merged, the round fails instead of killing the worker
+        results = await asyncio.gather(sender.batch(1).text("a").text(None).send(),
+                                       return_exceptions=True)
+        assert isinstance(results[0], TypeError)
+        # and the same chat is served afterwards
+        return await sender.batch(1).text("b").send()
+
+    assert send(bot, sender, build) == [("send_message", 1)]
+    assert sender.failed == 2
@@ -0,0 +1,41 @@
+import time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backends
+from backends import remember_chat_id, chat_id_of, get_session_store, _known_chat_ids
+
+
+def test_known_chat_ids_bounded(db, monkeypatch):
+    monkeypatch.setattr(_known_chat_ids, "maxsize", 2)
+    for i in range(3):
+        remember_chat_id(f"user{i}", 100 + i)
+
+    assert len(_known_chat_ids) == 2
+    assert _known_chat_ids.get("user0") is None
+    # forgotten here, still in its session
+    assert [chat_id_of(f"user{i}") for i in range(3)] == [100, 101, 102]
+
+
+def test_one_session_store(monkeypatch):
+    built = []
+
+    class Store:
+        def __init__(self, *args):
+            # slow enough for the other threads to find no store yet
+            time.sleep(0.05)
+            built.append(self)
+
+    monkeypatch.setattr(backends, "session_store", None)
+    monkeypatch.setattr(backends, "BOT_SESSIONS_STORE", "sqlite")
+    monkeypatch.setattr(backends, "SQLiteSessionStore", Store)
+    started = threading.Barrier(8)
+
+    def get(_):
+        started.wait()
+        return get_session_store()
+
+    with ThreadPoolExecutor(8) as executor:
+        stores = list(executor.map(get, range(8)))
+
+    assert len(built) == 1
+    assert all(store is built[0] for store in stores)
@@ -0,0 +1,48 @@
+import random, sqlite3
+
+from timeseries import TrafficHistory
+
+
+START = 1_700_000_000
+
+
+def test_saved_history_loads_the_same(tmp_path):
+    path = tmp_path/"history.db"
+    history = TrafficHistory(interval=0, compact_after=5)
+    history.open(path)
+    counters = {i: 0 for i in range(20)}
+    for k in range(300):
+        for i in random.sample(range(20), 5):
+            counters[i] += random.randrange(1, 2**20)
+        # inbound 0 gets renewed, which resets its counters
+        if k == 200:
+            counters[0] = 0
+        history.record([(i, c, c) for i, c in counters.items()], START + k*3600)
+        history.save()
+    # inbound 19 was removed from x-ui
+    del counters[19]
+    history.record([(i, c, c) for i, c in counters.items()], START + 300*3600)
+    history.save()
+
+    loaded = TrafficHistory()
+    loaded.open(path)
+    assert loaded.series.keys() == history.series.keys()
+    for i in counters:
+        for a, b in zip(loaded.series[i].tiers, history.series[i].tiers):
+            assert (a.ts, a.up, a.down) == (b.ts, b.up, b.down)
+    assert history.compactions > 0
+
+
+def test_save_appends_the_new_samples(tmp_path):
+    path = tmp_path/"history.db"
+    history = TrafficHistory(interval=0, compact_after=10)
+    history.open(path)
+    for k in range(3):
+        history.record([(1, k, k), (2, 0, 0)], START + k*300)
+        history.save()
+
+    conn = sqlite3.connect(path)
+    # inbound 2 never moved after its first sample
+    assert conn.execute("SELECT inbound_id, count(*) FROM samples "
+                        "GROUP BY inbound_id").fetchall() == [(1, 3), (2, 1)]
+    assert conn.execute("SELECT count(*) FROM series").fetchone() == (0,)
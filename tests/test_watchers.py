@@ -0,0 +1,30 @@
+from sqlalchemy import text
+
+from configs import XUI_DB_PATH
+from watchers import ChangeWatcher, WATCHES, TableWatch
+
+
+def watcher():
+    # fresh watches, the module's ones are shared with backends.db_watcher
+    return ChangeWatcher(XUI_DB_PATH, [TableWatch(w.event, w.aggregate, w.rows)
+                                       for w in WATCHES])
+
+
+def test_renamed_user(logged_in, db):
+    changes = watcher()
+    assert changes.check() == {}
+
+    with db.begin() as conn:
+        conn.execute(text("UPDATE telegram_users SET username='alicf' WHERE username='alice'"))
+
+    assert changes.check()["users"] == {"alice": ((1, 1), None), "alicf": (None, (1, 1))}
+
+
+def test_logged_out_user(logged_in, db):
+    changes = watcher()
+    changes.check()
+
+    with db.begin() as conn:
+        conn.execute(text("UPDATE telegram_users SET is_auth=0"))
+
+    assert changes.check()["users"] == {"alice": ((1, 1), (0, 1))}
@@ -0,0 +1,292 @@
+"""
+    A local history of every inbound's traffic counters, so the bot can tell
+    how fast an account is being used without asking x-ui's database.
+
+    Samples are taken from snapshots.TrafficSnapshot every `interval`
+    seconds and kept per inbound in typed arrays, one set per tier: raw
+    samples, then the last sample of every hour, then of every day, each
+    with its own retention. The counters are cumulative, so keeping the
+    last sample of a bucket is all downsampling needs.
+
+    On disk every inbound has its arrays as blobs, one row per tier, and a
+    log of the samples taken since they were written. A save only appends
+    the new samples to the log; once an inbound logged `compact_after` of
+    them its blobs are rewritten and its log emptied. Loading replays the
+    log over the blobs, which gives the same tiers the samples gave.
+"""
+
+import time, array, asyncio, logging, pathlib, sqlite3, threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+# (bucket size in seconds, 0 keeps every sample; seconds a sample is kept)
+TIERS = ((0, 2*DAY), (HOUR, 31*DAY), (DAY, 366*DAY))
+
+
+class Tier:
+    __slots__ = ("resolution", "retention", "ts", "up", "down")
+
+    def __init__(self, resolution, retention):
+        self.resolution = resolution
+        self.retention = retention
+        self.ts = array.array("q")
+        self.up = array.array("q")
+        self.down = array.array("q")
+
+    def add(self, ts, up, down):
+        if (self.resolution and self.ts
+                and self.ts[-1]//self.resolution == ts//self.resolution):
+            self.ts[-1], self.up[-1], self.down[-1] = ts, up, down
+            return
+        self.ts.append(ts)
+        self.up.append(up)
+        self.down.append(down)
+
+    def trim(self, now):
+        cut = bisect_left(self.ts, now - self.retention)
+        if cut:
+            del self.ts[:cut], self.up[:cut], self.down[:cut]
+
+    def clear(self):
+        del self.ts[:], self.up[:], self.down[:]
+
+    def at(self, t):
+        """The last sample taken at or before t, or None."""
+        i = bisect_right(self.ts, t) - 1
+        if i < 0:
+            return None
+        return self.ts[i], self.up[i], self.down[i]
+
+    def between(self, start, end):
+        lo, hi = bisect_left(self.ts, start), bisect_right(self.ts, end)
+        return list(zip(self.ts[lo:hi], self.up[lo:hi], self.down[lo:hi]))
+
+
+class Series:
+    __slots__ = ("tiers",)
+
+    def __init__(self, tiers=TIERS):
+        self.tiers = [Tier(*tier) for tier in tiers]
+
+    @property
+    def last(self):
+        raw = self.tiers[0]
+        if not raw.ts:
+            return None
+        return raw.ts[-1], raw.up[-1], raw.down[-1]
+
+    def add(self, ts, up, down):
+        last = self.last
+        # x-ui resets the counters when an account is renewed
+        if last is not None and up + down < last[1] + last[2]:
+            for tier in self.tiers:
+                tier.clear()
+        for tier in self.tiers:
+            tier.add(ts, up, down)
+            tier.trim(ts)
+
+    def _covering(self, t):
+        """The finest tier still holding a sample from t or before."""
+        for tier in self.tiers:
+            if tier.ts and tier.ts[0] <= t:
+                return tier
+        # t is older than everything kept, take the tier reaching back furthest
+        kept = [tier for tier in self.tiers if tier.ts]
+        return min(kept, key=lambda tier: tier.ts[0]) if kept else self.tiers[0]
+
+    def at(self, t):
+        return self._covering(t).at(t)
+
+    def between(self, start, end):
+        return self._covering(start).between(start, end)
+
+    def first(self):
+        starts = [(tier.ts[0], tier.up[0], tier.down[0]) for tier in self.tiers if tier.ts]
+        return min(starts) if starts else None
+
+
+class TrafficHistory:
+    """
+        Kept in memory until open() is given the sqlite file to load from
+        and save to.
+    """
+    def __init__(self, interval=300, tiers=TIERS, compact_after=48):
+        self.interval = interval
+        self.tiers = tiers
+        self.compact_after = compact_after
+        self.series = {}
+        self.samples = 0
+        self.last_sample = None
+        self.compactions = 0
+        self._lock = threading.Lock()
+        # inbound id -> samples not saved yet, and how many each has in the log
+        self._pending = {}
+        self._logged = {}
+        self._deleted = set()
+        self._tasks = set()
+        self._conn = None
+
+    def open(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS series ("
+            "inbound_id INTEGER NOT NULL, tier INTEGER NOT NULL, "
+            "ts BLOB NOT NULL, up BLOB NOT NULL, down BLOB NOT NULL, "
+            "PRIMARY KEY (inbound_id, tier))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "inbound_id INTEGER NOT NULL, ts INTEGER NOT NULL, "
+            "up INTEGER NOT NULL, down INTEGER NOT NULL, "
+            "PRIMARY KEY (inbound_id, ts)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        rows = self._conn.execute("SELECT inbound_id, tier, ts, up, down FROM series")
+        with self._lock:
+            for inbound_id, index, ts, up, down in rows:
+                if index >= len(self.tiers):
+                    continue
+                series = self.series.setdefault(inbound_id, Series(self.tiers))
+                tier = series.tiers[index]
+                tier.ts.frombytes(ts)
+                tier.up.frombytes(up)
+                tier.down.frombytes(down)
+            rows = self._conn.execute(
+                "SELECT inbound_id, ts, up, down FROM samples ORDER BY inbound_id, ts")
+            for inbound_id, ts, up, down in rows:
+                self.series.setdefault(inbound_id, Series(self.tiers)).add(ts, up, down)
+                self._logged[inbound_id] = self._logged.get(inbound_id, 0) + 1
+
+    def save(self):
+        """Writes the samples taken since the last save in one transaction."""
+        if self._conn is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            deleted, self._deleted = [(i,) for i in self._deleted], set()
+            appended, blobs, compacted = [], [], []
+            for inbound_id, samples in pending.items():
+                series = self.series[inbound_id]
+                logged = self._logged.get(inbound_id, 0) + len(samples)
+                if logged < self.compact_after:
+                    self._logged[inbound_id] = logged
+                    appended += [(inbound_id, *sample) for sample in samples]
+                    continue
+                self._logged.pop(inbound_id, None)
+                compacted.append((inbound_id,))
+                for index, tier in enumerate(series.tiers):
+                    blobs.append((inbound_id,
+                                  index,
+                                  tier.ts.tobytes(),
+                                  tier.up.tobytes(),
+                                  tier.down.tobytes()))
+            with self._conn:
+                self._conn.executemany("DELETE FROM series WHERE inbound_id=?", deleted)
+                self._conn.executemany("DELETE FROM samples WHERE inbound_id=?",
+                                       deleted + compacted)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO series (inbound_id, tier, ts, up, down) "
+                    "VALUES (?, ?, ?, ?, ?)", blobs)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO samples (inbound_id, ts, up, down) "
+                    "VALUES (?, ?, ?, ?)", appended)
+            self.compactions += len(compacted)
+
+    def record(self, counters, now=None):
+        """Takes (inbound id, up, down) of every inbound, stores those that moved."""
+        now = int(now or time.time())
+        seen = set()
+        with self._lock:
+            for inbound_id, up, down in counters:
+                seen.add(inbound_id)
+                series = self.series.get(inbound_id)
+                if series is None:
+                    series = self.series[inbound_id] = Series(self.tiers)
+                last = series.last
+                # an idle inbound needs no new sample, its last one still holds
+                if last is not None and last[1:] == (up, down):
+                    continue
+                series.add(now, up, down)
+                self._pending.setdefault(inbound_id, []).append((now, up, down))
+            for inbound_id in self.series.keys() - seen:
+                del self.series[inbound_id]
+                self._pending.pop(inbound_id, None)
+                self._logged.pop(inbound_id, None)
+                self._deleted.add(inbound_id)
+            self.samples += 1
+            self.last_sample = now
+
+    def observe(self, snapshot, now=None):
+        """Snapshot listener, samples at most once every `interval` seconds."""
+        now = now or time.time()
+        if self.last_sample is not None and now - self.last_sample < self.interval:
+            return
+        self.last_sample = now
+        counters = [(stat.id, stat.up, stat.down) for stat in snapshot.inbounds.values()]
+
+        def sample():
+            self.record(counters, now)
+            self.save()
+
+        task = asyncio.ensure_future(asyncio.to_thread(sample))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def range(self, inbound_id, start, end=None):
+        """(timestamp, up, down) samples of the inbound, at the finest kept resolution."""
+        with self._lock:
+            series = self.series.get(inbound_id)
+            if series is None:
+                return []
+            return series.between(start, end or time.time())
+
+    def usage_rate(self, inbound_id, window=DAY, now=None):
+        """Bytes per second used over the last `window` seconds, None without history."""
+        now = now or time.time()
+        with self._lock:
+            series = self.series.get(inbound_id)
+            if series is None or series.last is None:
+                return None
+            start = series.at(now - window) or series.first()
+            last = series.last
+        elapsed = now - start[0]
+        if elapsed <= 0:
+            return None
+        return ((last[1] + last[2]) - (start[1] + start[2])) / elapsed
+
+    def projected_exhaustion(self, stat, window=DAY, now=None):
+        """When the inbound runs out of traffic at its current rate, None if it won't."""
+        if not stat.total:
+            return None
+        now = now or time.time()
+        rate = self.usage_rate(stat.id, window, now)
+        if not rate or rate <= 0:
+            return None
+        remaining = max(0, stat.remaining_traffic)
+        return datetime.fromtimestamp(now + remaining / rate)
+
+    def close(self):
+        if self._conn is not None:
+            self.save()
+            self._conn.close()
+            self._conn = None
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "inbounds": len(self.series),
+            "samples": self.samples,
+            "last_sample": self.last_sample,
+            "compactions": self.compactions,
+        }
@@ -0,0 +1,163 @@
+"""
+    Free trials for guests. A pool of inbounds is created ahead of time and
+    reloaded into x-ui in the background, so giving a guest a trial is one
+    short transaction: take an inbound from the pool, rename it, start its
+    expiry and insert the guest row. guest_users.username is unique, which
+    makes issuing idempotent even across processes.
+"""
+
+import asyncio, logging, threading
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+
+from models import engine, Inbounds, GuestUsers, TrialPoolInbounds, HAS_RETURNING
+from ports import PortTaken, check_taken
+
+
+logger = logging.getLogger(__name__)
+
+
+class TrialPool:
+    """
+        allocator is a ports.PortAllocator, reloader a reloads.XUIReloader
+        and inbound_values backends.InboundsBackend.inbound_values.
+    """
+    def __init__(self,
+                 allocator,
+                 reloader,
+                 inbound_values,
+                 size=20,
+                 protocol="vless",
+                 quota=1,
+                 days=30):
+        self.allocator = allocator
+        self.reloader = reloader
+        self.inbound_values = inbound_values
+        self.size = size
+        self.protocol = protocol
+        self.quota = quota
+        self.days = days
+        self.loop = None
+        self.claims = 0
+        self.misses = 0
+        self.created = 0
+        self._wanted = None
+        self._lock = threading.Lock()
+
+    def start(self, loop=None):
+        """Binds the pool to the loop its top up task runs on."""
+        self.loop = loop or asyncio.get_running_loop()
+        self._wanted = asyncio.Event()
+
+    def available(self) -> int:
+        with engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(TrialPoolInbounds)).scalar()
+
+    @staticmethod
+    def _pop(conn):
+        if HAS_RETURNING:
+            return conn.execute(
+                delete(TrialPoolInbounds)
+                .where(TrialPoolInbounds.inbound_id==(
+                    select(TrialPoolInbounds.inbound_id).limit(1).scalar_subquery()))
+                .returning(TrialPoolInbounds.inbound_id)
+            ).scalar()
+        # the write lock is taken by the delete, so check it did remove the row
+        while True:
+            inbound_id = conn.execute(select(TrialPoolInbounds.inbound_id).limit(1)).scalar()
+            if inbound_id is None:
+                return None
+            deleted = conn.execute(
+                delete(TrialPoolInbounds).where(TrialPoolInbounds.inbound_id==inbound_id))
+            if deleted.rowcount:
+                return inbound_id
+
+    def claim(self, username) -> bool:
+        """
+            Gives username an inbound from the pool. Returns False if the pool
+            is empty, raises IntegrityError if username already has a trial.
+        """
+        now = datetime.now()
+        with engine.begin() as conn:
+            inbound_id = self._pop(conn)
+            if inbound_id is None:
+                self.misses += 1
+                self.wake()
+                return False
+            conn.execute(
+                update(Inbounds)
+                .where(Inbounds.id==inbound_id)
+                .values(remark=f"{username}_test",
+                        expiry_time=int((now + timedelta(days=self.days)).timestamp()*1e3))
+            )
+            conn.execute(GuestUsers.__table__.insert().values(username=username,
+                                                              inbound_id=inbound_id,
+                                                              created=now,
+                                                              updated=now))
+        self.claims += 1
+        self.wake()
+        return True
+
+    def top_up(self) -> int:
+        """Creates the inbounds missing from the pool with one reload, returns how many."""
+        with self._lock:
+            missing = self.size - self.available()
+            if missing <= 0:
+                return 0
+            ports = []
+            try:
+                for _ in range(missing):
+                    ports.append(self.allocator.allocate())
+                while True:
+                    rows = [self.inbound_values(self.protocol, f"trial_pool_{port}", port,
+                                                self.quota)
+                            for port in ports]
+                    try:
+                        with engine.begin() as conn:
+                            conn.execute(Inbounds.__table__.insert(), rows)
+                            check_taken(conn, ports)
+                            inbound_ids = conn.execute(
+                                select(Inbounds.id).where(Inbounds.port.in_(ports))
+                            ).scalars().all()
+                            conn.execute(TrialPoolInbounds.__table__.insert(),
+                                         [{"inbound_id": i, "created": datetime.now()}
+                                          for i in inbound_ids])
+                        break
+                    except PortTaken as e:
+                        self.allocator.replace(ports, e.ports)
+            except Exception:
+                for port in ports:
+                    self.allocator.release(port)
+                raise
+            self.created += missing
+        # the pooled inbounds only work once x-ui reloaded them
+        self.reloader.request()
+        return missing
+
+    def wake(self):
+        """Asks the top up task to run now, safe to call from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wanted.set)
+
+    async def run(self, interval=300):
+        while True:
+            try:
+                created = await asyncio.to_thread(self.top_up)
+                if created:
+                    logger.info("added %s inbounds to the trial pool", created)
+            except Exception:
+                logger.exception("topping up the trial pool failed")
+            try:
+                await asyncio.wait_for(self._wanted.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wanted.clear()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "claims": self.claims,
+            "misses": self.misses,
+            "created": self.created,
+        }
@@ -1,7 +1,14 @@
-import random, string, io, qrcode
+import random, string, io, asyncio
 from functools import wraps
-from telegram import Update
-from backends import BotUsersBackend
+from typing import TYPE_CHECKING
+
+from caches import QRCache
+from configs import QR_CACHE_BYTES, QR_CACHE_DIR, QR_CACHE_FILE_IDS
+
+# models imports this module, so keep telegram and qrcode (with PIL) out of
+# its import time; they're imported on first use
+if TYPE_CHECKING:
+    from telegram import Update
 
 
 def random_str(length=8) -> int:
@@ -12,18 +19,24 @@ def random_str(length=8) -> int:
 
 def login_required(function):
     @wraps(function)
-    async def wrapper(update: Update, context):
+    async def wrapper(update: "Update", context):
+        # backends imports models, which imports this module for random_str,
+        # and clients imports this module for the decorator
+        from backends import BotUsersBackend
+        from clients import reply
+        
         username = update.effective_user.username
-        user_qs = BotUsersBackend.user_exists(username)
-        if user_qs.scalar() and user_qs.first().is_auth:
+        if await BotUsersBackend.ais_authenticated(username):
             return await function(update, context)
-        await update.message.reply_text(
-            "برای استفاده از این قابلیت لطفا ابتدا وارد حساب کاربری خود شوید")
+        await reply(update,
+                    "برای استفاده از این قابلیت لطفا ابتدا وارد حساب کاربری خود شوید")
         return chr(0)
     return wrapper
 
 
-def generate_qr(data):
+def render_qr(data) -> bytes:
+    import qrcode
+
     qr = qrcode.QRCode(version=1,
                   box_size=10,
                   border=5)
@@ -32,5 +45,29 @@ def generate_qr(data):
     buff = io.BytesIO()
     qr_image = qr.make_image()
     qr_image.save(buff, format="PNG") 
-    buff.seek(0)
-    return buff
+    return buff.getvalue()
+
+
+qr_cache = QRCache(render_qr,
+                   max_bytes=QR_CACHE_BYTES,
+                   directory=QR_CACHE_DIR,
+                   max_file_ids=QR_CACHE_FILE_IDS)
+
+
+def generate_qr(data):
+    return io.BytesIO(qr_cache.png(data))
+
+
+async def qr_photo(data):
+    """
+        Returns the file_id of an already uploaded qr code of data, or its
+        PNG. A code that isn't cached is rendered off the event loop.
+    """
+    return qr_cache.file_id(data) or await asyncio.to_thread(generate_qr, data)
+
+
+def remember_qr_upload(data, message):
+    """Saves the file_id telegram gave to the qr code of data sent in message."""
+    photo = getattr(message, "photo", None)
+    if photo:
+        qr_cache.set_file_id(data, photo[-1].file_id)
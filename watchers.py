@@ -0,0 +1,165 @@
+"""
+    Notices changes x-ui, an admin or the bot itself made to the x-ui
+    database and tells the caches built on it, instead of them expiring on
+    a timer.
+
+    A check costs a stat() of the database and its WAL while nothing is
+    written. After a write, `PRAGMA data_version` says whether another
+    connection committed. Then one aggregate query per watched table says
+    whether that table changed. Only then are the table's rows read and
+    diffed, so subscribers get exactly the keys that changed.
+"""
+
+import os, asyncio, logging, pathlib, sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+
+class TableWatch:
+    """
+        event is what subscribers listen to. aggregate is a query whose
+        result changes whenever the watched columns do. rows, if given,
+        selects (key, *columns) to find which keys changed.
+    """
+    def __init__(self, event, aggregate, rows=None):
+        self.event = event
+        self.aggregate = aggregate
+        self.rows = rows
+        self.fingerprint = None
+        self.state = None
+
+
+WATCHES = (
+    # what the bot shows and hands out of an inbound, without its counters
+    TableWatch("inbounds",
+               "SELECT count(*), max(id), total(port), total(enable), total(total), "
+               "total(expiry_time), total(length(remark)), total(length(protocol)), "
+               "total(length(settings)), total(length(stream_settings)) FROM inbounds",
+               "SELECT id, port, enable, total, expiry_time, remark, protocol, "
+               "length(settings), length(stream_settings) FROM inbounds"),
+    TableWatch("traffic",
+               "SELECT total(up), total(down) FROM inbounds"),
+    # the usernames are concatenated in id order, so renaming one shows too
+    TableWatch("users",
+               "SELECT count(*), max(id), total(is_auth), total(bot_id), "
+               "group_concat(username, char(10)) FROM "
+               "(SELECT id, username, is_auth, bot_id FROM telegram_users ORDER BY id)",
+               "SELECT username, is_auth, bot_id FROM telegram_users"),
+    # which inbounds belong to whom, on this node and the others
+    TableWatch("owners",
+               "SELECT (SELECT count(*) FROM users_inbounds_relation), "
+               "(SELECT total(bot_id*inbound_id) FROM users_inbounds_relation), "
+               "(SELECT count(*) FROM guest_users), "
+               "(SELECT total(inbound_id) FROM guest_users), "
+               "(SELECT count(*) FROM node_inbounds_relation), "
+               "(SELECT total(bot_id*inbound_id) FROM node_inbounds_relation)"),
+)
+
+
+class ChangeWatcher:
+    def __init__(self, path, watches=WATCHES):
+        self.path = pathlib.Path(path)
+        self.watches = watches
+        self.checks = 0
+        self.scans = 0
+        self.events = {w.event: 0 for w in watches}
+        self._subscribers = {}
+        self._conn = None
+        self._file_state = None
+        self._data_version = None
+
+    def subscribe(self, event, callback):
+        """
+            callback(changes) is called on the event loop. changes maps each
+            changed key to its (old row, new row), None for a missing one,
+            or is None for watches without rows.
+        """
+        self._subscribers.setdefault(event, []).append(callback)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro",
+                                         uri=True,
+                                         check_same_thread=False)
+        return self._conn
+
+    def _stat(self):
+        states = []
+        for path in (self.path, self.path.with_name(self.path.name + "-wal")):
+            try:
+                stat = os.stat(path)
+                states.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except FileNotFoundError:
+                states.append(None)
+        return states
+
+    def check(self) -> dict:
+        """Returns {event: changes} of what changed since the last check. Blocking."""
+        self.checks += 1
+        file_state = self._stat()
+        if file_state == self._file_state:
+            return {}
+        self._file_state = file_state
+        conn = self._connect()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return {}
+        self._data_version = data_version
+        self.scans += 1
+        changed = {}
+        # one read transaction, so every watch sees the same commit
+        conn.execute("BEGIN")
+        try:
+            for watch in self.watches:
+                fingerprint = conn.execute(watch.aggregate).fetchone()
+                first = watch.fingerprint is None
+                if fingerprint == watch.fingerprint:
+                    continue
+                watch.fingerprint = fingerprint
+                changes = None
+                if watch.rows is not None:
+                    state = {row[0]: row[1:] for row in conn.execute(watch.rows)}
+                    if not first:
+                        changes = {
+                            key: (watch.state.get(key), state.get(key))
+                            for key in watch.state.keys() | state.keys()
+                            if watch.state.get(key) != state.get(key)
+                        }
+                    watch.state = state
+                # the first check only learns what's there
+                if not first and changes != {}:
+                    changed[watch.event] = changes
+        finally:
+            conn.execute("COMMIT")
+        return changed
+
+    def publish(self, changed):
+        for event, changes in changed.items():
+            self.events[event] += 1
+            for callback in self._subscribers.get(event, ()):
+                try:
+                    callback(changes)
+                except Exception:
+                    logger.exception("a subscriber of %s failed", event)
+
+    async def run(self, interval=1.0):
+        while True:
+            try:
+                self.publish(await asyncio.to_thread(self.check))
+            except Exception:
+                logger.exception("checking %s for changes failed", self.path)
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "checks": self.checks,
+            "scans": self.scans,
+            **{f"{event}_events": n for event, n in self.events.items()},
+        }